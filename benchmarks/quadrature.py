@@ -0,0 +1,65 @@
+import time
+import logging
+import sys
+import numpy as np
+import torch
+
+import copulagp.bvcopula as bvcopula
+from copulagp.bvcopula import conf
+
+# Compares the Monte Carlo and the quadrature estimates of the expected log likelihood
+# (conf.expected_log_prob) in terms of the number of steps to convergence, wall time and WAIC.
+# Usage: python quadrature.py [device] [NSamp]
+
+device = torch.device(sys.argv[1] if len(sys.argv)>1 else 'cpu')
+NSamp = int(sys.argv[2]) if len(sys.argv)>2 else 2000
+repeats = 3
+
+class StepCounter(logging.Handler):
+	'''
+	Gets the number of training steps from the infer logs
+	'''
+	def __init__(self):
+		super().__init__(level=logging.DEBUG)
+		self.steps = conf.max_num_iter
+	def emit(self, record):
+		msg = record.getMessage()
+		if 'converged in' in msg.lower():
+			self.steps = int(msg[msg.find(' in ')+4:].split()[0])
+
+mixtures = {
+	'Gaussian': [bvcopula.GaussianCopula_Likelihood()],
+	'Gaussian+Clayton': [bvcopula.GaussianCopula_Likelihood(),
+						bvcopula.ClaytonCopula_Likelihood(rotation='90°')],
+	'Gaussian+Clayton+Gumbel': [bvcopula.GaussianCopula_Likelihood(),
+						bvcopula.ClaytonCopula_Likelihood(rotation='90°'),
+						bvcopula.GumbelCopula_Likelihood(rotation='180°')],
+}
+modes = [('mc', None), ('quadrature', 2), ('quadrature', 3)]
+
+logging.getLogger().setLevel(logging.DEBUG)
+x = torch.linspace(0.,1.,NSamp)
+train_x = x.float().to(device=device)
+
+for name, likelihoods in mixtures.items():
+	for mode, level in modes:
+		conf.expected_log_prob = mode
+		if level is not None:
+			conf.quadrature_level = level
+		steps, times, waics = [], [], []
+		for rep in range(repeats):
+			torch.manual_seed(rep)
+			# data from a Gaussian copula with a varying correlation
+			train_y = bvcopula.GaussianCopula(0.8*torch.sin(3*x)).sample().squeeze().float().to(device=device)
+			counter = StepCounter()
+			logging.getLogger().addHandler(counter)
+			t = time.time()
+			waic, _ = bvcopula.infer(likelihoods,train_x,train_y,device=device)
+			times.append(time.time()-t)
+			logging.getLogger().removeHandler(counter)
+			steps.append(counter.steps)
+			waics.append(waic)
+		label = mode if level is None else f'{mode} (level {level})'
+		print(f'{name:25} {label:22} steps={np.mean(steps):6.0f} time={np.mean(times):6.1f}s '
+			f'WAIC={np.mean(waics):.4f}+-{np.std(waics):.4f}', flush=True)
+conf.expected_log_prob = 'mc'
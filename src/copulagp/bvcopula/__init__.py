@@ -1,4 +1,4 @@
-from .distributions import IndependenceCopula, GaussianCopula, FrankCopula, ClaytonCopula, GumbelCopula, StudentTCopula, MixtureCopula
+from .distributions import IndependenceCopula, GaussianCopula, FrankCopula, ClaytonCopula, GumbelCopula, StudentTCopula, MixtureCopula, CopulaFeatures
 from .likelihoods import IndependenceCopula_Likelihood, GaussianCopula_Likelihood, FrankCopula_Likelihood, \
 	ClaytonCopula_Likelihood, GumbelCopula_Likelihood, StudentTCopula_Likelihood, MixtureCopula_Likelihood
 from .models import MultitaskGPModel, Pair_CopulaGP, Pair_CopulaGP_data
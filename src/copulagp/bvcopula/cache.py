@@ -0,0 +1,106 @@
+import os
+import hashlib
+import logging
+import tempfile
+import torch
+from torch import Tensor
+
+from copulagp.utils import get_copula_name_string
+from . import conf
+
+# bump when the stored format or the meaning of the results changes
+CACHE_VERSION = 1
+
+# conf parameters that do not affect the trained model
+_IGNORED_CONF = ('cache_dir', 'cache_max_bytes', 'validation', 'history_size', 'waic_memory_budget')
+
+class InferCache():
+    '''
+    Persistent content-addressed cache of the infer results (WAIC and model weights).
+    Each result is a file named by the hash of everything it depends on:
+    the data, the mixture, the model settings and the bvcopula conf.
+    Files are written atomically (several processes can share the cache),
+    and the least recently used ones are removed when the total size
+    exceeds max_bytes.
+    '''
+    def __init__(self, path: str, max_bytes: int):
+        self.path, self.max_bytes = path, max_bytes
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, bvcopulas: list, train_x: Tensor, train_y: Tensor, grid_size=None, prior_rbf_length=0.5) -> str:
+        '''
+        Returns the hash of the data, the mixture, the model settings and the conf parameters
+        '''
+        h = hashlib.sha256()
+        for tensor in [train_x, train_y]:
+            tensor = tensor.detach().cpu().contiguous()
+            h.update(f'{tensor.dtype}{tuple(tensor.shape)}'.encode())
+            h.update(tensor.numpy().tobytes())
+        settings = {k: v for k, v in sorted(vars(conf).items())
+                    if (not k.startswith('_')) and (k not in _IGNORED_CONF)
+                    and isinstance(v, (bool, int, float, str, type(None)))}
+        h.update(repr((CACHE_VERSION, get_copula_name_string(bvcopulas),
+                       grid_size, prior_rbf_length, settings)).encode())
+        return h.hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, f'{key}.pth')
+
+    def get(self, key: str, bvcopulas: list, device: torch.device, grid_size=None):
+        '''
+        Returns the cached (WAIC, Pair_CopulaGP) or None
+        '''
+        from .models import Pair_CopulaGP
+        filename = self._file(key)
+        try:
+            entry = torch.load(filename, map_location=device)
+            os.utime(filename) # mark as recently used
+        except (FileNotFoundError, EOFError, RuntimeError) as error:
+            if not isinstance(error, FileNotFoundError):
+                logging.warning(f'Corrupted cache entry {filename}: {error}')
+            return None
+        model = Pair_CopulaGP(bvcopulas, device=device, grid_size=grid_size)
+        model.gp_model.load_state_dict(entry['weights'])
+        return entry['waic'], model
+
+    def put(self, key: str, waic: float, model):
+        '''
+        Stores the result, then evicts the least recently used entries
+        '''
+        state_dict = model.gp_model.cholesky_state_dict()
+        entry = {'waic': waic, 'weights': {k: v.cpu() for k, v in state_dict.items()}}
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            torch.save(entry, f)
+        os.replace(tmp, self._file(key))
+        self.evict()
+
+    def evict(self):
+        '''
+        Removes the least recently used entries, until the cache fits in max_bytes
+        '''
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith('.pth'):
+                try:
+                    stat = os.stat(os.path.join(self.path, name))
+                except FileNotFoundError: # removed by another process
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+def infer_cache():
+    '''
+    Returns the InferCache in conf.cache_dir (None if caching is off)
+    '''
+    if conf.cache_dir is None:
+        return None
+    return InferCache(conf.cache_dir, conf.cache_max_bytes)
@@ -12,6 +12,28 @@ r_loss_tol = 0.001 			# or, the relative change in loss
 loss_tol2check_waic = 0.05
 waic_tol = 0.005 # maximal WAIC indistinguishable from 0
 loss_av = 25 # average over this number x 2 of epochs is used for early stopping
+minibatch_size = None # if set, datasets with more points are trained on random minibatches of this size
+# 'adam' -- Adam for all parameters
+# 'ngd' -- natural gradient descent for the variational distribution q(u), Adam for the hyperparameters
+optimizer = 'adam'
+ngd_lr = 0.1
+lbfgs_iter = 0 # if >0, the trained parameters are polished with (at most) this many L-BFGS iterations
+# warm start (infer with init_from): jitter added to the interpolated covariance of q(u),
+# and the minimal mixing weight set for the copulas (to keep the mixing latents finite)
+warm_start_jitter = 1e-4
+warm_start_min_mix = 1e-3
+history_size = 100 # the number of the last iter_print steps recorded in the training history (for output_loss)
+
+# persistent cache of the infer results (see cache.py):
+# directory (None -- no caching), and the size limit, above which the least recently used results are removed
+cache_dir = None
+cache_max_bytes = 2**30
+
+# numerical checks (NaN/inf) on the hot paths:
+# 'strict' -- assert on every call (forces a device sync each time)
+# 'sampled' -- accumulate on-device flags, which infer inspects every iter_print iterations
+# 'off' -- skip the checks
+validation = 'strict'
 
 # copula's theta ranges
 # here thetas are mainly constrained by the summation of probabilities in mixture model,
@@ -32,3 +54,13 @@ Gauss_diag = 1e-5 # how far from diagonal the point can be to be considered as u
 # waic parameters
 waic_samples = 500
 waic_resamples = 3 #how many times to repeat
+waic_memory_budget = 2**30 # bytes; GP samples for WAIC are processed in chunks that fit in this budget
+
+# evaluate all elements of a mixture in a single vectorized pass
+fused_log_prob = True
+
+# expected log likelihood in the ELBO:
+# 'mc' -- Monte Carlo estimate with num_likelihood_samples draws of f (set in infer)
+# 'quadrature' -- deterministic sparse Gauss-Hermite rule over f
+expected_log_prob = 'mc'
+quadrature_level = 2 # exact for polynomials in f of total degree up to 2*level-1
@@ -2,6 +2,83 @@ import torch
 from torch.distributions.distribution import Distribution
 from torch.distributions import constraints, normal, studentT
 from . import conf
+from . import validation
+
+# which coordinates of the samples (u,v) are flipped (x -> 1-x) by each rotation
+_rotation_flips = {None: (0, 0), '0°': (0, 0), '90°': (0, 1), '180°': (1, 1), '270°': (1, 0)}
+
+class CopulaFeatures():
+    '''
+    Transforms of the copula samples, that are shared between
+    the elements of a mixture copula. Each transform is computed
+    at most once and then reused by every element of the mixture.
+    Rotated copies of the samples are stored along the first dimension:
+    index 0 contains x, and index 1 contains 1-x.
+    Parameters
+    ----------
+    value : Tensor
+        [batch_dims, 2] tensor of samples.
+    '''
+    def __init__(self, value):
+        assert value.shape[-1] == 2 #check that the samples are pairs of variables
+        self.value = value.clamp(0.001,0.999)
+        self.shape = self.value.shape[:-1]
+        self.device = self.value.device
+        u, v = self.value[...,0], self.value[...,1]
+        self.u = torch.stack([u, 1 - u])
+        self.v = torch.stack([v, 1 - v])
+        self.log_u = self.u.log()
+        self.log_v = self.v.log()
+        self._loglog_u, self._loglog_v, self._nrvs = None, None, None
+
+    @property
+    def loglog_u(self):
+        '''
+        log(-log(u)) for both orientations of u
+        '''
+        if self._loglog_u is None:
+            self._loglog_u = (-self.log_u).log()
+        return self._loglog_u
+
+    @property
+    def loglog_v(self):
+        '''
+        log(-log(v)) for both orientations of v
+        '''
+        if self._loglog_v is None:
+            self._loglog_v = (-self.log_v).log()
+        return self._loglog_v
+
+    @property
+    def nrvs(self):
+        '''
+        Normal quantiles of the (non-rotated) samples: [batch_dims, 2]
+        '''
+        if self._nrvs is None:
+            self._nrvs = normal.Normal(torch.zeros(1, device=self.device),
+                torch.ones(1, device=self.device)).icdf(self.value)
+        return self._nrvs
+
+    def rotated(self, name, rotations, dim):
+        '''
+        Selects a rotated transform for each copula in a stack.
+        Parameters
+        ----------
+        name : string
+            Name of the transform, e.g. 'log_u' or 'loglog_v'
+        rotations : list
+            Rotations of the copulas
+        dim : int
+            Number of dimensions of the [copulas, batch_dims] thetas
+        Returns
+        -------
+        transform : Tensor
+            [copulas, batch_dims] tensor, that broadcasts against thetas
+        '''
+        axis = 0 if name.endswith('_u') else 1
+        flip = torch.tensor([_rotation_flips[r][axis] for r in rotations], device=self.device)
+        transform = getattr(self, name)[flip]
+        return transform.reshape(transform.shape[:1] + torch.Size([1]*(dim - transform.dim())) + transform.shape[1:])
 
 class SingleParamCopulaBase(Distribution):
     '''
@@ -152,7 +229,7 @@ class GaussianCopula(SingleParamCopulaBase):
     support = constraints.interval(0,1) # [0,1]
     
     def ppcf(self, samples):
-        assert torch.all(self.theta.abs()<=1.0)
+        validation.check(lambda: self.theta.abs()<=1.0, 'GaussianCopula.ppcf: self.theta.abs()<=1.0')
         
         nrvs = normal.Normal(torch.zeros(1, device=self.theta.device),
                     torch.ones(1, device=self.theta.device)).icdf(samples)
@@ -179,7 +256,7 @@ class GaussianCopula(SingleParamCopulaBase):
         if torch.any(identical):
             size = torch.Size([identical[identical].numel()])
             vals[identical] = torch.empty(size=size,device=self.theta.device).uniform_(0., 1.)
-        assert torch.all(vals==vals)
+        validation.check(lambda: vals==vals, 'NaN in GaussianCopula.ccdf')
         return vals
 
     def log_prob(self, value, safe=False):
@@ -211,8 +288,8 @@ class GaussianCopula(SingleParamCopulaBase):
         log_prob[..., mask] -= torch.log(1 - thetas**2)[..., mask] / 2
 
         #check that formulas were computed correctly (without Nan or inf)
-        assert torch.all(log_prob.abs()!=float("Inf"))
-        assert torch.all(log_prob==log_prob)
+        validation.check(lambda: log_prob.abs()!=float("Inf"), 'inf in GaussianCopula.log_prob')
+        validation.check(lambda: log_prob==log_prob, 'NaN in GaussianCopula.log_prob')
 
         #now add inf were it is appropriate (will be ignored in integration anyway)
         log_prob[(thetas >= 1.)  & ((value[..., 0] - value[..., 1]).abs() <= conf.Gauss_diag)]      = float("Inf") # u==v
@@ -221,10 +298,38 @@ class GaussianCopula(SingleParamCopulaBase):
         # now put everything out of range to -inf (which was most likely Nan otherwise)
         log_prob[mask_theta & ~mask_samples] = -float("Inf") 
 
-        assert torch.all(log_prob==log_prob)
+        validation.check(lambda: log_prob==log_prob, 'NaN in GaussianCopula.log_prob')
         
         return log_prob
 
+    @staticmethod
+    def fused_log_prob(theta, features, rotations, safe=False):
+        '''
+        Log pdf for a stack of Gaussian copulas evaluated on shared features.
+        Samples are always inside (0,1) here, since CopulaFeatures clamps them.
+        Parameters
+        ----------
+        theta : Tensor
+            [copulas, batch_dims] tensor of parameters
+        features : CopulaFeatures
+            Precomputed transforms of the samples
+        rotations : list
+            Rotations of the copulas (not used, Gaussian copula is symmetric)
+        '''
+        thetas = theta*conf.Gauss_Safe_Theta if safe else theta
+        nrvs = features.nrvs
+        mask = (thetas < 1.) & (thetas > -1.)
+        thetas_ = torch.where(mask, thetas, torch.zeros_like(thetas)) # keeps the gradients finite
+        log_prob = (2 * thetas_ * nrvs[..., 0] * nrvs[..., 1] - thetas_**2 \
+            * (nrvs[..., 0]**2 + nrvs[..., 1]**2)) / (2 * (1 - thetas_**2)) \
+            - torch.log(1 - thetas_**2) / 2
+        log_prob = torch.where(mask, log_prob, torch.zeros_like(log_prob))
+
+        u, v = features.u[0], features.v[0]
+        log_prob = log_prob.masked_fill((thetas >= 1.)  & ((u - v).abs() <= conf.Gauss_diag), float("Inf")) # u==v
+        log_prob = log_prob.masked_fill((thetas <= -1.) & ((u - 1 + v).abs() <= conf.Gauss_diag), float("Inf")) # u==1-v
+        return log_prob
+
 class FrankCopula(SingleParamCopulaBase):
     '''
     This class represents a copula from the Frank family.
@@ -257,7 +362,7 @@ class FrankCopula(SingleParamCopulaBase):
                 / (torch.expm1(-theta_)
                    + torch.expm1(-theta_ * samples[..., 0])
                    * torch.expm1(-theta_ * samples[..., 1])))[theta_!=0]
-        assert torch.all(vals==vals)
+        validation.check(lambda: vals==vals, 'NaN in FrankCopula.ccdf')
         return vals
 
     def log_prob(self, value, safe=True):
@@ -285,11 +390,34 @@ class FrankCopula(SingleParamCopulaBase):
         log_prob[mask & ((value[..., 0] <= 0) | (value[..., 1] <= 0) |
                 (value[..., 0] >= 1) | (value[..., 1] >= 1))] = -float("Inf") 
 
-        assert torch.all(log_prob==log_prob)
-        assert torch.all(log_prob!=float("Inf"))
+        validation.check(lambda: log_prob==log_prob, 'NaN in FrankCopula.log_prob')
+        validation.check(lambda: log_prob!=float("Inf"), 'inf in FrankCopula.log_prob')
         
         return log_prob
 
+    @staticmethod
+    def fused_log_prob(theta, features, rotations, safe=True):
+        '''
+        Log pdf for a stack of Frank copulas evaluated on shared features.
+        Parameters
+        ----------
+        theta : Tensor
+            [copulas, batch_dims] tensor of parameters
+        features : CopulaFeatures
+            Precomputed transforms of the samples
+        rotations : list
+            Rotations of the copulas (not used, Frank copula is symmetric)
+        '''
+        u, v = features.u[0], features.v[0]
+        mask = (theta.abs() > 1e-2) & (theta.abs() < conf.Frank_Theta_Max)
+        theta_ = torch.where(mask, theta, torch.ones_like(theta)) # keeps the gradients finite
+        log_prob = torch.log(-theta_ * torch.expm1(-theta_)) \
+                            - (theta_ * (u + v)) \
+                            - 2*torch.log(torch.abs(torch.expm1(-theta_)
+                             + torch.expm1(-theta_ * u)
+                             * torch.expm1(-theta_ * v)))
+        return torch.where(mask, log_prob, torch.zeros_like(log_prob))
+
 class ClaytonCopula(SingleParamCopulaBase):
     '''
     This class represents a copula from the Clayton family.
@@ -307,7 +435,7 @@ class ClaytonCopula(SingleParamCopulaBase):
         unstable_part = torch.zeros_like(vals)
         unstable_part[thetas_>min_lim] = (samples[thetas_>min_lim][..., 0] * (samples[thetas_>min_lim][..., 1]**(1 + nonzero_theta))) \
                 ** (-nonzero_theta / (1 + nonzero_theta))
-        assert torch.all(unstable_part==unstable_part)
+        validation.check(lambda: unstable_part==unstable_part, 'NaN in ClaytonCopula.ppcf')
         if unstable_part.numel() > 0:
             unstable_part = unstable_part.reshape(*samples.shape[:-1])
             mask = (thetas_>min_lim) & (unstable_part != float("Inf"))
@@ -335,9 +463,9 @@ class ClaytonCopula(SingleParamCopulaBase):
         if (self.rotation == '180°') or (self.rotation == '270°'):
             vals = 1 - vals
         samples = self._SingleParamCopulaBase__rotate_input(samples)
-        if torch.any(vals!=vals):
+        if (conf.validation == 'strict') and torch.any(vals!=vals):
             print((core * samples[..., 1]**(-1 - theta_))[vals!=vals])
-        assert torch.all(vals==vals)
+        validation.check(lambda: vals==vals, 'NaN in ClaytonCopula.ccdf')
         return vals
 
     def log_prob(self, value, safe=True):
@@ -363,13 +491,38 @@ class ClaytonCopula(SingleParamCopulaBase):
         log_prob[..., (value[..., 0] <= 0) | (value[..., 1] <= 0) |
                 (value[..., 0] >= 1) | (value[..., 1] >= 1)] = -float("Inf") 
 
-        assert torch.all(log_prob==log_prob)
-        assert torch.all(log_prob!=float("Inf"))
+        validation.check(lambda: log_prob==log_prob, 'NaN in ClaytonCopula.log_prob')
+        validation.check(lambda: log_prob!=float("Inf"), 'inf in ClaytonCopula.log_prob')
 
         #log_prob[(self.theta<1e-2) | (self.theta>16.)] = -float("Inf") 
         
         return log_prob
 
+    @staticmethod
+    def fused_log_prob(theta, features, rotations, safe=True):
+        '''
+        Log pdf for a stack of Clayton copulas evaluated on shared features.
+        Rotations are applied by selecting log(u) or log(1-u) (same for v).
+        Parameters
+        ----------
+        theta : Tensor
+            [copulas, batch_dims] tensor of parameters
+        features : CopulaFeatures
+            Precomputed transforms of the samples
+        rotations : list
+            Rotations of the copulas
+        '''
+        log_u = features.rotated('log_u', rotations, theta.dim())
+        log_v = features.rotated('log_v', rotations, theta.dim())
+        theta_ = torch.clamp(theta,0.,conf.Clayton_Theta_Max)
+        small = theta_ < 1e-4
+        theta_ = torch.where(small, torch.ones_like(theta_), theta_) # keeps the gradients finite
+        log_prob = (torch.log(1 + theta_) + (-1 - theta_) \
+                       * (log_u + log_v) \
+                       + (-1 / theta_ - 2) \
+                       * torch.log(torch.exp(-theta_ * log_u) + torch.exp(-theta_ * log_v) - 1))
+        return log_prob.masked_fill(small, 0.)
+
 class GumbelCopula(SingleParamCopulaBase):
     '''
     This class represents a copula from the Gumbel family.
@@ -403,7 +556,7 @@ class GumbelCopula(SingleParamCopulaBase):
         if (self.rotation == '180°') or (self.rotation == '270°'):
             v = 1 - v
         samples = self._SingleParamCopulaBase__rotate_input(samples)
-        assert torch.all(v==v)
+        validation.check(lambda: v==v, 'NaN in GumbelCopula.ppcf')
         return v
 
     def ccdf(self, samples):
@@ -411,7 +564,7 @@ class GumbelCopula(SingleParamCopulaBase):
         vals = torch.zeros(samples.shape[:-1])
         theta_ = self.theta.expand(samples.shape[:-1]) # prepend with sample dimensions
 
-        assert torch.all(samples>0)
+        validation.check(lambda: samples>0, 'GumbelCopula.ccdf: samples>0')
         
         x = -samples[...,1].log()
         y = -samples[...,0].log()
@@ -422,7 +575,7 @@ class GumbelCopula(SingleParamCopulaBase):
         if (self.rotation == '180°') or (self.rotation == '270°'):
             vals = 1 - vals
         samples = self._SingleParamCopulaBase__rotate_input(samples)
-        assert torch.all(vals==vals)
+        validation.check(lambda: vals==vals, 'NaN in GumbelCopula.ccdf')
         return vals
 
     def log_prob(self, value, safe=True):
@@ -452,11 +605,42 @@ class GumbelCopula(SingleParamCopulaBase):
         log_prob[..., (value[..., 0] <= 0) | (value[..., 1] <= 0) |
                 (value[..., 0] >= 1) | (value[..., 1] >= 1)] = -float("Inf") 
 
-        assert torch.all(log_prob==log_prob)
-        assert torch.all(log_prob!=float("Inf"))
+        validation.check(lambda: log_prob==log_prob, 'NaN in GumbelCopula.log_prob')
+        validation.check(lambda: log_prob!=float("Inf"), 'inf in GumbelCopula.log_prob')
         
         return log_prob
 
+    @staticmethod
+    def fused_log_prob(theta, features, rotations, safe=True):
+        '''
+        Log pdf for a stack of Gumbel copulas evaluated on shared features.
+        Rotations are applied by selecting log(-log(u)) or log(-log(1-u)) (same for v).
+        Parameters
+        ----------
+        theta : Tensor
+            [copulas, batch_dims] tensor of parameters
+        features : CopulaFeatures
+            Precomputed transforms of the samples
+        rotations : list
+            Rotations of the copulas
+        '''
+        loglog_u = features.rotated('loglog_u', rotations, theta.dim())
+        loglog_v = features.rotated('loglog_v', rotations, theta.dim())
+
+        theta_ = torch.clamp(theta,1.,conf.Gumbel_Theta_Max)
+
+        h1 = theta_ - 1.0
+        h2 = (1.0 - 2.0 * theta_) / theta_
+        h3 = 1.0 / theta_
+
+        h4 = -features.rotated('log_u', rotations, theta.dim())
+        h5 = -features.rotated('log_v', rotations, theta.dim())
+        h6 = torch.exp(theta_ * loglog_u) + torch.exp(theta_ * loglog_v)
+        log_h6 = h6.log()
+        h7 = torch.exp(h3 * log_h6)
+
+        return -h7+h4+h5 + h1*loglog_u + h1*loglog_v + h2 * log_h6.clamp(-1e38,float("Inf")) + (h1+h7).log()
+
 class StudentTCopula(SingleParamCopulaBase):
     '''
     This class represents a copula from the Student T family.
@@ -555,8 +739,8 @@ class StudentTCopula(SingleParamCopulaBase):
         log_prob[..., (value[..., 0] <= 0) | (value[..., 1] <= 0) |
                 (value[..., 0] >= 1) | (value[..., 1] >= 1)] = -float("Inf") 
 
-        assert torch.all(log_prob==log_prob)
-        assert torch.all(log_prob!=float("Inf"))
+        validation.check(lambda: log_prob==log_prob, 'NaN in StudentTCopula.log_prob')
+        validation.check(lambda: log_prob!=float("Inf"), 'inf in StudentTCopula.log_prob')
         
         return log_prob
 
@@ -573,7 +757,8 @@ class MixtureCopula(Distribution):
         self.theta = theta
         self.mix = mix
         sum_mixes = self.mix.sum(dim=0)
-        assert torch.allclose(sum_mixes,torch.ones_like(sum_mixes),atol=0.01)
+        validation.check(lambda: torch.isclose(sum_mixes,torch.ones_like(sum_mixes),atol=0.01),
+            'MixtureCopula.__init__: mixing coefficients must sum to 1')
 
         self.copulas = copulas
         assert self.mix.shape[0]==len(self.copulas)
@@ -685,7 +870,7 @@ class MixtureCopula(Distribution):
             else:
                 vals += self.mix[i] * c(self.theta[i], rotation=self.rotations[i]).ccdf(samples)
         vals = vals.clamp(0.001,0.999)
-        assert torch.all(vals==vals)
+        validation.check(lambda: vals==vals, 'NaN in MixtureCopula.ccdf')
         return vals   
 
     def make_dependent(self, samples):
@@ -697,7 +882,7 @@ class MixtureCopula(Distribution):
             Copula with thetas/mixes of shape copulas x inputs
             Samples of shape: inputs x sample_size (any number of dimensions)
         '''
-        assert torch.all(samples==samples)
+        validation.check(lambda: samples==samples, 'NaN in MixtureCopula.make_dependent')
         assert self.mix.shape[0]==len(self.copulas)
         assert samples.shape[-1] == 2 #should be pairs
         if (len(self.copulas)==1) & (self.copulas[0].num_thetas==0): #if it is only independence
@@ -728,8 +913,8 @@ class MixtureCopula(Distribution):
                 vals[onehot[i]] = c(theta_[i,...][onehot[i]], 
                                                rotation=self.rotations[i]).ppcf(
                                                 samples[onehot[i],:])
-        assert torch.all(vals<=1)
-        assert torch.all(vals>=0)
+        validation.check(lambda: vals<=1, 'MixtureCopula.make_dependent: vals<=1')
+        validation.check(lambda: vals>=0, 'MixtureCopula.make_dependent: vals>=0')
         return vals.clamp(0.001,0.999)
 
     def tail(self, value):
@@ -761,16 +946,20 @@ class MixtureCopula(Distribution):
 
         Parameters
         ----------
-        value: Tensor
-            Samples Y
+        value: Tensor or CopulaFeatures
+            Samples Y, or their precomputed transforms
         Returns
         -------
         log p: float
             Log likelihood
         '''
+        features = value if isinstance(value, CopulaFeatures) else None
+        if features is not None:
+            value = features.value
         if self.theta.shape[1:]!=value.shape[:-1]:
             if self.theta.shape[-len(value.shape[:-1]):]==value.shape[:-1]:
-                value = value.expand(self.theta.shape[1:-len(value.shape[:-1])] + value.shape)
+                if not conf.fused_log_prob: # fused evaluation broadcasts the features instead
+                    value = value.expand(self.theta.shape[1:-len(value.shape[:-1])] + value.shape)
             elif self.theta.shape[1:] == value.shape[-len(self.theta.shape[1:])-1:-1]:
                 pass
             else:
@@ -782,10 +971,72 @@ class MixtureCopula(Distribution):
         # if self._validate_args:
         #     self._validate_sample(value)
         assert value.shape[-1] == 2 #check that the samples are pairs of variables
-        prob = torch.zeros_like(value[...,0]) # by default
-        
         assert self.mix.shape[0]==len(self.copulas)
 
+        if conf.fused_log_prob:
+            if features is None:
+                features = CopulaFeatures(value)
+            log_prob = self._fused_log_prob(features, clayton_only=clayton_only, safe=safe)
+        else:
+            log_prob = self._loop_log_prob(value, clayton_only=clayton_only, safe=safe)
+
+        validation.check(lambda: log_prob==log_prob, 'NaN in MixtureCopula.log_prob')
+        validation.check(lambda: log_prob!=float("inf"), 'inf in MixtureCopula.log_prob') #can be -inf though
+
+        return log_prob
+
+    def _fused_log_prob(self, features, clayton_only=False, safe=False):
+        '''
+        Evaluates all elements of the mixture in a single pass.
+        The elements of the same family are stacked and evaluated together,
+        the transforms of the samples are shared between all elements.
+        Parameters
+        ----------
+        features: CopulaFeatures
+            Transforms of the samples Y
+        Returns
+        -------
+        log p: Tensor
+            Log likelihood
+        '''
+        num_copulas = len(self.copulas)
+        # features are broadcasted against thetas, so that the transforms
+        # are computed only once for all GP samples
+        shape = max(self.theta.shape[1:], features.shape, key=len)
+        # align the copula dimension with the leading sample dimensions of the features
+        extra_dims = len(shape) - (self.theta.dim() - 1)
+        component_shape = lambda t: t.reshape(t.shape[:1] + torch.Size([1]*extra_dims) + t.shape[1:])
+        theta = component_shape(self.theta)
+
+        log_probs = features.value.new_zeros(torch.Size([num_copulas]) + shape)
+        families = {}
+        for i, c in enumerate(self.copulas):
+            families.setdefault(c, []).append(i)
+        for c, idx in families.items():
+            if c.__name__ == 'IndependenceCopula':
+                continue # log 1 = 0
+            rotations = [self.rotations[i] for i in idx]
+            if hasattr(c, 'fused_log_prob'):
+                log_probs[idx] = c.fused_log_prob(theta[idx], features, rotations, safe=safe).clamp(-float("inf"),88)
+            else:
+                for i in idx:
+                    log_probs[i] = c(self.theta[i], rotation=self.rotations[i]).log_prob(
+                        features.value.expand(shape + torch.Size([2])).clone(),safe=safe).clamp(-float("inf"),88)
+
+        if clayton_only:
+            log_probs[[i for i, c in enumerate(self.copulas) if c.__name__ != 'ClaytonCopula']] = -float("inf")
+
+        if num_copulas>1:
+            return (component_shape(self.mix).log() + log_probs).logsumexp(0)
+        else:
+            #if these is just 1 copula, no need to do log(exp(p))
+            return log_probs[0]
+
+    def _loop_log_prob(self, value, clayton_only=False, safe=False):
+        '''
+        Evaluates the elements of the mixture one by one.
+        Reference implementation for _fused_log_prob.
+        '''
         value_=(value.clone()).clamp(0.001,0.999)
        
         if len(self.copulas)>1:
@@ -806,11 +1057,7 @@ class MixtureCopula(Distribution):
             elif ( clayton_only and (self.copulas[0].__name__ != 'ClaytonCopula') ):
                 log_prob = -float("inf")*torch.ones_like(value_[...,0]) # log 0 = -inf
             else:
-                assert torch.all(self.theta[0]==self.theta[0])
+                validation.check(lambda: self.theta[0]==self.theta[0], 'NaN in MixtureCopula._loop_log_prob')
                 log_prob = self.copulas[0](self.theta[0], rotation=self.rotations[0]).log_prob(value_,safe=safe).clamp(-float("inf"),88)
 
-
-        assert torch.all(log_prob==log_prob)
-        assert torch.all(log_prob!=float("inf")) #can be -inf though
-
         return log_prob
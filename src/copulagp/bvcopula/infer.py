@@ -6,10 +6,13 @@ from matplotlib import pyplot as plt
 import logging
 from gpytorch.mlls import VariationalELBO
 from gpytorch.settings import num_likelihood_samples
+from gpytorch.optim import NGD
 import gc
 
 from copulagp.utils import get_copula_name_string
 from . import conf
+from . import validation
+from .cache import infer_cache
 
 def plot_loss(filename, losses, rbf, means):
 	# prot loss function and kernel length
@@ -20,18 +23,36 @@ def plot_loss(filename, losses, rbf, means):
 	marg = (np.max(losses) - np.min(losses))*0.1
 	loss.set_ylim(np.min(losses)-marg,
 	              np.max(losses)+marg)
-	rbf=np.array(rbf).squeeze()
+	rbf=np.array(rbf).reshape(len(rbf),-1) # [epochs x (pairs x) GP variables]
 	kern.plot(rbf)
 	kern.set_xlabel("Epoch #")
 	kern.set_ylabel("Kernel scale parameter")
-	mean.plot([np.mean(x,axis=1) for x in means])
+	mean.plot([np.mean(x,axis=-1).ravel() for x in means])
 	mean.set_xlabel("Epoch #")
 	mean.set_ylabel("Mean f")
 	fig.savefig(filename)
 	plt.close()
 
 def infer(bvcopulas, train_x: Tensor, train_y: Tensor, device: torch.device,
-			output_loss=None, grid_size=None, prior_rbf_length=0.5):
+			output_loss=None, grid_size=None, prior_rbf_length=0.5, init_from=None, max_num_iter=None):
+	'''
+	Trains a Pair_CopulaGP model with the mixture bvcopulas on the data
+	Parameters
+	----------
+	init_from: Pair_CopulaGP_data (Default = None)
+		A trained model of a related mixture (e.g. with an element added,
+		dropped or swapped) to initialize the matching copulas from
+		(see Pair_CopulaGP.warm_start). It only speeds up the training,
+		so the cached results (see conf.cache_dir) do not depend on it.
+	max_num_iter: int (Default = None)
+		Training budget, instead of conf.max_num_iter
+		(e.g. for a partial training that is later continued with init_from).
+		Such runs are not cached.
+	Returns
+	-------
+	WAIC: float (list for a batch of pairs)
+	model: Pair_CopulaGP
+	'''
 
 	if device!=torch.device('cpu'):
 		with torch.cuda.device(device):
@@ -40,107 +61,255 @@ def infer(bvcopulas, train_x: Tensor, train_y: Tensor, device: torch.device,
 	logging.info(f'Trying {get_copula_name_string(bvcopulas)}')
 
 	# define the model (optionally on GPU)
+	# train_y of shape [pairs x N x 2] trains a batch of models (one per pair, same bvcopulas) jointly,
+	# then WAIC is a list (one per pair) and the model is batched (see Pair_CopulaGP.split)
 	from .models import Pair_CopulaGP
-	model = Pair_CopulaGP(bvcopulas,device=device,grid_size=grid_size,prior_rbf_length=prior_rbf_length)
-
-	optimizer = torch.optim.Adam([
-	    {'params': model.gp_model.mean_module.parameters()},
-	    {'params': model.gp_model.variational_strategy.parameters()},
-	    {'params': model.gp_model.covar_module.parameters(), 'lr': conf.hyper_lr}, #hyperparameters
-	], lr=conf.base_lr)
+	num_pairs = train_y.shape[0] if train_y.dim()==3 else None
+
+	# the same data and mixture might have been trained before (see conf.cache_dir);
+	# batched models, partial training and the runs that plot the training history are not cached
+	cache = infer_cache() if (num_pairs is None) and (output_loss is None) and (max_num_iter is None) else None
+	if cache is not None:
+		key = cache.key(bvcopulas, train_x, train_y, grid_size=grid_size, prior_rbf_length=prior_rbf_length)
+		cached = cache.get(key, bvcopulas, device, grid_size=grid_size)
+		if cached is not None:
+			logging.info(f'WAIC={cached[0]:.4f} (cached)')
+			return cached
+	natural = (conf.optimizer == 'ngd')
+	model = Pair_CopulaGP(bvcopulas,device=device,grid_size=grid_size,prior_rbf_length=prior_rbf_length,
+						num_pairs=num_pairs,natural=natural)
+	pair_shape = model.gp_model.pair_shape
+	if init_from is not None:
+		model.warm_start(init_from)
+
+	if conf.optimizer == 'adam':
+		optimizer = torch.optim.Adam([
+		    {'params': model.gp_model.mean_module.parameters()},
+		    {'params': model.gp_model.variational_strategy.parameters()},
+		    {'params': model.gp_model.covar_module.parameters(), 'lr': conf.hyper_lr}, #hyperparameters
+		], lr=conf.base_lr)
+	elif conf.optimizer == 'ngd':
+		# natural gradient steps for q(u), Adam for the hyperparameters
+		optimizer = _Optimizers(
+			NGD(model.gp_model.variational_strategy.parameters(), num_data=train_y.size(-2), lr=conf.ngd_lr),
+			torch.optim.Adam([
+			    {'params': model.gp_model.mean_module.parameters()},
+			    {'params': model.gp_model.covar_module.parameters(), 'lr': conf.hyper_lr}, #hyperparameters
+			], lr=conf.base_lr))
+	else:
+		raise ValueError(f"Optimizer '{conf.optimizer}' not supported")
 
 	# train the model
 
 	mll = VariationalELBO(model.likelihood, model.gp_model,
-                            num_data=train_y.size(0))
+                            num_data=train_y.size(-2), combine_terms=(num_pairs is None))
+
+	# train_y does not change during training: transform it once
+	model.likelihood.cache_target(train_y)
 
-	losses, rbf, means = [], [], []
+	# optional training history, in a ring buffer on the device
+	history = _History(conf.history_size) if output_loss is not None else None
 
-	nans_detected = 0
-	WAIC = -1 #assume that the model will train well
+	WAIC = -torch.ones(pair_shape) #assume that the model will train well
+	validation.reset()
+
+	# minibatch SVI for large datasets (the ELBO is still scaled by the full num_data)
+	minibatch = (conf.minibatch_size is not None) and (train_x.shape[0] > conf.minibatch_size)
 	
-	def train(train_x, train_y, num_iter=conf.max_num_iter):
+	def train(train_x, train_y, num_iter=max_num_iter or conf.max_num_iter):
 	    model.gp_model.train()
 	    model.likelihood.train()
 
-	    loss_gpu = torch.zeros(num_iter,device=device)
+	    def elbo_loss(x, y):
+	        return _elbo_loss(model, mll, x, y, num_pairs)
+
+	    if minibatch:
+	        batches = _minibatches(train_x, train_y, conf.minibatch_size)
+	        # convergence and WAIC checks during training use a fixed subset of the data
+	        waic_idx = torch.randperm(train_x.shape[0], device=train_x.device)[:conf.minibatch_size]
+	        waic_x, waic_y = train_x[waic_idx], train_y[...,waic_idx,:]
+	        prev_loss = None
+	    else:
+	        batch_x, batch_y = train_x, train_y
+	        waic_x, waic_y = train_x, train_y
+
+	    loss_gpu = torch.zeros(num_iter,*pair_shape,device=device)
+
+	    p = torch.zeros(pair_shape,device=device)
+	    nans = torch.zeros((),dtype=torch.bool,device=device)
+	    infs = torch.zeros((),dtype=torch.bool,device=device)
+	    # pairs that are still being optimized (on the device, and its copy on the host);
+	    # converged pairs of a batch are masked out, and their parameters are kept frozen
+	    active = torch.ones(pair_shape,dtype=torch.bool,device=device)
+	    active_host = torch.ones(pair_shape,dtype=torch.bool)
+	    all_active = True
+	    params = list(model.gp_model.parameters())
+	    freeze = (num_pairs is not None) and (num_pairs > 1)
+	    frozen = [par.detach().clone() for par in params] if freeze else []
+	    q_u = model.gp_model.variational_strategy.base_variational_strategy
+	    on_cpu = (torch.device(device).type == 'cpu')
+
+	    # convergence flags are copied to the host asynchronously at every iter_print step,
+	    # and acted upon once they arrive (immediately on cpu, a few steps later on gpu)
+	    pending = None
+
+	    def process(pending):
+	        '''
+	        Updates the active pairs given the convergence flags (on the host).
+	        Returns False when all pairs have stopped.
+	        '''
+	        nonlocal active, all_active
+	        step, (converged_abs, converged, check_waic) = pending.step, pending.get()
+	        validation.inspect()
+	        check_waic = check_waic & active_host
+	        not_promising = torch.zeros_like(check_waic)
+	        if torch.any(check_waic):
+	            waic = torch.as_tensor(model.likelihood.WAIC(model.gp_model.grid_posterior(waic_x),waic_y))
+	            not_promising = check_waic & (waic > conf.waic_tol)
+	            if torch.any(not_promising):
+	                logging.debug("Training does not look promissing!")
+	        converged = converged & active_host & ~not_promising
+	        if torch.any(converged):
+	            if num_pairs is None:
+	                a = 'Absolute!' if converged_abs else 'Relative!'
+	                logging.debug(f"Converged in {step+1} steps! ({a})")
+	            else:
+	                logging.debug(f"{int(converged.sum())} pairs converged in {step+1} steps!")
+	        active_host.copy_(active_host & ~(converged | not_promising))
+	        if not torch.all(active_host):
+	            all_active = False
+	            active = active_host.to(device, non_blocking=True)
+	        return bool(torch.any(active_host))
 
-	    p = torch.zeros(1,device=device)
-	    nans = torch.zeros(1,device=device)
 	    for i in range(num_iter):
+	        if (pending is not None) and pending.ready():
+	            if not process(pending):
+	                break
+	            pending = None
+
 	        optimizer.zero_grad()
-	        output = model.gp_model(train_x)
-	        
-	        with num_likelihood_samples(30):
-	        	loss = -mll(output, train_y)  
+	        if minibatch:
+	            batch_x, batch_y = next(batches)
+	        loss = elbo_loss(batch_x, batch_y)
 	 
-	        if i>2*conf.loss_av: 
-	            p += (loss_gpu[i-conf.loss_av:i].mean() - loss_gpu[i-2*conf.loss_av:i-conf.loss_av].mean()).abs()
+	        if (not minibatch) and (i>2*conf.loss_av): 
+	            p += (loss_gpu[i-conf.loss_av:i].mean(dim=0) - loss_gpu[i-2*conf.loss_av:i-conf.loss_av].mean(dim=0)).abs()
 	        loss_gpu[i] = loss.detach()
 
 	        if not (i + 1) % conf.iter_print:
 
-	            losses.append(loss.detach().cpu().numpy())
-	            rbf.append(model.gp_model.covar_module.base_kernel.lengthscale.detach().cpu().numpy().squeeze())
-	            means.append(model.gp_model.variational_strategy.base_variational_strategy._variational_distribution.variational_mean.detach().cpu().numpy())
+	            if history is not None:
+	                history.record(loss=loss,
+	                    rbf=model.gp_model.covar_module.base_kernel.lengthscale,
+	                    means=q_u.variational_distribution.mean)
 	            
-	            mean_p = p/conf.loss_av/2
-	            av_loss = loss_gpu[i-2*conf.loss_av:i].mean().abs().cpu()
+	            if minibatch:
+	                # minibatch losses are too noisy to detect convergence:
+	                # evaluate the loss on the fixed subset with the same MC samples each time,
+	                # so that its change reflects the change of the parameters
+	                with torch.no_grad(), torch.random.fork_rng(devices=[] if train_x.device.type=='cpu' else [train_x.device]):
+	                    torch.manual_seed(0)
+	                    eval_loss = elbo_loss(waic_x, waic_y)
+	                av_loss = eval_loss.abs()
+	                if prev_loss is None:
+	                    mean_p = torch.full(pair_shape, float('inf'), device=device)
+	                else:
+	                    # per 2*loss_av steps, as in the full-batch criterion
+	                    mean_p = (prev_loss - eval_loss).abs() * 2*conf.loss_av/conf.iter_print
+	                prev_loss = eval_loss
+	            else:
+	                mean_p = p/conf.loss_av/2
+	                av_loss = loss_gpu[i-2*conf.loss_av:i].mean(dim=0).abs()
                 # print(f"{i}: {mean_p}")
 
-	            if (mean_p < conf.loss_tol2check_waic):
-	                WAIC = model.likelihood.WAIC(model.gp_model(train_x),train_y)
-	                if (WAIC > conf.waic_tol):
-	                    logging.debug("Training does not look promissing!")
-	                    break	
-
-	            if (mean_p < conf.a_loss_tol) or (mean_p/av_loss < conf.r_loss_tol):
-	                a = 'Absolute!' if (mean_p < conf.a_loss_tol) else 'Relative!'
-	                logging.debug(f"Converged in {i+1} steps! ({a})")
-	                break
-	            p = 0.
+	            converged_abs = mean_p < conf.a_loss_tol
+	            converged = converged_abs | (mean_p/av_loss < conf.r_loss_tol)
+	            check_waic = mean_p < conf.loss_tol2check_waic
+	            # parameters at this step, for the pairs that might stop here
+	            with torch.no_grad():
+	                for par, frozen_par in zip(params, frozen):
+	                    frozen_par.copy_(torch.where(_pair_mask(converged | check_waic, par), par, frozen_par))
+	            if pending is not None:
+	                # the previous flags have not arrived yet: wait for them
+	                if not process(pending):
+	                    break
+	            pending = _HostCopy(torch.stack([converged_abs, converged, check_waic]), step=i)
+	            if pending.ready():
+	                if not process(pending):
+	                    break
+	                pending = None
+	            p.zero_()
 
 	            for param_group in optimizer.param_groups:
 	            	param_group['lr'] = param_group['lr']*conf.decrease_lr
 
 	        # The actual optimization step
-	        loss.backward()
-	        covar_grad = model.gp_model.variational_strategy.base_variational_strategy._variational_distribution.chol_variational_covar.grad
-	        # strict
-	        # assert torch.all(covar_grad==covar_grad)
-	        #light
-	        if torch.any(covar_grad!=covar_grad):
-	            for n, par in model.gp_model.named_parameters():
-	                grad = par.grad.data
-	                if torch.any(grad!=grad):
-	                    # print(f'NaN grad in {n}')
-	                    nans_detected = 1
-	                # nans+=torch.sum(grad!=grad)
-	                if torch.any(grad.abs()==float('inf')):
-	                    logging.warning("Grad inf... fixing...")
-	                    grad = torch.clamp(grad,-1.,1.)
-	                grad[grad!=grad] = 0.0
-	                par.grad.data = grad
+	        torch.where(active, loss, torch.zeros_like(loss)).sum().backward()
+	        # non-finite gradients: zero out the NaNs and clip the gradients that have infs
+	        # (one fused check; on gpu the fix is masked by it, without syncing)
+	        with torch.no_grad():
+	            grads = [par.grad for par in params if par.grad is not None]
+	            bad = ~torch.isfinite(torch.cat([grad.reshape(-1) for grad in grads])).all()
+	            if (not on_cpu) or bad:
+	                _fix_grads(grads, bad, nans, infs)
 	        optimizer.step()
+	        if freeze and not all_active:
+	            with torch.no_grad():
+	                for par, frozen_par in zip(params, frozen):
+	                    par.copy_(torch.where(_pair_mask(active, par), par, frozen_par))
+
+	    # pairs stopped (possibly with a delay): restore their parameters at the stopping step
+	    with torch.no_grad():
+	        for par, frozen_par in zip(params, frozen):
+	            par.copy_(torch.where(_pair_mask(active_host.to(device), par), par, frozen_par))
+
+	    if infs:
+	        logging.warning("Grad inf... fixing...")
+	    return bool(nans)
 
 	t1 = time.time()
 
-	if (len(bvcopulas)!=1) or (bvcopulas[0].name!='Independence'):
-		train(train_x,train_y)
+	nans_detected = False
+	trained = (len(bvcopulas)!=1) or (bvcopulas[0].name!='Independence')
+	if trained:
+		nans_detected = train(train_x,train_y)
 
-	if nans_detected==1:
+	if nans_detected:
 		logging.warning('NaNs were detected in gradients.')
 
+	if natural:
+		# store the model in the standard (Cholesky) parameterization of q(u)
+		model.likelihood.cache_target(None)
+		model = model.cholesky()
+		model.likelihood.cache_target(train_y)
+
+	if (conf.lbfgs_iter > 0) and trained:
+		if minibatch:
+			logging.debug('L-BFGS polishing is skipped for minibatch training')
+		else:
+			_polish(model, train_x, train_y)
+
 	if output_loss is not None:
 		assert isinstance(output_loss, str)
-		plot_loss(output_loss, losses, rbf, means)
+		plot_loss(output_loss, history.get('loss'), history.get('rbf'), history.get('means'))
 
-	if (WAIC < 0): 
+	if torch.any(WAIC < 0): 
 	# if model got to the point where it was better than independence: recalculate final WAIC
-		WAIC = model.likelihood.WAIC(model.gp_model(train_x),train_y)
+		WAIC = torch.where(WAIC < 0, torch.as_tensor(model.likelihood.WAIC(model.gp_model.grid_posterior(train_x),train_y)), WAIC)
+
+	model.likelihood.cache_target(None)
+	validation.inspect()
 
 	t2 = time.time()
-	logging.info(f'WAIC={WAIC:.4f}, took {int(t2-t1)} sec')
+	if num_pairs is None:
+		WAIC = WAIC.item()
+		logging.info(f'WAIC={WAIC:.4f}, took {int(t2-t1)} sec')
+	else:
+		WAIC = WAIC.tolist()
+		logging.info(f'WAICs of {num_pairs} pairs: mean={sum(WAIC)/num_pairs:.4f}, took {int(t2-t1)} sec')
+
+	if cache is not None:
+		cache.put(key, WAIC, model)
 
 	if device!=torch.device('cpu'):
 		with torch.cuda.device(device):
@@ -150,6 +319,162 @@ def infer(bvcopulas, train_x: Tensor, train_y: Tensor, device: torch.device,
 
 	return WAIC, model
 
+class _HostCopy():
+	'''
+	Copies a (small) tensor to the host without blocking,
+	to be read once the copy has completed
+	'''
+	def __init__(self, tensor, step):
+		self.step = step
+		if tensor.device.type == 'cuda':
+			self.host = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+			self.host.copy_(tensor, non_blocking=True)
+			self.event = torch.cuda.Event()
+			self.event.record(torch.cuda.current_stream(tensor.device))
+		else:
+			self.host, self.event = tensor, None
+
+	def ready(self):
+		return (self.event is None) or self.event.query()
+
+	def get(self):
+		if self.event is not None:
+			self.event.synchronize()
+		return self.host
+
+class _History():
+	'''
+	Ring buffer with the training history (the last `size` records),
+	preallocated on the device, so that recording does not sync with the host
+	'''
+	def __init__(self, size):
+		self.size, self.count, self.buffers = size, 0, {}
+
+	def record(self, **values):
+		for name, value in values.items():
+			value = value.detach()
+			if name not in self.buffers:
+				self.buffers[name] = value.new_zeros(self.size, *value.shape)
+			self.buffers[name][self.count % self.size] = value
+		self.count += 1
+
+	def get(self, name):
+		'''
+		Returns the records in chronological order (as a numpy array)
+		'''
+		n = min(self.count, self.size)
+		order = torch.arange(self.count - n, self.count) % self.size
+		return self.buffers[name][order.to(self.buffers[name].device)].cpu().numpy()
+
+def _minibatches(train_x, train_y, size):
+	'''
+	Endless stream of random minibatches of the given size
+	(sampled without replacement within each pass through the data)
+	'''
+	N = train_x.shape[0]
+	while True:
+		perm = torch.randperm(N, device=train_x.device)
+		for j in range(0, N - size + 1, size):
+			idx = perm[j:j+size]
+			yield train_x[idx], train_y[...,idx,:]
+
+def _fix_grads(grads, bad, nans, infs):
+	'''
+	Zeroes out the NaNs and clips the gradients that have infs, where the (device) flag bad is set.
+	Updates the nans and infs flags in place.
+	'''
+	for grad in grads:
+		has_inf = torch.isinf(grad).any()
+		nans |= bad & torch.isnan(grad).any()
+		infs |= bad & has_inf
+		fixed = torch.where(has_inf, grad.clamp(-1.,1.), grad).nan_to_num(nan=0.0)
+		grad.copy_(torch.where(bad, fixed, grad))
+
+def _pair_mask(mask, par):
+	'''
+	Reshapes a [pairs] mask to broadcast over a (batched) parameter
+	'''
+	return mask.view(*mask.shape, *[1]*(par.dim()-mask.dim()))
+
+class _Optimizers():
+	'''
+	Several optimizers (for different parameters), stepped together
+	'''
+	def __init__(self, *optimizers):
+		self.optimizers = optimizers
+
+	@property
+	def param_groups(self):
+		return [group for optimizer in self.optimizers for group in optimizer.param_groups]
+
+	def zero_grad(self):
+		for optimizer in self.optimizers:
+			optimizer.zero_grad()
+
+	def step(self):
+		for optimizer in self.optimizers:
+			optimizer.step()
+
+def _elbo_loss(model, mll, x, y, num_pairs):
+	'''
+	Negative ELBO (per pair for a batched model)
+	'''
+	output = model.gp_model(x)
+	with num_likelihood_samples(30):
+		if num_pairs is None:
+			return -mll(output, y)
+		else:
+			log_likelihood, kl_divergence, _ = mll(output, y)
+			return -(log_likelihood - kl_divergence + _pair_log_prior(mll, num_pairs))
+
+def _polish(model, train_x, train_y):
+	'''
+	Refines the parameters of a trained model with L-BFGS (at most conf.lbfgs_iter iterations).
+	The Monte Carlo estimate of the ELBO is made deterministic by fixing the samples,
+	and the parameters of the pairs which ELBO does not improve are restored.
+	'''
+	num_pairs = model.num_pairs
+	mll = VariationalELBO(model.likelihood, model.gp_model,
+	                        num_data=train_y.size(-2), combine_terms=(num_pairs is None))
+	params = list(model.gp_model.parameters())
+	devices = [] if train_x.device.type=='cpu' else [train_x.device]
+
+	def loss_fn():
+		with torch.random.fork_rng(devices=devices):
+			torch.manual_seed(0)
+			return _elbo_loss(model, mll, train_x, train_y, num_pairs)
+
+	optimizer = torch.optim.LBFGS(params, lr=1., max_iter=conf.lbfgs_iter, line_search_fn='strong_wolfe')
+
+	def closure():
+		optimizer.zero_grad()
+		loss = loss_fn().sum()
+		loss.backward()
+		return loss
+
+	model.gp_model.train()
+	model.likelihood.train()
+	with torch.no_grad():
+		start = [par.detach().clone() for par in params]
+		loss_before = loss_fn()
+	optimizer.step(closure)
+	with torch.no_grad():
+		loss_after = loss_fn()
+		improved = torch.isfinite(loss_after) & (loss_after < loss_before)
+		for par, start_par in zip(params, start):
+			par.copy_(torch.where(_pair_mask(improved, par), par, start_par))
+	logging.debug(f'L-BFGS polishing: loss {loss_before.sum():.4f} -> {torch.where(improved, loss_after, loss_before).sum():.4f}')
+
+def _pair_log_prior(mll, num_pairs):
+	'''
+	Log prior of the hyperparameters of each pair of a batched model
+	(normalized as in VariationalELBO, which sums it over all the pairs)
+	'''
+	log_prior = 0.
+	for name, module, prior, closure, _ in mll.named_priors():
+		log_prior = log_prior + prior.log_prob(closure(module)).reshape(num_pairs, -1).sum(-1).div(mll.num_data)
+	return log_prior
+
 def load_model(filename, bvcopulas, device: torch.device):
 
 	logging.info(f'Loading {get_copula_name_string(bvcopulas)}')
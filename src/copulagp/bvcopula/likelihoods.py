@@ -1,4 +1,7 @@
 import torch
+import math
+import itertools
+import numpy as np
 from torch import Tensor
 from typing import Any
 from gpytorch.likelihoods.likelihood import Likelihood, _OneDimensionalLikelihood
@@ -6,9 +9,40 @@ from gpytorch.distributions import MultivariateNormal, base_distributions
 from gpytorch.settings import num_likelihood_samples
 from torch.distributions.transformed_distribution import TransformedDistribution #for Flow
 
-from .distributions import IndependenceCopula, GaussianCopula, FrankCopula, ClaytonCopula, GumbelCopula, StudentTCopula, MixtureCopula
+from .distributions import IndependenceCopula, GaussianCopula, FrankCopula, ClaytonCopula, GumbelCopula, StudentTCopula, MixtureCopula, \
+    CopulaFeatures
 # from .models import MultitaskGPModel #to check input into input_information
 from . import conf
+from . import validation
+
+def sparse_gauss_hermite(dim: int, level: int):
+    '''
+    Smolyak sparse grid built from Gauss-Hermite rules, for E[g(z)], z ~ N(0, I_dim).
+    Exact for polynomials of total degree up to 2*level-1
+    (for dim=1 it is the Gauss-Hermite rule with 2*level-1 nodes).
+    Returns
+    -------
+    nodes: np.ndarray
+        [num_nodes x dim]
+    weights: np.ndarray
+        [num_nodes] (sum up to 1, some may be negative)
+    '''
+    rules = []
+    for i in range(1, level+1):
+        x, w = np.polynomial.hermite_e.hermegauss(2*i-1)
+        rules.append((x, w/w.sum()))
+    q = dim + level - 1
+    nodes = {}
+    for idx in itertools.product(range(1, level+1), repeat=dim):
+        norm = sum(idx)
+        if norm < max(dim, q-dim+1) or norm > q:
+            continue
+        coef = (-1)**(q-norm) * math.comb(dim-1, q-norm)
+        for point in itertools.product(*[zip(*rules[i-1]) for i in idx]):
+            node = tuple(round(float(x), 12) + 0. for x, _ in point) # merge the shared nodes (incl. -0.)
+            nodes[node] = nodes.get(node, 0.) + coef * math.prod(w for _, w in point)
+    nodes = {node: w for node, w in nodes.items() if abs(w) > 1e-14}
+    return np.array(list(nodes.keys())), np.array(list(nodes.values()))
 
 class Copula_Likelihood_Base(_OneDimensionalLikelihood):
     def __init__(self): 
@@ -142,6 +176,43 @@ class GumbelCopula_Likelihood(Copula_Likelihood_Base):
         else:
             return (theta-1)/(conf.Gumbel_Theta_Max-1)
     
+class WAICStatistics():
+    '''
+    Online per-point statistics of the log likelihoods over GP samples,
+    updated with chunks of [samples x points] log likelihoods.
+    Attributes
+    ----------
+    count : int
+        Number of GP samples seen so far
+    logsumexp : Tensor
+        Log of the sum of likelihoods over the samples
+    var : Tensor
+        Unbiased variance of the log likelihoods over the samples
+    '''
+    def __init__(self):
+        self.count = 0
+        self.logsumexp, self.mean, self.m2 = None, None, None
+
+    def update(self, log_prob: Tensor):
+        n = log_prob.shape[0]
+        chunk_lse = log_prob.logsumexp(dim=0)
+        chunk_mean = log_prob.mean(dim=0)
+        chunk_m2 = ((log_prob - chunk_mean)**2).sum(dim=0)
+        if self.count == 0:
+            self.logsumexp, self.mean, self.m2 = chunk_lse, chunk_mean, chunk_m2
+        else:
+            # merge the chunk into the running statistics (Chan et al. parallel Welford)
+            total = self.count + n
+            delta = chunk_mean - self.mean
+            self.logsumexp = torch.logaddexp(self.logsumexp, chunk_lse)
+            self.mean = self.mean + delta * n / total
+            self.m2 = self.m2 + chunk_m2 + delta**2 * self.count * n / total
+        self.count += n
+
+    @property
+    def var(self):
+        return self.m2 / (self.count - 1)
+
 class MixtureCopula_Likelihood(Likelihood):
     def __init__(self, likelihoods):
         super(Likelihood, self).__init__()
@@ -159,11 +230,72 @@ class MixtureCopula_Likelihood(Likelihood):
         self.num_copulas = len(self.likelihoods)
         self.f_size = 2*self.num_copulas - 1 # first k -- copula params, next k-1 -- mixing coefs
 
+        # constant offsets of the stick-breaking weights: at f=0 all copulas are mixed equally
+        p0 = torch.tensor([(self.num_copulas-j-1)/(self.num_copulas-j) for j in range(self.num_copulas-1)]) # 3/4, 2/3, 1/2
+        self.register_buffer('f0', torch.erfinv(2*p0-1)*math.sqrt(2), persistent=False)
+        # group the likelihoods by type, to apply each link function once
+        groups = {}
+        for i, lik in enumerate(self.likelihoods):
+            groups.setdefault(type(lik), []).append(i)
+        order = [i for idx in groups.values() for i in idx]
+        # contiguous groups are sliced (no copy), and only reordered if needed
+        as_slice = lambda idx: slice(idx[0], idx[-1]+1) if idx == list(range(idx[0], idx[-1]+1)) else idx
+        self._link_groups = [(lik_type, as_slice(idx)) for lik_type, idx in groups.items()]
+        self._link_order = None if order == list(range(self.num_copulas)) else torch.tensor(order).argsort()
+
         # f dimensions are [f_samples dim x GP variables dim]
         # theta dimensions will be [copulas dim x f samples dim], where
         # f samples dim = batch dimension
         # note that f samples dim may be empty    
 
+        self._cached_target, self._cached_features = None, None
+        self._quadrature_rules = {}
+
+    def cache_target(self, target: Tensor):
+        '''
+        Precomputes the transforms of the target (see CopulaFeatures),
+        which are then reused by expected_log_prob and WAIC
+        for as long as they are called with this same target tensor.
+        Call with None to release the cache.
+        '''
+        if target is None:
+            self._cached_target, self._cached_features = None, None
+        else:
+            self._cached_target, self._cached_features = target, CopulaFeatures(target)
+
+    def _target_features(self, target: Tensor):
+        if (self._cached_target is not None) and (target is self._cached_target):
+            return self._cached_features
+        else:
+            return target
+
+    def quadrature_rule(self, device):
+        '''
+        Sparse Gauss-Hermite rule over the f_size latent dimensions (see conf.quadrature_level),
+        as tensors on the device: nodes [num_nodes x f_size] and weights [num_nodes]
+        '''
+        key = (conf.quadrature_level, device)
+        if key not in self._quadrature_rules:
+            nodes, weights = sparse_gauss_hermite(self.f_size, conf.quadrature_level)
+            self._quadrature_rules[key] = (torch.tensor(nodes, dtype=torch.float, device=device),
+                                           torch.tensor(weights, dtype=torch.float, device=device))
+        return self._quadrature_rules[key]
+
+    def expected_log_prob(self, observations: Tensor, function_dist: MultivariateNormal, *args: Any, **kwargs: Any) -> Tensor:
+        if conf.expected_log_prob == 'quadrature':
+            # the expectation for each data point only depends on the marginals of f,
+            # which are independent across the latent dimensions
+            nodes, weights = self.quadrature_rule(function_dist.mean.device)
+            mean, std = function_dist.mean, function_dist.variance.sqrt() # [... x N x f_size]
+            f = mean + std * nodes.view(-1, *[1]*(mean.dim()-1), self.f_size) # [nodes x ... x N x f_size]
+            log_prob = self.forward(f).log_prob(self._target_features(observations))
+            return torch.einsum('q,q...->...', weights, log_prob)
+        elif conf.expected_log_prob == 'mc':
+            likelihood_samples = self._draw_likelihood_samples(function_dist, *args, **kwargs)
+            return likelihood_samples.log_prob(self._target_features(observations)).mean(dim=0)
+        else:
+            raise ValueError(f"expected_log_prob '{conf.expected_log_prob}' not supported")
+
     def serialize(self):
         copula_names=[]
         for lik in self.likelihoods:
@@ -195,27 +327,47 @@ class MixtureCopula_Likelihood(Likelihood):
         else:
             return cls(likelihoods)
 
+    def _waic_chunk_size(self, num_points):
+        '''
+        The number of GP samples processed at once by WAIC_,
+        such that the memory stays within conf.waic_memory_budget.
+        Per GP sample we store f [N x f_size] and about 8 tensors
+        of size [copulas x N] (thetas, mixes and log_prob intermediates), 4 bytes each.
+        '''
+        bytes_per_sample = 4 * num_points * (self.f_size + 8 * self.num_copulas)
+        return max(1, int(conf.waic_memory_budget // bytes_per_sample))
+
     def WAIC_(self, gp_distr: MultivariateNormal, target: Tensor, combine_terms=True):
         '''
             Estimates WAIC (accuracy depends on the number of particles: conf.waic_samples)
+            GP samples are drawn in chunks (see _waic_chunk_size), and the log likelihoods
+            of each data point are aggregated online (logsumexp and Welford variance),
+            so the [samples x N] log likelihood tensor is never stored as a whole.
         Args:
             :attr:`gp_distr` (:class:`gpytorch.distributions.MultivariateNormal`)
-                Trained Gaussian Process distribution
+                Trained Gaussian Process distribution (or a GridPosterior,
+                see MultitaskGPModel.grid_posterior, which samples on the inducing grid)
             :attr:`target` (:class:`torch.Tensor`)
-                Values of :math:`y`.
+                Values of :math:`y`. For a batch of pairs: [pairs x N x 2].
         Returns
-            `WAIC` Widely applicable information criterion
+            `WAIC` Widely applicable information criterion (one per pair for a batch)
         '''
 
         with torch.no_grad():
-            N = target[...,0].numel() #number of data points. The last dimension is (2,) here.
-            samples_shape = torch.Size([conf.waic_samples])
-            f_samples = gp_distr.rsample(samples_shape) # [GP samples x GP variables x input shape]
-            # from GP perspective it is [sample x batch x event] dims
-            log_prob = self.get_copula(f_samples).log_prob(target).detach()
-            pwaic = torch.var(log_prob,dim=0).sum()
+            N = target.shape[-2] #number of data points. The last dimension is (2,) here.
+            features = self._target_features(target)
+            if not isinstance(features, CopulaFeatures):
+                features = CopulaFeatures(target) # shared between the chunks
+            chunk_size = self._waic_chunk_size(target[...,0].numel())
+            stats = WAICStatistics()
+            while stats.count < conf.waic_samples:
+                samples_shape = torch.Size([min(chunk_size, conf.waic_samples - stats.count)])
+                f_samples = gp_distr.rsample(samples_shape) # [GP samples x GP variables x input shape]
+                # from GP perspective it is [sample x batch x event] dims
+                stats.update(self.get_copula(f_samples).log_prob(features).detach())
+            pwaic = stats.var.sum(dim=-1)
             S = torch.ones_like(pwaic)*conf.waic_samples
-            lpd=(log_prob.logsumexp(dim=0)-S.log()).sum() # sum_M log(1/N * sum^i_S p(y|theta_i)), where N is train_x.shape[0]
+            lpd=(stats.logsumexp-S.log().unsqueeze(-1)).sum(dim=-1) # sum_M log(1/N * sum^i_S p(y|theta_i)), where N is train_x.shape[0]
 
         if combine_terms:
             return -(lpd-pwaic)/N #=WAIC
@@ -227,9 +379,10 @@ class MixtureCopula_Likelihood(Likelihood):
             WAIC = 0
             for rep in range(waic_resamples):
                 WAIC += self.WAIC_(gp_distr=gp_distr, target=target, combine_terms=True)/waic_resamples
-            return WAIC.cpu().item()
+            return WAIC.cpu().item() if WAIC.dim()==0 else WAIC.cpu().tolist()
         else:
-            return self.WAIC_(gp_distr=gp_distr, target=target, combine_terms=False).cpu().item()
+            lpd, pwaic = self.WAIC_(gp_distr=gp_distr, target=target, combine_terms=False)
+            return tuple(t.cpu().item() if t.dim()==0 else t.cpu().tolist() for t in (lpd, pwaic))
 
     def get_copula(self, f):
         '''
@@ -250,35 +403,28 @@ class MixtureCopula_Likelihood(Likelihood):
         assert self.f_size==f.shape[-1] # = independent thetas + mixing concentrations - 1 (dependent)
         # we assume that there is 1 GP to parameterise each copula in this class
 
-        thetas, mix = [], []
-        prob_rem = torch.ones_like(f[...,0]) #1-x1, x1(1-x2), x1x2(1-x3)...
-        
-        for i, lik in enumerate(self.likelihoods):
-            theta = lik.gplink_function(f[...,i])
-            if normalized_thetas==True:
-                theta = lik.normalize(theta)
-            thetas.append(theta)
-            prob = torch.ones_like(f[...,0])
-            for j in range(i):
-                p0 = (self.num_copulas-j-1)/(self.num_copulas-j)*torch.ones_like(f[...,0]) # 3/4, 2/3, 1/2
-                f0 = base_distributions.Normal(torch.zeros(1, device=f.device),
-                    torch.ones(1, device=f.device)).icdf(p0) 
-                prob = prob*base_distributions.Normal(torch.zeros(1, device=f.device),
-                    torch.ones(1, device=f.device)).cdf(conf.mix_lr_ratio*f[...,j+self.num_copulas]+f0)
-            if i!=(self.num_copulas-1):
-                p0 = (self.num_copulas-i-1)/(self.num_copulas-i)*torch.ones_like(f[...,0]) # 3/4, 2/3, 1/2
-                f0 = base_distributions.Normal(torch.zeros(1, device=f.device),
-                    torch.ones(1, device=f.device)).icdf(p0) 
-                prob = prob*(1.0-base_distributions.Normal(torch.zeros(1, device=f.device),
-                    torch.ones(1, device=f.device)).cdf(conf.mix_lr_ratio*f[...,i+self.num_copulas]+f0))
-
-            mix.append(prob)
-
-        stack_thetas = torch.stack(thetas)
-        stack_mix = torch.stack(mix)
-
-        assert torch.all(stack_thetas==stack_thetas)
-        assert torch.all(stack_mix==stack_mix)
+        # thetas: the likelihoods of the same type share a link function
+        thetas = [lik_type.gplink_function(f[...,idx]) for lik_type, idx in self._link_groups]
+        thetas = torch.cat(thetas, dim=-1) if len(thetas)>1 else thetas[0]
+        if self._link_order is not None:
+            thetas = thetas[...,self._link_order.to(f.device)]
+        if normalized_thetas==True:
+            thetas = torch.stack([lik.normalize(thetas[...,i]) for i, lik in enumerate(self.likelihoods)], dim=-1)
+        stack_thetas = torch.einsum('...i->i...', thetas)
+
+        # mixing coefficients: stick-breaking with the weights
+        # s_j = Phi(mix_lr_ratio*f_j + f0_j), so that mix_i = s_0 * ... * s_{i-1} * (1 - s_i)
+        # and the last copula takes the remainder: 1-x1, x1(1-x2), x1x2(1-x3)...
+        if self.num_copulas>1:
+            s = 0.5 * (1 + torch.erf((conf.mix_lr_ratio*f[...,self.num_copulas:] + self.f0.to(f.device)) / math.sqrt(2)))
+            ones = torch.ones_like(f[...,:1])
+            mix = torch.cat([ones, torch.cumprod(s, dim=-1)], dim=-1) * torch.cat([1.0 - s, ones], dim=-1)
+            stack_mix = torch.einsum('...i->i...', mix)
+        else:
+            stack_mix = torch.ones_like(stack_thetas)
+
+        validation.check(lambda: stack_thetas==stack_thetas, 'NaN in MixtureCopula_Likelihood.gplink_function')
+        validation.check(lambda: stack_mix==stack_mix, 'NaN in MixtureCopula_Likelihood.gplink_function')
         return stack_thetas, stack_mix
 
     def fit(self, samples, f0 = None, n_epoch=200, lr=0.01):
@@ -290,9 +436,10 @@ class MixtureCopula_Likelihood(Likelihood):
         Parameters:
         ----------
         samples: Tensor
-            The data
+            The data [... x N x 2]: leading dimensions are independent batches
+            (e.g. bins of the conditioning variable), each fitted with its own parameters
         f0: Tensor, optional
-            The starting parameters in f-space (before GPLink)
+            The starting parameters in f-space (before GPLink) [... x 1 x f_size]
         n_epoch: int
             Number of epochs
         lr: float
@@ -304,16 +451,18 @@ class MixtureCopula_Likelihood(Likelihood):
         '''
         device = samples.device
         if f0 is None:
-            f0 = torch.zeros((self.f_size,1),device=device)
+            f0 = torch.zeros((*samples.shape[:-2],1,self.f_size),device=device)
         assert device == f0.device
         f = torch.autograd.Variable(f0, requires_grad = True) 
         optimizer = torch.optim.Adam([f], lr=lr)
         plot_loss = torch.zeros((n_epoch),device=device)
+        shape = (*samples.shape[:-1], self.f_size) # the same parameters for all samples of a batch
         for epoch in range(n_epoch):
-            copula = self(f)
+            optimizer.zero_grad()
+            copula = self(f.expand(shape))
             loss = - copula.log_prob(samples).mean()
             if (loss<torch.min(plot_loss)) or (epoch==0):
-                best_copula = self(f.detach())
+                best_copula = self(f.detach().expand(shape))
             plot_loss[epoch] = loss.data
             loss.backward()
             grad = f.grad.data
@@ -324,7 +473,7 @@ class MixtureCopula_Likelihood(Likelihood):
         return best_copula#, plot_loss
 
     def forward(self, function_samples: Tensor, *params: Any) -> MixtureCopula:
-        assert torch.all(function_samples==function_samples)
+        validation.check(lambda: function_samples==function_samples, 'NaN in MixtureCopula_Likelihood.forward')
         thetas, mix = self.gplink_function(function_samples)
         return self.copula(thetas, 
                              mix, 
@@ -2,14 +2,76 @@ import torch
 import gpytorch
 from torch import all, Size
 from gpytorch.distributions import MultitaskMultivariateNormal
+from gpytorch.utils.interpolation import Interpolation
 import math
+import logging
 from collections import OrderedDict
 from .likelihoods import MixtureCopula_Likelihood
 from . import conf
+from . import validation
 from .infer import infer
 
+class CachedGridInterpolationVariationalStrategy(gpytorch.variational.GridInterpolationVariationalStrategy):
+    '''
+    GridInterpolationVariationalStrategy, which memoizes the interpolation
+    indices and weights for the last input tensor (e.g. train_x, which is
+    the same on every training iteration and in WAIC).
+    The cache is keyed by the memory location, shape and version counter
+    of the input (and of the grid), so it is invalidated when a different
+    input is passed or the input is modified in-place.
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._interp_cache = None
+
+    def _cached(self, inputs):
+        key = (inputs.data_ptr(), inputs.shape, inputs.stride(), inputs.dtype, inputs.device, inputs._version,
+                self.grid.data_ptr(), self.grid._version)
+        if (self._interp_cache is None) or (self._interp_cache[0] != key):
+            # keeps a reference to the inputs, such that their memory is not reused while cached
+            self._interp_cache = (key, inputs, {})
+        return self._interp_cache[2]
+
+    def interpolation(self, inputs):
+        '''
+        Returns interpolation indices and values [N x 4^d] for the inputs [N x d]
+        '''
+        cache = self._cached(inputs)
+        if 'interp' not in cache:
+            cache['interp'] = Interpolation().interpolate(self.grid, inputs.reshape(-1, inputs.size(-1)))
+        return cache['interp']
+
+    def interpolation_matrix(self, inputs):
+        '''
+        Returns a sparse [N x grid_size] matrix W of the interpolation weights,
+        such that f(inputs) = W u, where u are the values on the grid.
+        '''
+        cache = self._cached(inputs)
+        if 'matrix' not in cache:
+            interp_indices, interp_values = self.interpolation(inputs)
+            rows = torch.arange(interp_indices.shape[0], device=inputs.device).unsqueeze(-1).expand_as(interp_indices)
+            cache['matrix'] = torch.sparse_coo_tensor(
+                torch.stack([rows.reshape(-1), interp_indices.reshape(-1)]),
+                interp_values.reshape(-1), size=(interp_indices.shape[0], self.grid.shape[0])).coalesce()
+        return cache['matrix']
+
+    def _compute_grid(self, inputs):
+        n_data = inputs.size(-2)
+        batch_shape = inputs.shape[:-2]
+
+        interp_indices, interp_values = self.interpolation(inputs)
+        interp_indices = interp_indices.view(*batch_shape, n_data, -1)
+        interp_values = interp_values.view(*batch_shape, n_data, -1)
+
+        if (interp_indices.dim() - 2) != len(self._variational_distribution.batch_shape):
+            batch_shape = torch.broadcast_shapes(interp_indices.shape[:-2], self._variational_distribution.batch_shape)
+            interp_indices = interp_indices.expand(*batch_shape, *interp_indices.shape[-2:])
+            interp_values = interp_values.expand(*batch_shape, *interp_values.shape[-2:])
+        return interp_indices, interp_values
+
 class MultitaskGPModel(gpytorch.models.ApproximateGP):
-    def __init__(self, num_dim, grid_bounds=(0, 1), prior_rbf_length=0.5, grid_size=None):
+    def __init__(self, num_dim, grid_bounds=(0, 1), prior_rbf_length=0.5, grid_size=None, num_pairs=None,
+                natural=False):
 
         def _grid_size(num_dim):
             if num_dim<4:
@@ -24,15 +86,27 @@ class MultitaskGPModel(gpytorch.models.ApproximateGP):
             assert type(grid_size) == int
             self.grid_size = grid_size
 
-        variational_distribution = gpytorch.variational.CholeskyVariationalDistribution(
-            num_inducing_points=self.grid_size, batch_shape=torch.Size([num_dim])
-        )
+        # a batch of independent models (one per pair of variables) has a leading pair dimension
+        self.pair_shape = torch.Size([]) if num_pairs is None else torch.Size([num_pairs])
+        batch_shape = self.pair_shape + torch.Size([num_dim])
+
+        # q(u) in the natural parameterization is trained with natural gradient descent (conf.optimizer='ngd'),
+        # and converted to the Cholesky parameterization afterwards (see cholesky_state_dict)
+        if natural:
+            variational_distribution = gpytorch.variational.TrilNaturalVariationalDistribution(
+                num_inducing_points=self.grid_size, batch_shape=batch_shape
+            )
+        else:
+            variational_distribution = gpytorch.variational.CholeskyVariationalDistribution(
+                num_inducing_points=self.grid_size, batch_shape=batch_shape
+            )
 
         # Our base variational strategy is a GridInterpolationVariationalStrategy,
         # which places variational inducing points on a Grid
+        # (and caches the interpolation for the last inputs)
         # We wrap it with a IndependentMultitaskVariationalStrategy so that our output is a vector-valued GP
         variational_strategy = gpytorch.variational.IndependentMultitaskVariationalStrategy(
-            gpytorch.variational.GridInterpolationVariationalStrategy(
+            CachedGridInterpolationVariationalStrategy(
                 self, grid_size=self.grid_size, grid_bounds=[grid_bounds],
                 variational_distribution=variational_distribution,
             ), num_tasks=num_dim,
@@ -48,11 +122,11 @@ class MultitaskGPModel(gpytorch.models.ApproximateGP):
         self.covar_module = gpytorch.kernels.ScaleKernel(
             gpytorch.kernels.RBFKernel(
                 lengthscale_prior=lengthscale_prior,
-                batch_shape=torch.Size([num_dim])
+                batch_shape=batch_shape
             ),
-            batch_shape=torch.Size([num_dim])
+            batch_shape=batch_shape
         )
-        self.mean_module = gpytorch.means.ConstantMean(batch_shape=torch.Size([num_dim]))
+        self.mean_module = gpytorch.means.ConstantMean(batch_shape=batch_shape)
         self.grid_bounds = grid_bounds
 
     def forward(self, x):
@@ -60,19 +134,109 @@ class MultitaskGPModel(gpytorch.models.ApproximateGP):
         # dimension in batch
         mean = self.mean_module(x)  # Returns (num_indep_tasks=batch) x N matrix
         covar = self.covar_module(x) # batch x N x N
-        assert all(mean==mean)
+        validation.check(lambda: mean==mean, 'NaN in MultitaskGPModel.forward')
         return gpytorch.distributions.MultivariateNormal(mean, covar)
 
+    def grid_posterior(self, x):
+        '''
+        Returns the posterior of the latent functions at the inputs x,
+        which samples on the inducing grid and interpolates the samples to x.
+        Same distribution as self(x), but the sampling cost scales with the grid size.
+        '''
+        return GridPosterior(self, x)
+
+    def cholesky_state_dict(self):
+        '''
+        Returns the state_dict with q(u) in the Cholesky parameterization
+        (variational_mean, chol_variational_covar), in which the models are stored,
+        also when q(u) is in the natural parameterization.
+        '''
+        state_dict = self.state_dict()
+        prefix = 'variational_strategy.base_variational_strategy._variational_distribution.'
+        if prefix+'natural_vec' in state_dict:
+            with torch.no_grad():
+                q_u = self.variational_strategy.base_variational_strategy.variational_distribution
+                del state_dict[prefix+'natural_vec'], state_dict[prefix+'natural_tril_mat']
+                state_dict[prefix+'variational_mean'] = q_u.mean.clone()
+                state_dict[prefix+'chol_variational_covar'] = torch.linalg.cholesky(q_u.covariance_matrix)
+        return state_dict
+
+    def load_cholesky_state_dict(self, state_dict):
+        '''
+        Loads a state_dict with q(u) in the Cholesky parameterization
+        (see cholesky_state_dict), also into a model with the natural parameterization.
+        '''
+        prefix = 'variational_strategy.base_variational_strategy._variational_distribution.'
+        if prefix+'natural_vec' in self.state_dict():
+            state_dict = OrderedDict(state_dict)
+            mean = state_dict.pop(prefix+'variational_mean')
+            chol = state_dict.pop(prefix+'chol_variational_covar')
+            eye = torch.eye(chol.shape[-1], dtype=chol.dtype, device=chol.device)
+            state_dict[prefix+'natural_vec'] = torch.cholesky_solve(mean.unsqueeze(-1), chol).squeeze(-1)
+            state_dict[prefix+'natural_tril_mat'] = torch.linalg.solve_triangular(chol, eye, upper=False)
+        self.load_state_dict(state_dict)
+
+class GridPosterior():
+    '''
+    Posterior q(f) at the inputs x of the MultitaskGPModel.
+    In GridInterpolationVariationalStrategy f(x) = W(x) u, where W is
+    a sparse matrix of the (cubic) interpolation weights, and u are the values
+    at the grid points, so the samples of u (grid_size points) are drawn once
+    and mapped to x by a sparse matmul.
+    The interpolation weights are cached by the variational strategy,
+    and reused by all rsample calls.
+    '''
+    def __init__(self, gp_model, x: torch.Tensor):
+        strategy = gp_model.variational_strategy.base_variational_strategy
+        self.variational_distribution = strategy.variational_distribution # [f_size x grid_size]
+        if x.dim() == 1:
+            x = x.unsqueeze(-1)
+        self.weights = strategy.interpolation_matrix(x)
+
+    def _interpolate(self, u):
+        '''
+        Maps [... x f_size x grid_size] values on the grid to [... x N x f_size] values at x
+        '''
+        batch_shape = u.shape[:-1]
+        u = u.reshape(-1, u.shape[-1]).t() # [grid_size x (... f_size)]
+        f = torch.sparse.mm(self.weights, u).t().reshape(*batch_shape, -1)
+        return f.transpose(-1, -2)
+
+    @property
+    def mean(self):
+        return self._interpolate(self.variational_distribution.mean)
+
+    def rsample(self, sample_shape=torch.Size([])):
+        return self._interpolate(self.variational_distribution.rsample(sample_shape))
+
 class Pair_CopulaGP():
-    def __init__(self, copulas: list, device='cpu', grid_size=None, prior_rbf_length=0.5):
+    def __init__(self, copulas: list, device='cpu', grid_size=None, prior_rbf_length=0.5, num_pairs=None,
+                natural=False):
+        '''
+        Parameters
+        ----------
+        copulas: list
+            a list of copula likelihoods in the mixture
+        num_pairs: int (Default = None)
+            If given, the model is a batch of independent models
+            for num_pairs pairs of variables (with the same mixture),
+            which have a leading pair dimension in inputs and outputs.
+            Use split() to get the models of individual pairs.
+        natural: bool (Default = False)
+            If True, q(u) is in the natural parameterization
+            (for natural gradient descent). Use cholesky() to convert
+            the trained model to the standard parameterization.
+        '''
 
         self.__likelihood = MixtureCopula_Likelihood(copulas).to(device=device).float()
 
         self.__gp_model = MultitaskGPModel(self.__likelihood.f_size, 
-            grid_bounds=(0, 1), prior_rbf_length=prior_rbf_length, grid_size=grid_size).to(device=device).float()
+            grid_bounds=(0, 1), prior_rbf_length=prior_rbf_length, grid_size=grid_size,
+            num_pairs=num_pairs, natural=natural).to(device=device).float()
 
         self.__device = device
         self.__particles = 50
+        self.__num_pairs = num_pairs
 
     @property
     def gp_model(self):
@@ -89,6 +253,10 @@ class Pair_CopulaGP():
     @property
     def device(self):
         return self.__device
+
+    @property
+    def num_pairs(self):
+        return self.__num_pairs
     #TODO: mb add setter for device, that relocates all parts of the model?
     #TODO: particle number setter
 
@@ -112,16 +280,123 @@ class Pair_CopulaGP():
         '''
 
         with torch.no_grad():
-            f = self.__gp_model(X).rsample(torch.Size([self.__particles])) #TODO particle num to conf
+            f = self.__gp_model.grid_posterior(X).rsample(torch.Size([self.__particles])) #TODO particle num to conf
         f = torch.einsum('i...->...i', f)
         onehot = torch.rand(f.shape,device=self.__device).argsort(dim = -1) == 0
         f_samples = f[onehot].reshape(f.shape[:-1])
 
         return self.__likelihood.get_copula(f_samples) 
 
+    def cholesky(self):
+        '''
+        Returns the same model with q(u) in the Cholesky parameterization
+        (see the natural parameter)
+        '''
+        model = Pair_CopulaGP(self.__likelihood.likelihoods, device=self.__device,
+                              grid_size=self.__gp_model.grid_size, num_pairs=self.__num_pairs)
+        model.gp_model.load_state_dict(self.__gp_model.cholesky_state_dict())
+        return model
+
+    def warm_start(self, model_data):
+        '''
+        Initializes the model from a related trained model,
+        e.g. the same mixture with an element added, dropped or swapped.
+        The copulas present in both mixtures (same family and rotation)
+        get the trained q(u) and kernel/mean hyperparameters of their GP variables
+        (q(u) is interpolated to this model's grid).
+        The mixing latents are set such that, on the mean of q(u), the matched copulas
+        keep their mixing weights, and each of the new ones gets 1/num_copulas.
+        The rest is initialized from the prior, as usual.
+        Parameters
+        ----------
+        model_data: Pair_CopulaGP_data
+            trained model (not batched)
+        '''
+        assert self.__num_pairs is None, 'Warm start is not supported for batched models'
+        if model_data.weights is None: # Independence
+            return
+        source = model_data.model_init(self.__device)
+        new_names = [[lik.name, lik.rotation] for lik in self.__likelihood.likelihoods]
+        old_names = [[lik.name, lik.rotation] for lik in source.likelihood.likelihoods]
+        matches = [] # (new index, old index)
+        for j, name in enumerate(new_names):
+            if name in old_names:
+                i = old_names.index(name)
+                old_names[i] = None
+                matches.append((j, i))
+
+        strategy = self.__gp_model.variational_strategy.base_variational_strategy
+        source_strategy = source.gp_model.variational_strategy.base_variational_strategy
+        prefix = 'variational_strategy.base_variational_strategy._variational_distribution.'
+        with torch.no_grad():
+            # initialize q(u) from the prior
+            strategy._variational_distribution.initialize_variational_distribution(strategy.prior_distribution)
+            strategy.variational_params_initialized.fill_(1)
+            state_dict = self.__gp_model.cholesky_state_dict()
+            source_state_dict = source.gp_model.state_dict()
+
+            # q(u) of the source on this grid: u = W u_source
+            grid = strategy.grid.clamp(source_strategy.grid.min(), source_strategy.grid.max())
+            W = source_strategy.interpolation_matrix(grid).to_dense()
+            mean = source_state_dict[prefix+'variational_mean'] @ W.t() # [f_size x grid]
+            chol = source_state_dict[prefix+'chol_variational_covar'].tril()
+            covar = W @ (chol @ chol.transpose(-1, -2)) @ W.t()
+            covar = covar + torch.eye(W.shape[0], device=W.device) * conf.warm_start_jitter
+            chol = torch.linalg.cholesky(covar)
+
+            for j, i in matches:
+                state_dict[prefix+'variational_mean'][j] = mean[i]
+                state_dict[prefix+'chol_variational_covar'][j] = chol[i]
+                for name, _ in self.__gp_model.named_hyperparameters():
+                    state_dict[name][j] = source_state_dict[name][i]
+
+            # mixing weights of the source at the grid points
+            if self.__likelihood.num_copulas > 1:
+                _, old_mix = source.likelihood.gplink_function(mean.t()) # [old copulas x grid]
+                mix = torch.full((self.__likelihood.num_copulas, grid.shape[0]),
+                                 1./self.__likelihood.num_copulas, device=mean.device)
+                for j, i in matches:
+                    mix[j] = old_mix[i]
+                mix = mix.clamp(min=conf.warm_start_min_mix)
+                mix = mix / mix.sum(dim=0)
+                # invert the stick-breaking: s_j = 1 - mix_j/(1 - mix_0 - ... - mix_{j-1})
+                rest = 1. - torch.cumsum(mix, dim=0)[:-1] + mix[:-1]
+                s = (1. - mix[:-1]/rest).clamp(conf.warm_start_min_mix, 1.-conf.warm_start_min_mix)
+                f_mix = (torch.erfinv(2*s-1)*math.sqrt(2) - self.__likelihood.f0.to(s.device).unsqueeze(-1)) / conf.mix_lr_ratio
+                state_dict[prefix+'variational_mean'][self.__likelihood.num_copulas:] = f_mix
+
+            self.__gp_model.load_cholesky_state_dict(state_dict)
+        logging.debug(f'Warm start from {model_data.name_string}: {len(matches)} copulas matched')
+
+    def split(self):
+        '''
+        Splits a batched model (see num_pairs)
+        into a list of the models of individual pairs
+        Returns
+        -------
+        models: list
+            list of Pair_CopulaGP models
+        '''
+        assert self.__num_pairs is not None, 'Not a batched model'
+        state_dict = self.__gp_model.cholesky_state_dict()
+        models = []
+        for i in range(self.__num_pairs):
+            model = Pair_CopulaGP(self.__likelihood.likelihoods, device=self.__device,
+                                  grid_size=self.__gp_model.grid_size)
+            pair_state_dict = model.gp_model.state_dict()
+            for k in pair_state_dict:
+                # batched tensors have a leading pair dimension, the rest is shared
+                if state_dict[k].shape == pair_state_dict[k].shape:
+                    pair_state_dict[k] = state_dict[k]
+                else:
+                    pair_state_dict[k] = state_dict[k][i]
+            model.gp_model.load_state_dict(pair_state_dict)
+            models.append(model)
+        return models
+
     def serialize(self):
         bvcopulas = self.__likelihood.serialize()    
-        state_dict = self.__gp_model.state_dict()
+        state_dict = self.__gp_model.cholesky_state_dict()
         cpu_state_dict = OrderedDict({k: state_dict[k].cpu() for k in state_dict})
         return Pair_CopulaGP_data(bvcopulas, cpu_state_dict)
 
@@ -0,0 +1,60 @@
+import torch
+from . import conf
+
+# on-device flags of the failed checks, for 'sampled' validation:
+# {(message, device): bool tensor}
+_failures = {}
+
+def check(condition, message):
+    '''
+    Numerical check (e.g. no NaNs) on a hot path.
+    Behaviour depends on conf.validation:
+        'strict'  - the check is asserted immediately (forces a device sync);
+        'sampled' - the result is accumulated in an on-device flag,
+                    which is later inspected with `inspect`;
+        'off'     - the check is skipped.
+    Parameters
+    ----------
+    condition : callable
+        Returns a boolean tensor, which must be True everywhere.
+        Not evaluated if validation is off.
+    message : str
+        Describes the check (reported when it fails).
+    '''
+    if conf.validation == 'off':
+        return
+    ok = condition()
+    if conf.validation == 'strict':
+        assert torch.all(ok), message
+    elif conf.validation == 'sampled':
+        failed = ~torch.all(ok)
+        key = (message, failed.device)
+        if key in _failures:
+            _failures[key] |= failed
+        else:
+            _failures[key] = failed.clone()
+    else:
+        raise ValueError(f"Validation level '{conf.validation}' not supported")
+
+def inspect():
+    '''
+    Reads the accumulated flags back from the devices (one sync per device),
+    resets them, and raises an AssertionError if any of the checks failed
+    since the last inspection.
+    '''
+    if len(_failures) == 0:
+        return
+    keys = list(_failures.keys())
+    failed = []
+    for device in set(key[1] for key in keys):
+        on_device = [key for key in keys if key[1] == device]
+        flags = torch.stack([_failures[key] for key in on_device]).cpu()
+        failed += [key[0] for key, flag in zip(on_device, flags) if flag]
+    reset()
+    assert len(failed) == 0, 'Failed checks: ' + ', '.join(sorted(set(failed)))
+
+def reset():
+    '''
+    Discards the accumulated flags
+    '''
+    _failures.clear()
@@ -1,4 +1,6 @@
 from .simple_greedy import select_copula_model, available_elements#, add_copula
 from .heuristics import select_with_heuristics, important_copulas#, models_to_try
 from .light import select_light
+from .halving import select_halving
+from .prescreen import clearly_independent
 from .conf import elements
@@ -0,0 +1,157 @@
+import hashlib
+import logging
+import multiprocessing
+import types
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+
+import copulagp.bvcopula as bvcopula
+from copulagp.bvcopula import conf as conf_bvcopula
+from copulagp.utils import get_copula_name_string
+
+from . import conf
+
+# data of the worker processes (see _init_worker)
+_worker_data = None
+
+
+def _init_worker(train_x, train_y, num_threads, bvcopula_conf):
+    global _worker_data
+    torch.set_num_threads(num_threads)
+    # spawned workers re-import the defaults: apply the settings of the parent process
+    for k, v in bvcopula_conf.items():
+        setattr(conf_bvcopula, k, v)
+    _worker_data = (train_x, train_y)
+
+
+def _seed(likelihoods, init_from):
+    # the seed of a candidate, so that it is trained on the same random stream
+    # in a worker and in this process (whatever was sampled before)
+    name = get_copula_name_string(likelihoods)
+    if init_from is not None:
+        name += f" from {init_from.name_string}"
+    return int.from_bytes(hashlib.sha256(name.encode()).digest()[:4], "little")
+
+
+def _infer(likelihoods, train_x, train_y, device, init_from, max_num_iter):
+    devices = [] if torch.device(device).type == "cpu" else [device]
+    with torch.random.fork_rng(devices=devices):
+        torch.manual_seed(_seed(likelihoods, init_from))
+        return bvcopula.infer(
+            likelihoods,
+            train_x,
+            train_y,
+            device=device,
+            init_from=init_from,
+            max_num_iter=max_num_iter,
+        )
+
+
+def _infer_worker(likelihoods, init_from, max_num_iter):
+    train_x, train_y = _worker_data
+    waic, model = _infer(
+        likelihoods, train_x, train_y, torch.device("cpu"), init_from, max_num_iter
+    )
+    return waic, model.serialize()
+
+
+class _Deferred:
+    """
+    Candidate that is trained when its result is requested
+    (so that the sequential evaluation follows the order of the requests)
+    """
+
+    def __init__(self, likelihoods, train_x, train_y, device, init_from, max_num_iter):
+        self.args = (likelihoods, train_x, train_y, device, init_from, max_num_iter)
+        self._result = None
+
+    def result(self):
+        if self._result is None:
+            self._result = _infer(*self.args)
+        return self._result
+
+    def cancel(self):
+        pass
+
+
+class _Remote:
+    """
+    Candidate that is being trained in a worker process
+    """
+
+    def __init__(self, future, likelihoods, device):
+        self.future, self.likelihoods, self.device = future, likelihoods, device
+
+    def result(self):
+        waic, model_data = self.future.result()
+        logging.debug(
+            f"{get_copula_name_string(self.likelihoods)} (WAIC = {waic:.4f}, trained in a worker)"
+        )
+        return waic, model_data.model_init(self.device)
+
+    def cancel(self):
+        self.future.cancel()
+
+
+class Candidates:
+    """
+    Trains candidate mixtures on the same data (bvcopula.infer).
+    With conf.candidate_workers > 1, the submitted candidates are trained
+    concurrently in a pool of worker processes, each using
+    conf.candidate_threads torch threads. Otherwise (or on gpu, or inside
+    a daemonic process, e.g. a vine training worker) a candidate is trained
+    when its result is requested, as a plain infer call.
+    Use as a context manager, to shut the pool down.
+    """
+
+    def __init__(self, train_x, train_y, device):
+        self.train_x, self.train_y, self.device = train_x, train_y, device
+        self.pool = None
+        workers = conf.candidate_workers
+        if workers > 1:
+            if torch.device(device).type != "cpu":
+                logging.debug("Candidates are trained one after another on gpu")
+            elif multiprocessing.current_process().daemon:
+                logging.debug("Candidates are trained one after another in a daemonic process")
+            else:
+                threads = conf.candidate_threads
+                if threads is None:
+                    threads = max(1, torch.get_num_threads() // workers)
+                bvcopula_conf = {
+                    k: v
+                    for k, v in vars(conf_bvcopula).items()
+                    if (not k.startswith("__")) and (not isinstance(v, types.ModuleType))
+                }
+                self.pool = ProcessPoolExecutor(
+                    workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker,
+                    initargs=(train_x.cpu(), train_y.cpu(), threads, bvcopula_conf),
+                )
+
+    def submit(self, likelihoods, init_from=None, max_num_iter=None):
+        """
+        Schedules the training of a candidate mixture
+        (init_from and max_num_iter are passed to bvcopula.infer).
+        Returns an object, which result() is (waic, Pair_CopulaGP),
+        as returned by bvcopula.infer.
+        """
+        if self.pool is None:
+            return _Deferred(
+                likelihoods, self.train_x, self.train_y, self.device, init_from, max_num_iter
+            )
+        else:
+            future = self.pool.submit(_infer_worker, likelihoods, init_from, max_num_iter)
+            return _Remote(future, likelihoods, self.device)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -41,3 +41,58 @@ max_mix = 6
 
 # above this waic data is independent
 waic_threshold = -0.005
+
+# initialize the reduced/extended/swapped candidate mixtures from an already trained related model
+# (see bvcopula.infer, init_from); faster, but the training trajectories, and so the WAICs
+# and possibly the selected mixtures, differ from the ones trained from scratch
+warm_start = False
+
+# the candidate mixtures in select_with_heuristics that do not depend on each other
+# are trained concurrently in this many worker processes (on cpu only; 1 -- one after another),
+# each with candidate_threads torch threads (None -- the available threads are split evenly)
+candidate_workers = 1
+candidate_threads = None
+
+# pre-screening in select_with_heuristics (see prescreen.py): before the GP models are trained,
+# cheap tests on prescreen_bins bins of X rule out the tail corners (rotations) of the Clayton and
+# Gumbel copulas that none of the bins supports, and detect clear dependence
+prescreen = False
+prescreen_bins = 8
+prescreen_q = 0.1 # the size of the tail corners
+prescreen_z = 3. # z-score for Kendall's tau and for the tail asymmetry
+prescreen_tau_samples = 500 # Kendall's tau is O(n^2) in memory: computed on at most this many samples per bin
+prescreen_chi2 = 13.8 # likelihood ratio for an extra mixture element (p=0.001 for 2 parameters)
+prescreen_epochs = 200 # static fits (bvcopula.MixtureCopula_Likelihood.fit)
+prescreen_lr = 0.05
+
+# fast independence test (see prescreen.clearly_independent) in the selectors and in the vine training:
+# a pair is declared independent without training any GP, when the upper confidence bound
+# of the binned mutual information is below -waic_threshold;
+# independence_tolerance is the accepted rate of missed dependencies at that level
+independence_test = False
+independence_bins = 8
+independence_tolerance = 0.05
+independence_resamples = 200 # bootstrap resamples for the confidence bound
+
+# subsample-then-refit (see subsample.py): the mixture is selected on a stratified (over X) subsample
+# of this fraction of the data, then refitted on all the data (None -- select on all the data);
+# for a random subsample_check fraction of the pairs the selection is also repeated on all the data,
+# to log the agreement (subsample.subsample_agreement collects it from the logs; the results do not change)
+subsample = None
+subsample_check = 0.
+
+# select_copula_model (simple greedy) keeps the candidate models in memory and saves only the best one;
+# with greedy_spill=True all the candidates are also written to disk (in a background thread)
+greedy_spill = False
+
+# successive halving (select_halving): all mixtures of up to halving_max_mix elements
+# are trained for halving_iter iterations, then the better half (on held-out data)
+# continues with twice as many iterations, and so on, until one mixture is left
+halving_max_mix = 2
+halving_iter = 100
+halving_holdout = 0.2 # the fraction of the data held out for ranking the mixtures
+
+# with gauss=True, the pairs of a vine tree are trained jointly (as one batched model)
+# in batches of up to this many pairs (e.g. 32); None -- one model per pair
+# (the batched layers are not timed per pair, so they are not used by the cost model)
+gauss_pair_batch = None
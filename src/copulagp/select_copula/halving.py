@@ -0,0 +1,133 @@
+import itertools
+import logging
+
+import torch
+
+import copulagp.bvcopula as bvcopula
+from copulagp.utils import get_copula_name_string
+
+from . import conf
+from .candidates import Candidates
+from .heuristics import set_logger
+from .prescreen import clearly_independent
+from .subsample import select_subsampled
+
+
+def candidate_mixtures(max_mix):
+    """
+    All mixtures of 1 to max_mix different elements of conf.elements
+    (in the order of conf.elements)
+    """
+    mixtures = []
+    for n in range(1, max_mix + 1):
+        mixtures += [list(mixture) for mixture in itertools.combinations(conf.elements, n)]
+    return mixtures
+
+
+def heldout_score(model, x, y):
+    """
+    Negative log pointwise predictive density of the held-out data
+    (per data point; lower is better)
+    """
+    lpd, _ = model.likelihood.WAIC_(
+        model.gp_model.grid_posterior(x), y, combine_terms=False
+    )
+    return -float(lpd)
+
+
+def select_halving(
+    X: torch.Tensor,
+    Y: torch.Tensor,
+    device: torch.device,
+    exp_pref: str,
+    path_output: str,
+    name_x: str,
+    name_y: str,
+    train_x=None,
+    train_y=None,
+):
+    """
+    Successive halving: all candidate mixtures (see candidate_mixtures)
+    are trained for conf.halving_iter iterations, ranked by the predictive
+    density of held-out data, and the better half continues training
+    (from where it stopped) with a doubled budget, until one mixture is left.
+    It is then trained to convergence on all the data.
+    The total compute is bounded by the number of rounds
+    x number of candidates x conf.halving_iter iterations.
+    """
+
+    if exp_pref != "":
+        exp_name = f"{exp_pref}_{name_x}-{name_y}"
+        log_name = f"{path_output}/log_{device}_{exp_name}.txt"
+        set_logger(log_name)
+
+    logging.info(f"Selecting {name_x}-{name_y} on {device}")
+
+    # convert numpy data to tensors (optionally on GPU)
+    if train_x is None:
+        train_x = torch.tensor(X).float().to(device=device)
+    if train_y is None:
+        train_y = torch.tensor(Y).float().to(device=device)
+
+    if clearly_independent(train_x, train_y):
+        logging.info("These variables are independent")
+        best_likelihoods = [bvcopula.IndependenceCopula_Likelihood()]
+        return bvcopula.Pair_CopulaGP(best_likelihoods).serialize(), 0.0
+
+    select = lambda train_x, train_y: _select_halving(train_x, train_y, device)
+    if conf.subsample is not None:
+        return select_subsampled(select, train_x, train_y, device)
+    return select(train_x, train_y)
+
+
+def _select_halving(train_x, train_y, device):
+
+    # the same held-out points every time, so that the selection is reproducible
+    N = train_x.shape[0]
+    perm = torch.randperm(N, generator=torch.Generator().manual_seed(0)).to(
+        train_x.device
+    )
+    num_heldout = int(N * conf.halving_holdout)
+    fit_idx, heldout_idx = perm[num_heldout:], perm[:num_heldout]
+    heldout_x, heldout_y = train_x[heldout_idx], train_y[heldout_idx]
+
+    mixtures = candidate_mixtures(conf.halving_max_mix)
+    models = [None] * len(mixtures)
+    budget = conf.halving_iter
+    with Candidates(train_x[fit_idx], train_y[fit_idx], device) as candidates:
+        while len(mixtures) > 1:
+            trained = [
+                candidates.submit(likelihoods, init_from=model_data, max_num_iter=budget)
+                for likelihoods, model_data in zip(mixtures, models)
+            ]
+            scores = []
+            for i, candidate in enumerate(trained):
+                _, model = candidate.result()
+                with torch.no_grad():
+                    scores.append(heldout_score(model, heldout_x, heldout_y))
+                models[i] = model.serialize()
+            keep = sorted(range(len(mixtures)), key=lambda i: scores[i])
+            keep = keep[: max(1, len(mixtures) // 2)]
+            logging.info(
+                f"{budget} iterations: kept {len(keep)} of {len(mixtures)} mixtures, best "
+                + get_copula_name_string(mixtures[keep[0]])
+                + f" (held-out score = {scores[keep[0]]:.4f})"
+            )
+            mixtures = [mixtures[i] for i in keep]
+            models = [models[i] for i in keep]
+            budget *= 2
+
+    best_likelihoods = mixtures[0]
+    waic, model = bvcopula.infer(
+        best_likelihoods, train_x, train_y, device=device, init_from=models[0]
+    )
+    logging.info(get_copula_name_string(best_likelihoods) + f" (WAIC = {waic:.4f})")
+
+    if waic > conf.waic_threshold:
+        logging.info("These variables are independent")
+        best_likelihoods = [bvcopula.IndependenceCopula_Likelihood()]
+        return bvcopula.Pair_CopulaGP(best_likelihoods).serialize(), waic
+
+    logging.info("Final model: " + get_copula_name_string(best_likelihoods))
+
+    return model.serialize(), waic
@@ -7,7 +7,10 @@ import copulagp.bvcopula as bvcopula
 from copulagp.utils import Plot_Fit, get_copula_name_string
 
 from . import conf
+from .candidates import Candidates
 from .importance import important_copulas, reduce_model
+from .prescreen import clearly_independent, prescreen
+from .subsample import select_subsampled
 
 
 def set_logger(log_name):
@@ -22,6 +25,19 @@ def set_logger(log_name):
     )
 
 
+def _warm_start(model_data):
+    # the trained model to initialize a related mixture from (see conf.warm_start)
+    return model_data if conf.warm_start else None
+
+
+def _important_copulas(model, keep):
+    # important_copulas of a mixture reduced with keep, at the positions of the full mixture
+    which = torch.zeros(len(keep), dtype=bool)
+    if model is not None:
+        which[keep] = important_copulas(model)
+    return which
+
+
 def select_with_heuristics(
     X: torch.Tensor,
     Y: torch.Tensor,
@@ -47,9 +63,49 @@ def select_with_heuristics(
     if train_y is None:
         train_y = torch.tensor(Y).float().to(device=device)
 
+    if clearly_independent(train_x, train_y):
+        logging.info("These variables are independent")
+        best_likelihoods = [bvcopula.IndependenceCopula_Likelihood()]
+        return bvcopula.Pair_CopulaGP(best_likelihoods).serialize(), 0.0
+
+    def select(train_x, train_y):
+        # independent candidate mixtures can be trained concurrently (see conf.candidate_workers)
+        with Candidates(train_x, train_y, device) as candidates:
+            return _select_with_heuristics(train_x, train_y, device, candidates)
+
+    if conf.subsample is not None:
+        return select_subsampled(select, train_x, train_y, device)
+    return select(train_x, train_y)
+
+
+def _select_with_heuristics(train_x, train_y, device, candidates):
+
+    # only the tail corners that pass the cheap tests are included into the mixtures (see conf.prescreen)
+    dependent = False
+    clayton_corners, gumbel_corners = torch.ones(4, dtype=bool), torch.ones(4, dtype=bool)
+    if conf.prescreen:
+        dependent, clayton_corners, gumbel_corners = prescreen(train_x, train_y)
+    clayton_keep = torch.cat([torch.ones(2, dtype=bool), clayton_corners])
+    gumbel_keep = torch.cat([torch.ones(2, dtype=bool), gumbel_corners])
+    clayton_likelihoods = reduce_model(conf.clayton_likelihoods, clayton_keep)
+    gumbel_likelihoods = reduce_model(conf.gumbel_likelihoods, gumbel_keep)
+
+    def submit_mixtures():
+        # a family without plausible corners is not trained (None)
+        gumbels, claytons = None, None
+        if gumbel_corners.any():
+            gumbels = candidates.submit(gumbel_likelihoods)
+        if clayton_corners.any():
+            claytons = candidates.submit(clayton_likelihoods)
+        return gumbels, claytons
+
     best_models = {}
     best_likelihoods = [bvcopula.GaussianCopula_Likelihood()]
-    waic_min, model = bvcopula.infer(best_likelihoods, train_x, train_y, device=device)
+    gaussian = candidates.submit(best_likelihoods)
+    if dependent:
+        # independence is ruled out: the mixtures do not wait for the Gaussian copula
+        mixtures = submit_mixtures()
+    waic_min, model = gaussian.result()
     best_models[get_copula_name_string(best_likelihoods)] = model.serialize()
     logging.info(get_copula_name_string(best_likelihoods) + f" (WAIC = {waic_min:.4f})")
 
@@ -59,41 +115,54 @@ def select_with_heuristics(
         return bvcopula.Pair_CopulaGP(best_likelihoods).serialize(), waic_min
     else:
 
-        (waic_gumbels, model_gumbels) = bvcopula.infer(
-            conf.gumbel_likelihoods, train_x, train_y, device=device
-        )
-        logging.info(
-            get_copula_name_string(conf.gumbel_likelihoods)
-            + f" (WAIC = {waic_gumbels:.4f})"
-        )
-        (waic_claytons, model_claytons) = bvcopula.infer(
-            conf.clayton_likelihoods, train_x, train_y, device=device
-        )
-        logging.info(
-            get_copula_name_string(conf.clayton_likelihoods)
-            + f" (WAIC = {waic_claytons:.4f})"
-        )
+        if not dependent:
+            mixtures = submit_mixtures()
+        gumbels, claytons = mixtures
+        waic_gumbels, model_gumbels = float("inf"), None
+        waic_claytons, model_claytons = float("inf"), None
+        if gumbels is not None:
+            (waic_gumbels, model_gumbels) = gumbels.result()
+            logging.info(
+                get_copula_name_string(gumbel_likelihoods)
+                + f" (WAIC = {waic_gumbels:.4f})"
+            )
+        if claytons is not None:
+            (waic_claytons, model_claytons) = claytons.result()
+            logging.info(
+                get_copula_name_string(clayton_likelihoods)
+                + f" (WAIC = {waic_claytons:.4f})"
+            )
 
         if waic_min >= min(waic_claytons, waic_gumbels):
 
             if waic_claytons < waic_gumbels:
-                which_leader = important_copulas(model_claytons)
-                which_follow = important_copulas(model_gumbels)
+                which_leader = _important_copulas(model_claytons, clayton_keep)
+                which_follow = _important_copulas(model_gumbels, gumbel_keep)
                 likelihoods_leader = conf.clayton_likelihoods[2:]
                 likelihoods_follow = conf.gumbel_likelihoods[2:]
+                leader_corners, follow_corners = clayton_corners, gumbel_corners
                 best_models[get_copula_name_string(best_likelihoods)] = (
                     model_claytons.serialize()
                 )
             else:
-                which_leader = important_copulas(model_gumbels)
-                which_follow = important_copulas(model_claytons)
+                which_leader = _important_copulas(model_gumbels, gumbel_keep)
+                which_follow = _important_copulas(model_claytons, clayton_keep)
                 likelihoods_leader = conf.gumbel_likelihoods[2:]
                 likelihoods_follow = conf.clayton_likelihoods[2:]
+                leader_corners, follow_corners = gumbel_corners, clayton_corners
                 best_models[get_copula_name_string(best_likelihoods)] = (
                     model_gumbels.serialize()
                 )
 
-            if waic_claytons > 10:
+            # the corners ruled out for the leading family can only be taken from the other one
+            for j in range(4):
+                if not leader_corners[j]:
+                    likelihoods_leader[j] = likelihoods_follow[j]
+
+            # the leading mixture, to warm-start its modifications from
+            leader_data = best_models[get_copula_name_string(best_likelihoods)]
+
+            if (model_claytons is not None) and (waic_claytons > 10):
                 print("Strange WAIC!")
 
             symmetric_part = which_leader[:2] + which_follow[:2]  # + = elementwise_or
@@ -106,23 +175,48 @@ def select_with_heuristics(
             logging.info("Symmetric: " + get_copula_name_string(symmetric_likelihoods))
             best_likelihoods = conf.clayton_likelihoods[:2] + likelihoods_leader.copy()
             count_swaps = 0
-            for iter, i in enumerate(torch.arange(4)[assymetric_part]):
-                likelihoods = symmetric_likelihoods.copy()
-                if (count_swaps == 0) and (
-                    iter == torch.sum(assymetric_part).cpu() - 1
-                ):
-                    logging.info(
-                        "No need to swap the last one, as we already tried that model"
-                    )
-                else:
-                    for j in torch.arange(4)[assymetric_part]:
+            swap_idx = torch.arange(4)[assymetric_part]
+
+            def submit_swaps(start):
+                # the swaps from start on, given the current leader;
+                # they are evaluated speculatively, and resubmitted when the leader changes
+                swaps = {}
+                for iter, i in enumerate(swap_idx):
+                    if (iter < start) or (
+                        (count_swaps == 0) and (iter == len(swap_idx) - 1)
+                    ):
+                        continue
+                    if not (leader_corners[i] and follow_corners[i]):
+                        continue
+                    likelihoods = symmetric_likelihoods.copy()
+                    for j in swap_idx:
                         if i != j:
                             likelihoods.append(likelihoods_leader[j])
                         else:
                             likelihoods.append(likelihoods_follow[j])
-                    (waic, model) = bvcopula.infer(
-                        likelihoods, train_x, train_y, device=device
+                    swaps[iter] = (
+                        likelihoods,
+                        candidates.submit(
+                            likelihoods, init_from=_warm_start(leader_data)
+                        ),
                     )
+                return swaps
+
+            swaps = submit_swaps(0)
+            for iter, i in enumerate(swap_idx):
+                if not (leader_corners[i] and follow_corners[i]):
+                    logging.info(
+                        "No need to swap "
+                        + get_copula_name_string([likelihoods_leader[i]])
+                        + ", the other one was ruled out by the pre-screening"
+                    )
+                elif iter not in swaps:
+                    logging.info(
+                        "No need to swap the last one, as we already tried that model"
+                    )
+                else:
+                    likelihoods, swap = swaps[iter]
+                    (waic, model) = swap.result()
                     if waic < waic_min:
                         logging.info(
                             "Swap "
@@ -139,6 +233,12 @@ def select_with_heuristics(
                         best_models[get_copula_name_string(best_likelihoods)] = (
                             model.serialize()
                         )
+                        leader_data = best_models[
+                            get_copula_name_string(best_likelihoods)
+                        ]
+                        for _, swap in swaps.values():
+                            swap.cancel()
+                        swaps = submit_swaps(iter + 1)
 
             # print("Assymetric: "+get_copula_name_string(likelihoods_leader))
 
@@ -146,7 +246,11 @@ def select_with_heuristics(
                 best_likelihoods = reduce_model(best_likelihoods, which_leader)
                 logging.info("Re-running reduced model...")
                 (waic, model) = bvcopula.infer(
-                    best_likelihoods, train_x, train_y, device=device
+                    best_likelihoods,
+                    train_x,
+                    train_y,
+                    device=device,
+                    init_from=_warm_start(leader_data),
                 )
                 logging.info(
                     get_copula_name_string(best_likelihoods) + f" (WAIC = {waic:.4f})"
@@ -157,6 +261,9 @@ def select_with_heuristics(
                 )
             else:
                 logging.info("Nothing to reduce")
+            best_data = best_models.get(
+                get_copula_name_string(best_likelihoods), leader_data
+            )
 
             # If Frank is still selected, check if Gaussian Copula is better than Frank
             if symmetric_part[1] == True:
@@ -166,7 +273,11 @@ def select_with_heuristics(
                         with_gauss[i] = bvcopula.FrankCopula_Likelihood()
                 # print('Trying Gauss: '+get_copula_name_string(with_gauss))
                 (waic, model) = bvcopula.infer(
-                    with_gauss, train_x, train_y, device=device
+                    with_gauss,
+                    train_x,
+                    train_y,
+                    device=device,
+                    init_from=_warm_start(best_data),
                 )
                 if waic < waic_min:
                     logging.info("Frank is better than Gauss")
@@ -180,27 +291,37 @@ def select_with_heuristics(
                 # Gaussian is often confused with Clayton+Gumbel or Gumbel+(180-rotated-Gumbel)
                 # Check that this did not happen.
                 new_best = best_likelihoods  # no need to copy here
+                substitutions = []
                 for i in range(len(best_likelihoods) - 1):
                     for j in range(i, len(best_likelihoods)):
                         if i != j:
-                            logging.info(
-                                f"Trying to substitute 2 elements ({i} and {j}) with a Gauss..."
-                            )
-                            # print(f"Trying to substitute 2 elements ({i} and {j}) with a Gauss...")
                             likelihoods = [bvcopula.GaussianCopula_Likelihood()]
                             for k in range(len(best_likelihoods)):
                                 if (k != i) & (k != j):
                                     likelihoods = likelihoods + [best_likelihoods[k]]
-                            (waic, model) = bvcopula.infer(
-                                likelihoods, train_x, train_y, device=device
+                            substitutions.append(
+                                (
+                                    i,
+                                    j,
+                                    likelihoods,
+                                    candidates.submit(
+                                        likelihoods, init_from=_warm_start(best_data)
+                                    ),
+                                )
                             )
-                            if waic < waic_min:
-                                waic_min = waic
-                                new_best = likelihoods.copy()
-                                # print(get_copula_name_string(new_best)+f" (WAIC = {waic:.4f})")
-                                best_models[
-                                    get_copula_name_string(best_likelihoods)
-                                ] = model.serialize()
+                for i, j, likelihoods, substitution in substitutions:
+                    logging.info(
+                        f"Trying to substitute 2 elements ({i} and {j}) with a Gauss..."
+                    )
+                    # print(f"Trying to substitute 2 elements ({i} and {j}) with a Gauss...")
+                    (waic, model) = substitution.result()
+                    if waic < waic_min:
+                        waic_min = waic
+                        new_best = likelihoods.copy()
+                        # print(get_copula_name_string(new_best)+f" (WAIC = {waic:.4f})")
+                        best_models[
+                            get_copula_name_string(best_likelihoods)
+                        ] = model.serialize()
                 best_likelihoods = new_best.copy()
         else:  # if Gaussian was better than all combinations -> Check Frank
             waic, model = bvcopula.infer(
@@ -215,15 +336,18 @@ def select_with_heuristics(
                 )
 
         # load model
-        model = best_models[get_copula_name_string(best_likelihoods)].model_init(
-            device=device
-        )
+        best_data = best_models[get_copula_name_string(best_likelihoods)]
+        model = best_data.model_init(device=device)
         # final reduce
         which = important_copulas(model)
         if torch.any(which == False):
             best_likelihoods = reduce_model(best_likelihoods, which)
             (waic, model) = bvcopula.infer(
-                best_likelihoods, train_x, train_y, device=device
+                best_likelihoods,
+                train_x,
+                train_y,
+                device=device,
+                init_from=_warm_start(best_data),
             )
             if waic > waic_min:
                 logging.info("Reducing the model, even though the WAIC gets worse.")
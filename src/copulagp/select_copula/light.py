@@ -6,6 +6,8 @@ from copulagp.utils import get_copula_name_string, Plot_Fit
 import os
 
 from .importance import important_copulas, reduce_model
+from .prescreen import clearly_independent
+from .subsample import select_subsampled
    
 def select_light(X: torch.Tensor, Y: torch.Tensor, device: torch.device,
     exp_pref: str, path_output: str, name_x: str, name_y: str,
@@ -25,6 +27,18 @@ def select_light(X: torch.Tensor, Y: torch.Tensor, device: torch.device,
     if train_y is None:
         train_y = torch.tensor(Y).float().to(device=device)
 
+    if clearly_independent(train_x, train_y):
+        logging.info("These variables are independent")
+        best_likelihoods = [bvcopula.IndependenceCopula_Likelihood()]
+        return bvcopula.Pair_CopulaGP(best_likelihoods).serialize(), 0.0
+
+    select = lambda train_x, train_y: _select_light(train_x, train_y, device)
+    if conf.subsample is not None:
+        return select_subsampled(select, train_x, train_y, device)
+    return select(train_x, train_y)
+
+def _select_light(train_x, train_y, device):
+
     def checkNreduce(waic,model,likelihoods,
         scnd_best_waic,scnd_best_model_data,scnd_best_lik):
         which = important_copulas(model)
@@ -32,7 +46,8 @@ def select_light(X: torch.Tensor, Y: torch.Tensor, device: torch.device,
             likelihoods_new = reduce_model(likelihoods,which)
             if get_copula_name_string(likelihoods_new)!=get_copula_name_string(scnd_best_lik):
                 logging.info("Re-running reduced model...")
-                (waic_new, model_new) = bvcopula.infer(likelihoods_new,train_x,train_y,device=device)
+                (waic_new, model_new) = bvcopula.infer(likelihoods_new,train_x,train_y,device=device,
+                                        init_from=model.serialize() if conf.warm_start else None)
                 logging.info(get_copula_name_string(likelihoods_new)+f" (WAIC = {waic:.4f})")
                 return (waic_new,likelihoods_new,model_new.serialize())
             else:
@@ -64,7 +79,8 @@ def select_light(X: torch.Tensor, Y: torch.Tensor, device: torch.device,
                                                waic_min,best_model,[bvcopula.GaussianCopula_Likelihood()])
             #try adding Frank
             with_frank = [bvcopula.FrankCopula_Likelihood()] + best_likelihoods
-            (waic, model) = bvcopula.infer(with_frank,train_x,train_y,device=device)
+            (waic, model) = bvcopula.infer(with_frank,train_x,train_y,device=device,
+                                    init_from=best_model if conf.warm_start else None)
             if waic<waic_min:
                 logging.info('Frank added')
                 waic_min, best_likelihoods, best_model = checkNreduce(waic,model,with_frank,
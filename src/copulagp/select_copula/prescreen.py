@@ -0,0 +1,174 @@
+import logging
+import math
+
+import torch
+
+import copulagp.bvcopula as bvcopula
+from copulagp.bvcopula.distributions import _rotation_flips
+
+from . import conf
+
+# the max number of the resampled scores held in memory at once (clearly_independent)
+max_resampled = 2**24
+
+
+def binned(train_x, train_y, num_bins):
+    """
+    Splits the samples Y into num_bins bins of equal size along X
+    (the remainder of the samples is dropped).
+    Returns a tensor [num_bins x n x 2]
+    """
+    order = torch.argsort(train_x.reshape(train_x.shape[0], -1)[:, 0])
+    n = train_y.shape[0] // num_bins
+    return train_y[order][: n * num_bins].reshape(num_bins, n, 2)
+
+
+def kendall_tau(y):
+    """
+    Kendall's tau of the samples y [... x n x 2] (no ties)
+    """
+    n = y.shape[-2]
+    du = torch.sign(y[..., :, None, 0] - y[..., None, :, 0])
+    dv = torch.sign(y[..., :, None, 1] - y[..., None, :, 1])
+    return (du * dv).sum(dim=(-1, -2)) / (n * (n - 1))
+
+
+def corner_counts(y, q):
+    """
+    Number of the samples y [... x n x 2] in each tail corner (a square of size q)
+    of conf.clayton_likelihoods[2:]. Returns [4 x ...]
+    """
+    counts = []
+    for likelihood in conf.clayton_likelihoods[2:]:
+        fu, fv = _rotation_flips[likelihood.rotation]
+        u = 1 - y[..., 0] if fu else y[..., 0]
+        v = 1 - y[..., 1] if fv else y[..., 1]
+        counts.append(((u < q) & (v < q)).sum(dim=-1))
+    return torch.stack(counts)
+
+
+def normal_scores(y):
+    """
+    Gaussian quantiles of the ranks of the samples y [... x n x 2]
+    """
+    n = y.shape[-2]
+    ranks = torch.argsort(torch.argsort(y, dim=-2), dim=-2).float()
+    return torch.distributions.Normal(0.0, 1.0).icdf((ranks + 1) / (n + 1))
+
+
+def gaussian_information(z):
+    """
+    Mutual information (per sample) of the Gaussian copula fitted to the normal
+    scores z [... x bins x n x 2] and to their squares (dependence of the
+    magnitudes, e.g. a mixture of the opposite rotations), averaged over the bins.
+    Returns the largest of the two, minus its expected value under independence
+    """
+    n = z.shape[-2]
+    information = []
+    for scores in [z, z**2]:
+        scores = scores - scores.mean(dim=-2, keepdim=True)
+        r = (scores[..., 0] * scores[..., 1]).sum(dim=-1) / scores.norm(dim=-2).prod(dim=-1)
+        information.append((-0.5 * torch.log1p(-(r**2))).mean(dim=-1))
+    return torch.maximum(*information) - 1 / (2 * (n - 1))
+
+
+def clearly_independent(train_x, train_y):
+    """
+    Fast independence test (no GP involved), on when conf.independence_test.
+    The mutual information of the Gaussian copulas in conf.independence_bins bins
+    along X is compared to the WAIC threshold of the GP models (-conf.waic_threshold).
+    Returns True if its upper confidence bound (bootstrap, at the level of
+    1 - conf.independence_tolerance) is below the threshold
+    """
+    if not conf.independence_test:
+        return False
+    z = normal_scores(binned(train_x, train_y, conf.independence_bins))
+    num_bins, n = z.shape[:2]
+    information = gaussian_information(z)
+
+    # resampled within each bin (fixed seed, so that the decisions are reproducible),
+    # in chunks of resamples that fit in max_resampled
+    generator = torch.Generator().manual_seed(0)
+    chunk = max(1, max_resampled // z.numel())
+    resampled = []
+    for start in range(0, conf.independence_resamples, chunk):
+        shape = (min(chunk, conf.independence_resamples - start), num_bins, n)
+        idx = torch.randint(n, shape, generator=generator).to(z.device)[..., None].expand(shape + (2,))
+        resampled.append(gaussian_information(torch.gather(z.expand(shape + (2,)), -2, idx)))
+    resampled = torch.cat(resampled)
+    bound = information + torch.quantile(resampled - resampled.mean(), 1 - conf.independence_tolerance)
+
+    logging.info(f"Independence test: information {information:.4f} (upper bound {bound:.4f})")
+    return bool(bound < -conf.waic_threshold)
+
+
+def static_log_likelihood(likelihoods, y):
+    """
+    Mean log likelihood of the samples y [bins x n x 2] under a mixture
+    with constant parameters in each bin (fitted with MixtureCopula_Likelihood.fit)
+    """
+    likelihood = bvcopula.MixtureCopula_Likelihood(likelihoods)
+    copula = likelihood.fit(y, n_epoch=conf.prescreen_epochs, lr=conf.prescreen_lr)
+    with torch.no_grad():
+        return copula.log_prob(y).mean(dim=-1)
+
+
+def prescreen(train_x, train_y):
+    """
+    Cheap tests for the selection of the copula mixture (no GP involved).
+    The data is split in conf.prescreen_bins bins along X, and in each bin:
+    * Kendall's tau (on at most conf.prescreen_tau_samples evenly spaced samples)
+      is compared to its standard deviation under independence;
+    * the number of samples in each tail corner is compared to the opposite corner;
+    * a Gaussian copula and mixtures of a Gaussian copula with a Clayton or
+      a Gumbel copula in each corner are fitted with constant parameters,
+      the gain in the likelihood is compared to conf.prescreen_chi2.
+    Returns
+    -------
+    dependent: bool
+        True if the variables are clearly dependent
+    clayton_corners, gumbel_corners: Tensor
+        Which of conf.clayton_likelihoods[2:] and conf.gumbel_likelihoods[2:]
+        are plausible
+    """
+    y = binned(train_x, train_y, conf.prescreen_bins)
+    n = y.shape[-2]
+
+    y_tau = y[:, :: math.ceil(n / conf.prescreen_tau_samples)]
+    n_tau = y_tau.shape[-2]
+    tau = kendall_tau(y_tau)
+    tau_std = math.sqrt(2 * (2 * n_tau + 5) / (9 * n_tau * (n_tau - 1)))
+    dependent = bool(torch.any(tau.abs() > conf.prescreen_z * tau_std))
+
+    # radial asymmetry: more samples in a tail corner than in the opposite one
+    counts = corner_counts(y, conf.prescreen_q).float()
+    opposite = counts[[2, 3, 0, 1]]
+    asymmetry = (counts - opposite) / torch.sqrt(torch.clamp(counts + opposite, min=1.0))
+    asymmetric = torch.any(asymmetry > conf.prescreen_z, dim=-1).cpu()
+
+    gaussian = static_log_likelihood([bvcopula.GaussianCopula_Likelihood()], y)
+    corners = []
+    for likelihoods in [conf.clayton_likelihoods, conf.gumbel_likelihoods]:
+        gains = torch.stack(
+            [
+                static_log_likelihood([bvcopula.GaussianCopula_Likelihood(), likelihood], y)
+                - gaussian
+                for likelihood in likelihoods[2:]
+            ]
+        )
+        # likelihood ratio test in each bin
+        plausible = torch.any(2 * n * gains > conf.prescreen_chi2, dim=-1).cpu()
+        corners.append(plausible | asymmetric)
+        logging.debug(
+            "Pre-screening gains (per sample): "
+            + ", ".join(
+                f"{likelihood.name}{likelihood.rotation} {gain:.4f}"
+                for likelihood, gain in zip(likelihoods[2:], gains.max(dim=-1).values)
+            )
+        )
+
+    logging.info(
+        f"Pre-screening: max |tau| = {tau.abs().max():.3f} ({tau_std:.3f} if independent), "
+        + f"plausible Clayton corners {corners[0].tolist()}, Gumbel corners {corners[1].tolist()}"
+    )
+    return dependent, corners[0], corners[1]
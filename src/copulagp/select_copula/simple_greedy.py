@@ -5,11 +5,13 @@ from matplotlib import pyplot as plt
 from gpytorch.distributions import MultivariateNormal
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 import copulagp.bvcopula as bvcopula
 import copulagp.utils as utils
 from . import conf
 from .importance import important_copulas, reduce_model
+from .prescreen import clearly_independent
 
 def available_elements(current_model):
 	'''
@@ -28,15 +30,48 @@ def available_elements(current_model):
 	    	av_el.append(el)
 	return av_el
 
+class Spill():
+	'''
+	Writes the weights of the candidate models to {path_output}/w_{name}.pth
+	in a background thread, if conf.greedy_spill (otherwise does nothing).
+	The candidates are kept in memory anyway.
+	'''
+	def __init__(self):
+		self.executor = ThreadPoolExecutor(1) if conf.greedy_spill else None
+		self.futures = []
+
+	def save(self, model_data, weights_filename):
+		if self.executor is not None:
+			# a copy, so that the weights do not change while they are being written
+			weights = {k: v.detach().clone() for k, v in model_data.weights.items()}
+			self.futures.append(self.executor.submit(torch.save, weights, weights_filename))
+
+	def close(self):
+		'''
+		Waits until all the weights are written
+		'''
+		if self.executor is not None:
+			self.executor.shutdown(wait=True)
+			for future in self.futures:
+				if future.exception() is not None:
+					logging.error(f'Failed to save the weights: {future.exception()}')
+			self.executor, self.futures = None, []
+
 def add_copula(X: Tensor, Y: Tensor, train_x: Tensor, train_y: Tensor, device: torch.device,
-	simple_model: list,	exp_name: str, path_output: str, name_x: str, name_y: str):
+	simple_model: list,	exp_name: str, path_output: str, name_x: str, name_y: str, init_from=None, spill=None):
+	'''
+	Tries to add each of the available elements to simple_model.
+	Returns the best mixture, its WAIC and its serialized model (Pair_CopulaGP_data);
+	the other candidates are only kept on disk by the spill (see Spill).
+	If all the candidates failed, the model is None (and WAIC is Inf).
+	'''
 
 	if type(simple_model) != list:
 		simple_model = [simple_model]
 
 	available = available_elements(simple_model)
 	waics = np.ones(len(available)) * (-float("Inf"))
-	files_created = []
+	models = [None] * len(available)
 	for i, el in enumerate(available): #iterate over absolute indexes of available elements
 		likelihoods = [el]+simple_model
 		# make file names
@@ -45,12 +80,13 @@ def add_copula(X: Tensor, Y: Tensor, train_x: Tensor, train_y: Tensor, device: t
 		#################
 		waic = float("Inf")
 		try:
-			waic, model = bvcopula.infer(likelihoods,train_x,train_y,device=device)
-			torch.save(model.gp_model.state_dict(),weights_filename)
-			files_created.append(weights_filename)
+			waic, model = bvcopula.infer(likelihoods,train_x,train_y,device=device,init_from=init_from)
+			models[i] = model.serialize()
+			if spill is not None:
+				spill.save(models[i], weights_filename)
 		except ValueError as error:
 			logging.error(error)
-			logging.error(utils.get_copula_name_string(likelihoods),' failed')
+			logging.error(f'{utils.get_copula_name_string(likelihoods)} failed')
 		finally:
 			waics[i] = waic
 
@@ -61,22 +97,17 @@ def add_copula(X: Tensor, Y: Tensor, train_x: Tensor, train_y: Tensor, device: t
 	best_likelihoods = [best] + simple_model # order here is extrimely important!!!
 	waic = np.min(waics)
 
-	# load the best model to plot
-	name = f'{exp_name}_{utils.get_copula_name_string(best_likelihoods)}'
-	weights_filename = f'{path_output}/w_{name}.pth'
-	model = bvcopula.load_model(weights_filename, best_likelihoods, device)
+	if models[best_i] is None:
+		logging.error('All the candidate mixtures failed')
+		return (best_likelihoods,waic,None)
 
-	# plot the result
+	# plot the best model
+	name = f'{exp_name}_{utils.get_copula_name_string(best_likelihoods)}'
+	model = models[best_i].model_init(device)
 	plot_res = f'{path_output}/res_{name}.png'
 	utils.Plot_Fit(model, X, Y, name_x, name_y, device, filename=plot_res)
 
-	# remove all weights for all models, except for the best one
-	for file in files_created[1:]: # never delete independence
-		if file!=weights_filename:
-			logging.debug(f'Removing {file}')
-			os.remove(file)
-
-	return (best_likelihoods,waic)
+	return (best_likelihoods,waic,models[best_i])
 
 def select_copula_model(X: Tensor, Y: Tensor, device: torch.device,
 	exp_pref: str, path_output: str, name_x: str, name_y: str,
@@ -92,12 +123,30 @@ def select_copula_model(X: Tensor, Y: Tensor, device: torch.device,
 		train_x = torch.tensor(X).float().to(device=device)
 	if train_y is None:
 		train_y = torch.tensor(Y).float().to(device=device)
+
+	if clearly_independent(train_x, train_y):
+		logging.info('The variables are independent (independence test).')
+		return ([bvcopula.IndependenceCopula_Likelihood()],0)
 	
 	mixtures = [[]]
 	waics = [float("inf")]
+	models = {} # serialized models of the best mixtures, by name
+	spill = Spill()
 	num_elements = 0
 	while num_elements < conf.max_mix:
-		(likelihoods, waic) = add_copula(X,Y,train_x,train_y,device,mixtures[-1],exp_name,path_output,name_x,name_y)
+		# warm-start the extended mixtures from the current one
+		init_from = None
+		if conf.warm_start and len(mixtures[-1])>0:
+			init_from = models[utils.get_copula_name_string(mixtures[-1])]
+		(likelihoods, waic, model_data) = add_copula(X,Y,train_x,train_y,device,mixtures[-1],exp_name,path_output,name_x,name_y,
+										init_from=init_from,spill=spill)
+		if model_data is None:
+			# keep the best mixture so far (independence, if none was trained)
+			if len(mixtures) == 1:
+				mixtures.append([bvcopula.IndependenceCopula_Likelihood()])
+				waics.append(0)
+			break
+		models[utils.get_copula_name_string(likelihoods)] = model_data
 		num_elements = len(likelihoods)
 		if (waic > conf.waic_threshold):
 			logging.info(f'The variables are independent (waic less than {conf.waic_threshold:.4f}).')	
@@ -114,19 +163,20 @@ def select_copula_model(X: Tensor, Y: Tensor, device: torch.device,
 	best_ind = np.argmin(waics)
 	logging.info(f"The best model is {utils.get_copula_name_string(mixtures[best_ind])} with WAIC = {waics[best_ind]:.4f}")
 
-	# load the best model to check, if reduction is needed
-	name = f'{exp_name}_{utils.get_copula_name_string(mixtures[best_ind])}'
-	weights_filename = f'{path_output}/w_{name}.pth'
-	model = bvcopula.load_model(weights_filename, mixtures[best_ind], device)
+	# the best model, to check if reduction is needed
+	best_name = utils.get_copula_name_string(mixtures[best_ind])
+	if best_name in models:
+		model = models[best_name].model_init(device)
+	else: # independence
+		model = bvcopula.Pair_CopulaGP(mixtures[best_ind],device=device)
 	#reduce the model
 	important = important_copulas(model)
 	reduced_likelihoods = reduce_model(mixtures[best_ind],important) 
 	if np.any(available_elements(reduced_likelihoods) != available_elements(mixtures[best_ind])):
 		logging.info("Model was reduced, getting new WAIC...")
-		waic, model = bvcopula.infer(reduced_likelihoods,train_x,train_y,device=device)
+		waic, model = bvcopula.infer(reduced_likelihoods,train_x,train_y,device=device,
+									init_from=model.serialize() if conf.warm_start else None)
 		name = f'{exp_name}_{utils.get_copula_name_string(reduced_likelihoods)}'
-		weights_filename = f'{path_output}/w_{name}.pth'
-		torch.save(model.gp_model.state_dict(),weights_filename)
 		print(f"Model reduced to {utils.get_copula_name_string(reduced_likelihoods)}")
 		waics[best_ind] = waic
 		mixtures[best_ind] = reduced_likelihoods
@@ -134,9 +184,10 @@ def select_copula_model(X: Tensor, Y: Tensor, device: torch.device,
 		plot_res = f'{path_output}/res_{name}.png'
 		utils.Plot_Fit(model, X, Y, name_x, name_y, device, filename=plot_res)
 
-	# copy the very best model 
-	# if True: #(utils.get_copula_name_string(mixtures[best_ind])!='Independence'):
-	# 	...
+	# only the very best model is persisted
+	spill.close()
+	name = f'{exp_name}_{utils.get_copula_name_string(mixtures[best_ind])}'
+	torch.save(model.gp_model.cholesky_state_dict(),f'{path_output}/w_{name}.pth')
 
 	print('History:')
 	for mix,waic in zip(mixtures[1:],waics[1:]):
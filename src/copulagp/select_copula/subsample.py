@@ -0,0 +1,97 @@
+import logging
+import random
+import re
+
+import torch
+
+import copulagp.bvcopula as bvcopula
+
+from . import conf
+
+# the log line of a selection checked against the full data (see subsample_agreement)
+_check_line = "Subsample check: agreed={agreed}, subsample: {subsample}, all data: {full}"
+
+
+def stratified_subsample(train_x, fraction, seed=0):
+    """
+    Indices of a subsample of the fraction of the data, stratified over X:
+    the data sorted by X is split into strata of equal size,
+    and one random point is taken from each of them
+    """
+    N = train_x.shape[0]
+    num = max(1, int(N * fraction))
+    order = torch.argsort(train_x.reshape(N, -1)[:, 0]).cpu()
+    bounds = torch.linspace(0, N, num + 1)
+    generator = torch.Generator().manual_seed(seed)
+    position = bounds[:-1] + torch.rand(num, generator=generator) * (bounds[1:] - bounds[:-1])
+    idx = order[torch.clamp(position.long(), max=N - 1)]
+    return torch.sort(idx).values.to(train_x.device)
+
+
+def select_subsampled(select, train_x, train_y, device):
+    """
+    Selects the mixture on a stratified subsample (conf.subsample) of the data,
+    then refits the selected mixture on all the data, warm-started from the subsample model.
+    For a random conf.subsample_check fraction of the calls, the selection is repeated
+    on all the data, and whether it agrees is logged (see subsample_agreement).
+    This check only measures the agreement (at the cost of a full selection):
+    the subsample choice is returned either way.
+    Parameters
+    ----------
+    select: callable
+        select(train_x, train_y) -> (Pair_CopulaGP_data, waic)
+    Returns
+    -------
+    (Pair_CopulaGP_data, waic)
+    """
+    idx = stratified_subsample(train_x, conf.subsample)
+    logging.info(f"Selecting on a subsample of {len(idx)} out of {train_x.shape[0]} points")
+    model_data, waic = select(train_x[idx], train_y[idx])
+
+    if random.random() < conf.subsample_check:
+        logging.info("Checking the selection on all the data...")
+        full_data, _ = select(train_x, train_y)
+        logging.info(
+            _check_line.format(
+                agreed=int(full_data.name_string == model_data.name_string),
+                subsample=model_data.name_string,
+                full=full_data.name_string,
+            )
+        )
+
+    if model_data.name_string == "Independence":
+        return model_data, waic
+
+    likelihoods = bvcopula.MixtureCopula_Likelihood.deserialize(
+        model_data.bvcopulas, just_likelihoods=True
+    )
+    waic, model = bvcopula.infer(
+        likelihoods, train_x, train_y, device=device, init_from=model_data
+    )
+    logging.info(f"Refitted on all the data: {model_data.name_string} (WAIC = {waic:.4f})")
+    if waic > conf.waic_threshold:
+        logging.info("These variables are independent")
+        likelihoods = [bvcopula.IndependenceCopula_Likelihood()]
+        return bvcopula.Pair_CopulaGP(likelihoods).serialize(), waic
+    return model.serialize(), waic
+
+
+def subsample_agreement(log_files):
+    """
+    Agreement of the subsample selections checked on all the data (conf.subsample_check),
+    aggregated over the logs of the selections (e.g. of all the pairs of a vine,
+    selected in different worker processes).
+    Returns
+    -------
+    (agreed, checked)
+    """
+    pattern = re.compile(re.escape(_check_line.split("{")[0]) + r"(\d)")
+    agreed, checked = 0, 0
+    for log_file in log_files:
+        with open(log_file) as f:
+            for line in f:
+                match = pattern.search(line)
+                if match is not None:
+                    agreed += int(match.group(1))
+                    checked += 1
+    return agreed, checked
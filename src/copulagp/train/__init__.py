@@ -1,3 +1,3 @@
-from .checkpoints import save_checkpoint, load_checkpoint, save_final
-from .train_next_tree import train_next_tree
+from .checkpoints import save_checkpoint, load_checkpoint, save_final, PairStore
+from .train_next_tree import train_next_tree, train_trees, WorkerPool, shuffled
 from .train_vine import train_vine, train_small_vine
\ No newline at end of file
@@ -1,6 +1,50 @@
+import os
+import hashlib
+import tempfile
 import pickle as pkl
+import numpy as np
 from copulagp.utils import standard_loader, standard_saver
 
+class PairStore():
+	'''
+	Durable results of the individual pairs, so that an interrupted layer
+	is resumed with only the unfinished pairs.
+	Each result (store, waic, y) is pickled into its own file, written
+	atomically as soon as the pair is trained. The file name contains the
+	layer, the pair and the hash of the inputs of the pair (X, Y0, Y1
+	and the flags), so a result is only reused for the same inputs.
+	'''
+	def __init__(self, path):
+		self.path = path
+		os.makedirs(path, exist_ok=True)
+
+	def key(self, layer, i, X, Y0, Y1, *flags):
+		h = hashlib.sha256()
+		for array in [X, Y0, Y1]:
+			array = np.ascontiguousarray(array)
+			h.update(f'{array.dtype}{array.shape}'.encode())
+			h.update(array.tobytes())
+		h.update(repr(flags).encode())
+		return f'layer{layer}_pair{i}_{h.hexdigest()[:16]}'
+
+	def get(self, key):
+		'''
+		Returns the stored result or None
+		'''
+		try:
+			with open(os.path.join(self.path, f'{key}.pkl'), 'rb') as f:
+				return pkl.load(f)
+		except (FileNotFoundError, EOFError, pkl.UnpicklingError):
+			return None
+
+	def put(self, key, result):
+		fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+		with os.fdopen(fd, 'wb') as f:
+			pkl.dump(result, f)
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(tmp, os.path.join(self.path, f'{key}.pkl'))
+
 def save_checkpoint(X,Y,to_save,path2data,path2models): 
 	standard_saver(path2data,X,Y)
 	with open(path2models,"wb") as f:
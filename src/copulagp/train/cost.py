@@ -0,0 +1,83 @@
+import heapq
+import os
+import numpy as np
+from torch import tensor
+
+from copulagp.select_copula.prescreen import binned, kendall_tau
+
+# features: [1, binned |tau|, log(N/1000), layer];
+# the prior: 10 sec, growing with the dependence and the number of samples
+prior_weights = np.array([np.log(10.), 5., 1., 0.])
+# the weight of the prior (in the number of timings)
+prior_strength = 1.
+# bins of X for Kendall's tau, and the max number of samples per bin
+tau_bins, tau_samples = 8, 500
+
+def pair_features(X, Y0, Y1, layer):
+	'''
+	Features of a pair for the cost model: mean |Kendall's tau| over the bins of X,
+	the number of samples and the layer
+	'''
+	y = binned(tensor(X), tensor(np.stack([Y1,Y0]).T).float(), tau_bins)
+	step = int(np.ceil(y.shape[1]/tau_samples))
+	tau = kendall_tau(y[:,::step]).abs().mean().item()
+	return [tau, len(X), layer]
+
+def format_features(features):
+	return 'features: ' + ' '.join(f'{f:.4f}' if isinstance(f, float) else f'{f}' for f in features)
+
+class CostModel():
+	'''
+	Predicts the training time of a pair from its features (see pair_features).
+	log(time) is a linear function of the features, fitted (ridge regression towards
+	prior_weights) to the timings found in the _model_list.txt logs of the workers.
+	'''
+	def __init__(self):
+		self.timings = {}
+
+	def load(self, filename):
+		'''
+		(Re)reads the timings and the features of the pairs from a _model_list.txt
+		'''
+		timings = []
+		if os.path.exists(filename):
+			with open(filename) as f:
+				for line in f:
+					fields = line.rstrip('\n').split('\t')
+					if (len(fields) >= 4) and fields[3].startswith('features:') and fields[2].endswith(' sec'):
+						features = [float(x) for x in fields[3].split()[1:]]
+						timings.append((features, max(1., float(fields[2].split()[0]))))
+		self.timings[filename] = timings
+
+	@staticmethod
+	def _design(features):
+		features = np.atleast_2d(np.array(features, dtype=float))
+		return np.stack([np.ones(len(features)), features[:,0],
+			np.log(features[:,1]/1000), features[:,2]], axis=-1)
+
+	def weights(self):
+		timings = [t for file in self.timings.values() for t in file]
+		if len(timings) == 0:
+			return prior_weights
+		A = self._design([f for f, _ in timings])
+		b = np.log([t for _, t in timings])
+		reg = prior_strength*np.eye(len(prior_weights))
+		return np.linalg.solve(A.T @ A + reg, A.T @ b + reg @ prior_weights)
+
+	def predict(self, features):
+		'''
+		Predicted training times (sec) of the pairs with these features
+		'''
+		return np.exp(self._design(features) @ self.weights())
+
+	def __len__(self):
+		return sum(len(file) for file in self.timings.values())
+
+def makespan(times, workers):
+	'''
+	Time to train the pairs on this many workers, when submitted longest-first
+	'''
+	finish = [0.]*workers
+	for t in sorted(times, reverse=True):
+		heapq.heappush(finish, heapq.heappop(finish)+t)
+	return max(finish)
@@ -0,0 +1,309 @@
+import os
+import time
+import types
+import _thread
+import uuid
+import shutil
+import socket
+import sqlite3
+import argparse
+import threading
+import traceback
+import pickle as pkl
+import numpy as np
+
+import copulagp.bvcopula as bvcopula
+import copulagp.select_copula as select_copula
+from .train_next_tree import Shared, _init_worker
+
+class JobQueue():
+	'''
+	A job queue in an SQLite database, shared by the processes that submit
+	the jobs and the workers that run them (on this machine or on others
+	sharing the file system). A worker leases a job for lease seconds and
+	extends the lease while it runs; the job of a worker that died is leased
+	again when the lease expires. A failed job is retried, up to max_attempts.
+	'''
+	def __init__(self, path: str, lease=300., max_attempts=3):
+		self.path, self.lease, self.max_attempts = path, lease, max_attempts
+		with self._connect() as db:
+			db.execute('''CREATE TABLE IF NOT EXISTS jobs (
+				id INTEGER PRIMARY KEY AUTOINCREMENT,
+				run TEXT, task BLOB,
+				status TEXT DEFAULT 'pending', -- pending, leased, done, failed
+				attempts INTEGER DEFAULT 0,
+				lease_until REAL, worker TEXT,
+				result BLOB, error TEXT)''')
+			db.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)')
+
+	def _connect(self):
+		db = sqlite3.connect(self.path, timeout=60., isolation_level=None)
+		db.execute('PRAGMA busy_timeout = 60000')
+		return _Transaction(db)
+
+	def submit(self, run: str, task) -> int:
+		'''
+		Adds a job (task is a picklable (function, args, kwargs)), returns its id
+		'''
+		with self._connect() as db:
+			return db.execute('INSERT INTO jobs (run, task) VALUES (?, ?)', (run, pkl.dumps(task))).lastrowid
+
+	def take(self, worker: str):
+		'''
+		Leases a pending job (or a job with an expired lease).
+		Returns (id, task) or None if there are no jobs to run
+		'''
+		now = time.time()
+		with self._connect() as db:
+			# the jobs of dead workers that ran out of attempts
+			db.execute('''UPDATE jobs SET status='failed', error='the lease expired too many times'
+				WHERE status='leased' AND lease_until<? AND attempts>=?''', (now, self.max_attempts))
+			row = db.execute('''SELECT id, task FROM jobs WHERE status='pending'
+				OR (status='leased' AND lease_until<?) ORDER BY id LIMIT 1''', (now,)).fetchone()
+			if row is None:
+				return None
+			db.execute('''UPDATE jobs SET status='leased', worker=?, lease_until=?, attempts=attempts+1
+				WHERE id=?''', (worker, now+self.lease, row[0]))
+		return row[0], pkl.loads(row[1])
+
+	def extend(self, id: int, worker: str) -> bool:
+		'''
+		Extends the lease of a running job. Returns False if the job is not
+		leased by this worker anymore (it was removed, or leased again after
+		the lease expired): its result would be discarded
+		'''
+		with self._connect() as db:
+			return db.execute('''UPDATE jobs SET lease_until=? WHERE id=? AND worker=? AND status='leased' ''',
+				(time.time()+self.lease, id, worker)).rowcount > 0
+
+	def complete(self, id: int, worker: str, result):
+		with self._connect() as db:
+			db.execute('''UPDATE jobs SET status='done', result=? WHERE id=? AND worker=? AND status='leased' ''',
+				(pkl.dumps(result), id, worker))
+
+	def fail(self, id: int, worker: str, error: str):
+		'''
+		Returns the job to the queue, or marks it as failed after max_attempts
+		'''
+		with self._connect() as db:
+			db.execute('''UPDATE jobs SET status=CASE WHEN attempts>=? THEN 'failed' ELSE 'pending' END,
+				error=? WHERE id=? AND worker=? AND status='leased' ''', (self.max_attempts, error, id, worker))
+
+	def finished(self, run: str):
+		'''
+		Returns the finished (done or failed) jobs of a run: [(id, status, result, error)]
+		'''
+		with self._connect() as db:
+			rows = db.execute('''SELECT id, status, result, error FROM jobs
+				WHERE run=? AND status IN ('done','failed')''', (run,)).fetchall()
+		return [(id, status, pkl.loads(result) if result is not None else None, error)
+				for id, status, result, error in rows]
+
+	def remove(self, run: str, ids=None):
+		'''
+		Removes the jobs of a run (all if ids is None)
+		'''
+		with self._connect() as db:
+			if ids is None:
+				db.execute('DELETE FROM jobs WHERE run=?', (run,))
+			else:
+				db.executemany('DELETE FROM jobs WHERE run=? AND id=?', [(run, id) for id in ids])
+
+class _Transaction():
+	'''
+	An SQLite connection as a context manager for an immediate transaction
+	(that locks the database for writing right away, so that two workers
+	cannot lease the same job)
+	'''
+	def __init__(self, db):
+		self.db = db
+	def __enter__(self):
+		self.db.execute('BEGIN IMMEDIATE')
+		return self.db
+	def __exit__(self, exc_type, *args):
+		self.db.execute('ROLLBACK' if exc_type is not None else 'COMMIT')
+		self.db.close()
+
+def _settings(conf):
+	# all the settings, incl. the lists of likelihoods (e.g. select_copula.conf.elements)
+	return {k: v for k, v in vars(conf).items() if (not k.startswith('__'))
+			and (not isinstance(v, types.ModuleType))}
+
+def _apply_settings(conf, settings):
+	for k, v in settings.items():
+		setattr(conf, k, v)
+
+class _JobResult():
+	'''
+	Result of a job (as multiprocessing's AsyncResult)
+	'''
+	def __init__(self, callback, error_callback):
+		self.callback, self.error_callback = callback, error_callback
+		self.event = threading.Event()
+		self.value, self.error = None, None
+
+	def finish(self, value, error):
+		self.value, self.error = value, error
+		if error is None:
+			if self.callback is not None:
+				self.callback(value)
+		elif self.error_callback is not None:
+			self.error_callback(error)
+		self.event.set()
+
+	def get(self):
+		self.event.wait()
+		if self.error is not None:
+			raise self.error
+		return self.value
+
+class QueuePool():
+	'''
+	A replacement of WorkerPool (same interface), that submits the tasks to a JobQueue
+	in the database path, instead of running them in local processes.
+	The tasks are run by any number of workers (see run_worker) started separately.
+	The data are shared through files next to the database.
+	'''
+	def __init__(self, path: str, workers=1, exp='', gauss=False, poll=1.):
+		# the workers can run in other directories (or on other machines)
+		path = os.path.abspath(path)
+		self.queue = JobQueue(path)
+		self.workers = workers # expected number of the workers (for the ETA)
+		self.run = uuid.uuid4().hex
+		self.prefix = exp+'_g' if gauss else exp
+		self.dir = f'{os.path.splitext(path)[0]}_data/{self.run}'
+		os.makedirs(self.dir)
+		self.count = 0
+		self.jobs = {}
+		self.lock = threading.Lock()
+		self.poll = poll
+		self.stopped = threading.Event()
+		self.thread = threading.Thread(target=self._collect, daemon=True)
+		self.thread.start()
+
+	def share(self, array: np.ndarray) -> Shared:
+		path = os.path.join(self.dir, f'{self.count}.npy')
+		self.count += 1
+		np.save(path, array)
+		return Shared(path)
+
+	def unshare(self, *shared):
+		for s in shared:
+			if os.path.exists(s.path):
+				os.remove(s.path)
+
+	def apply_async(self, func, args=(), kwds={}, callback=None, error_callback=None):
+		# the settings of this process are applied in the worker
+		task = (func, args, kwds, self.prefix,
+				_settings(bvcopula.conf), _settings(select_copula.conf))
+		result = _JobResult(callback, error_callback)
+		with self.lock:
+			self.jobs[self.queue.submit(self.run, task)] = result
+		return result
+
+	def _collect(self):
+		# passes the results of the finished jobs to the waiting ones
+		while not self.stopped.wait(self.poll):
+			with self.lock:
+				if len(self.jobs) == 0:
+					continue
+			finished = self.queue.finished(self.run)
+			for id, status, value, error in finished:
+				with self.lock:
+					result = self.jobs.pop(id, None)
+				if result is not None:
+					result.finish(value, None if status=='done' else RuntimeError(f'Job {id} failed: {error}'))
+			self.queue.remove(self.run, [id for id, *_ in finished])
+
+	def close(self, terminate=False):
+		'''
+		Waits for the submitted jobs (as Pool.close), or cancels them if terminate:
+		the removed jobs are not taken anymore, and the workers running them
+		stop them at the next extension of the lease
+		'''
+		while not terminate:
+			with self.lock:
+				if len(self.jobs) == 0:
+					break
+			time.sleep(self.poll)
+		self.stopped.set()
+		self.thread.join()
+		self.queue.remove(self.run)
+		shutil.rmtree(self.dir, ignore_errors=True)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, *args):
+		self.close(terminate=exc_type is not None)
+
+def run_worker(path: str, device='cpu', idle_exit=None, poll=1., lease=300.):
+	'''
+	Runs the jobs from the JobQueue in the database path on this device,
+	until no job was found for idle_exit seconds (None: forever).
+	The jobs are leased for lease seconds, and the lease is extended
+	every lease/3 seconds while the job runs. A job that was cancelled
+	(see QueuePool.close) is interrupted then, if the worker runs in the main thread.
+	The settings of a job are restored after it.
+	'''
+	queue = JobQueue(path, lease=lease)
+	name = f'{socket.gethostname()}:{os.getpid()}'
+	idle_since = time.time()
+	while (idle_exit is None) or (time.time()-idle_since < idle_exit):
+		job = queue.take(name)
+		if job is None:
+			time.sleep(poll)
+			continue
+		id, (func, args, kwds, prefix, bvcopula_settings, select_settings) = job
+		saved = _settings(bvcopula.conf), _settings(select_copula.conf)
+
+		# keep the lease while the job runs
+		finished, lost, lock = threading.Event(), threading.Event(), threading.Lock()
+		interrupt = threading.current_thread() is threading.main_thread()
+		def heartbeat():
+			while not finished.wait(queue.lease/3):
+				if not queue.extend(id, name):
+					with lock:
+						if not finished.is_set():
+							lost.set()
+							if interrupt:
+								_thread.interrupt_main()
+					return
+		thread = threading.Thread(target=heartbeat, daemon=True)
+		thread.start()
+		try:
+			_init_worker([device], prefix)
+			_apply_settings(bvcopula.conf, bvcopula_settings)
+			_apply_settings(select_copula.conf, select_settings)
+			try:
+				result = func(*args, **kwds)
+			finally:
+				with lock:
+					finished.set()
+			if lost.is_set():
+				print(f'Job {id} was cancelled, its result is discarded')
+			elif isinstance(result, int) and (result == -1): # the workers return -1 on errors
+				queue.fail(id, name, 'the worker returned -1')
+			else:
+				queue.complete(id, name, result)
+		except KeyboardInterrupt:
+			if not lost.is_set():
+				raise
+			print(f'Job {id} was cancelled')
+		except Exception:
+			queue.fail(id, name, traceback.format_exc())
+		finally:
+			finished.set()
+			thread.join()
+			_apply_settings(bvcopula.conf, saved[0])
+			_apply_settings(select_copula.conf, saved[1])
+		idle_since = time.time()
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Run the pair fits from a job queue')
+	parser.add_argument('path', help='Job queue database (see train_vine, queue)')
+	parser.add_argument('-device', default='cpu', help='Device to train on (cpu or cuda:N)')
+	parser.add_argument('-idle', default=None, type=float, help='Exit after this many seconds without jobs')
+	parser.add_argument('-lease', default=300., type=float, help='Lease time of a job (sec), before it is retried')
+	args = parser.parse_args()
+	run_worker(args.path, args.device, args.idle, lease=args.lease)
@@ -3,17 +3,111 @@ import pickle as pkl
 import numpy as np
 import multiprocessing
 import os
-from torch import device, tensor, load, no_grad
+import queue
+import shutil
+import tempfile
+from torch import device, tensor, load, no_grad, randperm, Generator
 
 import copulagp.select_copula as select_copula
 import copulagp.bvcopula as bvcopula
 from copulagp.select_copula import conf as conf_select
+from .cost import CostModel, pair_features, format_features, makespan
 
-def worker(X, Y0, Y1, idxs, layer, gauss=False, light=False, shuffle=False):
+def worker_device():
 	# get unique gpu id for cpu id
 	cpu_name = multiprocessing.current_process().name
+	if '-' not in cpu_name: # not a pool worker (e.g. a job queue worker, see jobqueue.py)
+		return device_list[0]
 	cpu_id = (int(cpu_name[cpu_name.find('-') + 1:]) - 1)%len(device_list) # ids will be 8 consequent numbers
-	device_str = device_list[cpu_id]
+	return device_list[cpu_id]
+
+class Shared():
+	'''
+	A reference to an array (or its column) shared with the workers
+	through a memory-mapped file (see WorkerPool.share)
+	'''
+	def __init__(self, path, column=None):
+		self.path, self.index = path, column
+
+	def column(self, i):
+		return Shared(self.path, i)
+
+	def get(self):
+		array = np.load(self.path, mmap_mode='r')
+		if self.index is not None:
+			array = array[:,self.index]
+		return np.array(array)
+
+def shuffled(X, layer: int):
+	'''
+	Returns X shuffled for the tree layer. The permutation is seeded by the layer,
+	so that a resumed run gets the same inputs (and finds its pairs in PairStore)
+	'''
+	return X[randperm(X.shape[0], generator=Generator().manual_seed(layer))]
+
+def fetch(array):
+	'''
+	Returns the array that a task argument refers to
+	'''
+	return array.get() if isinstance(array, Shared) else array
+
+def _init_worker(devices, prefix):
+	global device_list, exp_pref
+	device_list, exp_pref = devices, prefix
+
+class WorkerPool():
+	'''
+	A pool of worker processes, that can be kept for several vine trees (see train_vine).
+	The devices and the experiment prefix are passed to each worker once, when it starts.
+	The data are shared through memory-mapped files (see share),
+	so that the tasks only carry the references to them.
+	'''
+	def __init__(self, devices: list, exp='', gauss=False):
+		for dev in devices:
+			assert (dev=='cpu') or (dev[:-2]=='cuda')
+		prefix = exp+'_g' if gauss else exp
+		self.dir = tempfile.mkdtemp(prefix='copulagp_')
+		self.count = 0
+		self.workers = len(devices)
+		self.pool = multiprocessing.Pool(self.workers, initializer=_init_worker, initargs=(devices, prefix))
+
+	def share(self, array: np.ndarray) -> Shared:
+		'''
+		Saves the array for the workers, returns a reference to it
+		'''
+		path = os.path.join(self.dir, f'{self.count}.npy')
+		self.count += 1
+		np.save(path, array)
+		return Shared(path)
+
+	def unshare(self, *shared):
+		'''
+		Removes the arrays that are no longer needed
+		'''
+		for s in shared:
+			if os.path.exists(s.path):
+				os.remove(s.path)
+
+	def apply_async(self, *args, **kwargs):
+		return self.pool.apply_async(*args, **kwargs)
+
+	def close(self, terminate=False):
+		if terminate:
+			self.pool.terminate()
+		else:
+			self.pool.close()
+		self.pool.join()
+		shutil.rmtree(self.dir, ignore_errors=True)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, *args):
+		self.close(terminate=exc_type is not None)
+
+def worker(X, Y0, Y1, idxs, layer, gauss=False, light=False, shuffle=False, log_dir=None, features=None):
+	device_str = worker_device()
+	X, Y0, Y1 = fetch(X), fetch(Y0), fetch(Y1)
 
 	Y = np.stack([Y1,Y0]).T # order!
 	n0, n1, n_out = idxs[0] + layer, idxs[1]+layer, idxs[1]-1 # substitute this to get other (not C) vines
@@ -25,12 +119,16 @@ def worker(X, Y0, Y1, idxs, layer, gauss=False, light=False, shuffle=False):
 	try:
 		t_start = time.time()
 		if gauss:
-			gauss = [bvcopula.GaussianCopula_Likelihood()]
-			waic, model = bvcopula.infer(gauss,train_x,train_y,device=device(device_str)) 
-			if waic>conf_select.waic_threshold:
+			if select_copula.clearly_independent(train_x,train_y): # no need to train a GP
+				waic = 0.
 				store = bvcopula.Pair_CopulaGP_data([['Independence',None]], None)
 			else:
-				store = model.cpu().serialize()
+				gauss = [bvcopula.GaussianCopula_Likelihood()]
+				waic, model = bvcopula.infer(gauss,train_x,train_y,device=device(device_str)) 
+				if waic>conf_select.waic_threshold:
+					store = bvcopula.Pair_CopulaGP_data([['Independence',None]], None)
+				else:
+					store = model.cpu().serialize()
 		else:
 			if light:
 				(store, waic) = select_copula.select_light(X,Y,device(device_str),exp_pref,log_dir,n0,n1,train_x=train_x,train_y=train_y)
@@ -46,10 +144,11 @@ def worker(X, Y0, Y1, idxs, layer, gauss=False, light=False, shuffle=False):
 		return -1
 	finally:
 		print(f"{n0}-{n1} {store.name_string} {waic:.4} took {int((t_end-t_start)/60)} min")
-		# save textual info into model list
+		# save textual info into model list (with the features for the cost model)
 		if log_dir!=None:
 			with open(log_dir+'_model_list.txt','a') as f:
-				f.write(f"{n0}-{n1} {store.name_string}\t{waic:.4f}\t{int(t_end-t_start)} sec\n")
+				f.write(f"{n0}-{n1} {store.name_string}\t{waic:.4f}\t{int(t_end-t_start)} sec"
+					+ (f"\t{format_features(features)}" if features is not None else '') + "\n")
 
 		if store.name_string!='Independence':
 			model.gp_model.eval()
@@ -60,9 +159,81 @@ def worker(X, Y0, Y1, idxs, layer, gauss=False, light=False, shuffle=False):
 
 		return (store, waic, y)
 
+def gauss_batch_worker(X, Y0, Y1s, idxs_list, layer, log_dir=None):
+	'''
+	Same as worker with gauss=True, but trains the Gaussian copula models
+	for several pairs jointly, as one batched Pair_CopulaGP.
+	Returns a list of worker's results (one per pair).
+	'''
+	device_str = worker_device()
+	X, Y0, Y1s = fetch(X), fetch(Y0), [fetch(Y1) for Y1 in Y1s]
+
+	train_x = tensor(X).float().to(device=device(device_str))
+	train_y = tensor(np.stack([np.stack([Y1,Y0]).T for Y1 in Y1s])).float().to(device=device(device_str)) # order!
+
+	t_start = time.time()
+	# the clearly independent pairs are not trained
+	independent = [select_copula.clearly_independent(train_x,pair_y) for pair_y in train_y]
+	dependent = [i for i, ind in enumerate(independent) if not ind]
+	waics, models = [0.]*len(Y1s), [None]*len(Y1s)
+	if len(dependent)>0:
+		try:
+			gauss = [bvcopula.GaussianCopula_Likelihood()]
+			batch_waics, batched_model = bvcopula.infer(gauss,train_x,train_y[dependent],device=device(device_str))
+		except RuntimeError as error:
+			print(error)
+			return [-1]*len(Y1s)
+		for i, waic, model in zip(dependent, batch_waics, batched_model.split()):
+			waics[i], models[i] = waic, model
+	t_end = time.time()
+
+	results = []
+	for idxs, Y1, pair_y, waic, model in zip(idxs_list, Y1s, train_y, waics, models):
+		n0, n1 = idxs[0] + layer, idxs[1]+layer
+		if (model is None) or (waic>conf_select.waic_threshold):
+			store = bvcopula.Pair_CopulaGP_data([['Independence',None]], None)
+			y = Y1
+		else:
+			store = model.cpu().serialize()
+			model.gp_model.eval()
+			copula = model.marginalize(train_x) # marginalize the GP
+			y = copula.ccdf(pair_y).cpu().numpy()
+		print(f"{n0}-{n1} {store.name_string} {waic:.4} took {int((t_end-t_start)/60)} min (batch of {len(Y1s)})")
+		if log_dir!=None:
+			with open(log_dir+'_model_list.txt','a') as f:
+				f.write(f"{n0}-{n1} {store.name_string}\t{waic:.4f}\t{int(t_end-t_start)} sec\n")
+		results.append((store, waic, y))
+	return results
+
+def make_log_dir(exp, path_logs, layer):
+	'''
+	Creates the log directory of a layer (None if no logs)
+	'''
+	if exp=='':
+		return None
+	log_dir = path_logs(exp_pref, layer)
+	if(log_dir is not None):
+		try:
+			os.makedirs(log_dir)
+		except FileExistsError as error:
+			print(f"Error:{error}")
+	return log_dir
+
+def cost_model(exp, path_logs, layers):
+	'''
+	The cost model, with the timings from the model lists of these layers
+	'''
+	cost = CostModel()
+	if exp!='':
+		for layer in layers:
+			log_dir = path_logs(exp_pref, layer)
+			if log_dir is not None:
+				cost.load(log_dir+'_model_list.txt')
+	return cost
+
 def train_next_tree(X: np.ndarray, Y: np.ndarray, 
 		    layer: int, devices: list, gauss=False, light=False, shuffle=False, path_logs=lambda x,y: None,
-	exp = ''):
+	exp = '', pool=None, pair_store=None):
 	'''
 	Trains one vine copula tree
 
@@ -84,48 +255,88 @@ def train_next_tree(X: np.ndarray, Y: np.ndarray,
 	gauss : bool (Default = False)
 		A flag that turns off model selection
 		and only trains gaussian copula models
+	pool : WorkerPool (Default = None)
+		The worker pool to use (created with the same
+		devices, exp and gauss). If None: a new pool
+		is created for this tree.
+	pair_store : PairStore (Default = None)
+		Where the result of each pair is saved as soon as
+		it is trained. The pairs found there are not trained again.
 
 	Returns
 	-------
 	to_save : dict
 		Dictionary with keys={'models','waics'}
 	'''
-	for dev in devices:
-		assert (dev=='cpu') or (dev[:-2]=='cuda')
-
-	global exp_pref, log_dir
+	global exp_pref
 	exp_pref = exp
 	if gauss:
 		exp_pref += '_g'
 
-	global device_list
-	device_list = devices
-
-	if exp!='':
-		log_dir = path_logs(exp_pref, layer)
-		if(log_dir is not None):
-			try:
-				os.makedirs(log_dir)
-			except FileExistsError as error:
-				print(f"Error:{error}")
-	else:
-		log_dir = None
+	log_dir = make_log_dir(exp, path_logs, layer)
 
 	NN = Y.shape[-1]-1
 
-	results = np.empty(NN,dtype=object)
-	pool = multiprocessing.Pool(len(device_list))
+	# the pairs that are already trained
+	keys, finished = {}, {}
+	if pair_store is not None:
+		for i in range(1,NN+1):
+			keys[i] = pair_store.key(layer, i, X, Y[:,0], Y[:,i], gauss, light)
+			result = pair_store.get(keys[i])
+			if result is not None:
+				finished[i] = result
+		if len(finished) > 0:
+			print(f"Layer {layer}: {len(finished)} of {NN} pairs are already trained")
+	todo = [i for i in range(1,NN+1) if i not in finished]
 
-	for i in np.arange(1,NN+1): 
-		results[i-1] = pool.apply_async(worker, (X, Y[:,0], Y[:,i], [0,i],  layer, gauss, light, shuffle))
+	def save(pairs):
+		# saves the results as soon as the pairs are trained
+		def callback(results):
+			if pair_store is not None:
+				for i, result in zip(pairs, results):
+					if isinstance(result, tuple): # not failed
+						pair_store.put(keys[i], result)
+		return callback
 
-	pool.close()
-	pool.join()  # block at this line until all processes are done
-	print(f"Layer {layer} completed")
+	batched = gauss and (conf_select.gauss_pair_batch or 1) > 1
+	own_pool = pool is None
+	if own_pool:
+		pool = WorkerPool(devices, exp, gauss)
+
+	try:
+		shared_X, shared_Y = pool.share(X), pool.share(Y)
+		if batched:
+			batches = [todo[j:j+conf_select.gauss_pair_batch] for j in range(0,len(todo),conf_select.gauss_pair_batch)]
+			tasks = [(batch, pool.apply_async(gauss_batch_worker, (shared_X, shared_Y.column(0), [shared_Y.column(i) for i in batch],
+						[[0,i] for i in batch], layer, log_dir), callback=save(batch)))
+						for batch in batches]
+		else:
+			# the longest pairs first (as predicted from the previous timings, see cost.py)
+			cost = cost_model(exp, path_logs, range(layer+1))
+			features = [pair_features(X, Y[:,0], Y[:,i], layer) for i in todo]
+			times = cost.predict(features) if len(todo) > 0 else np.zeros(0)
+			print(f"Layer {layer}: predicted {makespan(times, pool.workers)/60:.1f} min for {len(todo)} pairs "
+				+ f"(cost model from {len(cost)} timings)")
+			tasks = []
+			for j in np.argsort(-times): 
+				i = todo[j]
+				tasks.append(([i], pool.apply_async(worker, (shared_X, shared_Y.column(0), shared_Y.column(i), [0,i],  layer, gauss, light, shuffle, log_dir),
+											{'features': features[j]}, callback=lambda result, s=save([i]): s([result]))))
+
+		# block until all the pairs are done
+		for pairs, task in tasks:
+			for i, result in zip(pairs, task.get() if batched else [task.get()]):
+				finished[i] = result
+		results = [finished[i] for i in range(1,NN+1)]
+		print(f"Layer {layer} completed")
+		pool.unshare(shared_X, shared_Y)
+	finally:
+		if own_pool:
+			pool.close()
 
 	models, waics, Y_next = [], [], []
 	for result in results:
-		m, w, y = result.get()
+		m, w, y = result
 		models.append(m)
 		waics.append(w)
 		Y_next.append(y)
@@ -133,3 +344,174 @@ def train_next_tree(X: np.ndarray, Y: np.ndarray,
 	Y_next = np.array(Y_next).T
 
 	return models, waics, Y_next
+
+def train_trees(X: np.ndarray, Y: np.ndarray, start: int, layers: int,
+		devices: list, gauss=False, light=False, shuffle=False, path_logs=lambda x,y: None,
+		exp = '', on_layer=None, pool=None, pair_store=None):
+	'''
+	Trains the vine copula trees from start to layers-1 without barriers between the trees.
+	In a C-vine, the pair (0,i) of the tree k+1 only needs the outputs (ccdf)
+	of the pairs (0,1) and (0,i+1) of the tree k, so it is submitted to the pool
+	as soon as they are ready, while the rest of the tree k is still being trained.
+
+	Parameters
+	----------
+	X : np.ndarray
+		Conditioning variable
+	Y : np.ndarray
+		Collection of data variables (inputs to the tree start)
+	start : int
+		The first tree to train
+	layers : int
+		The number of trees (the last one is layers-1)
+	devices : List[str]
+		A list of devices to be used for
+		training (in parallel)
+	gauss, light, shuffle, path_logs, exp :
+		Same as in train_next_tree
+		(with shuffle, X is shuffled before each tree, see shuffled)
+	on_layer : Callable (Default = None)
+		Called with (layer, X, models, waics, Y_next) when a tree is completed
+		(the trees complete in order)
+	pool : WorkerPool (Default = None)
+		The worker pool to use (see train_next_tree)
+	pair_store : PairStore (Default = None)
+		Where the result of each pair is saved (see train_next_tree)
+
+	Returns
+	-------
+	models, waics : list
+		The models and WAICs of each tree
+	Y_next : np.ndarray
+		The outputs of the last tree (Y, if there are no trees to train)
+	'''
+	global exp_pref
+	exp_pref = exp
+	if gauss:
+		exp_pref += '_g'
+
+	Y_next = Y
+	if layers <= start:
+		return [], [], Y_next
+
+	own_pool = pool is None
+	if own_pool:
+		pool = WorkerPool(devices, exp, gauss)
+
+	# the inputs of each tree (with shuffle, X is shared for each tree, and unshared when it completes)
+	Xs, log_dirs = {}, {}
+	shared_X = None if shuffle else pool.share(X)
+	for layer in range(start,layers):
+		if shuffle:
+			X = shuffled(X, layer)
+		Xs[layer] = (X, pool.share(X) if shuffle else shared_X)
+		log_dirs[layer] = make_log_dir(exp, path_logs, layer)
+	NN = {layer: Y.shape[-1]-1-(layer-start) for layer in range(start,layers)}
+	results = {layer: {} for layer in range(start,layers)}
+	shared_Y = pool.share(Y)
+	shared = {start-1: {'Y': shared_Y}} # the outputs of each tree, shared with the workers
+
+	def column(layer, i):
+		# i-th input variable of the tree
+		if layer==start:
+			return shared_Y.column(i)
+		return shared[layer-1][1 if i==0 else i+1]
+
+	done = queue.Queue() # filled by the result handler thread of the pool
+
+	def inputs(layer, i):
+		if layer==start:
+			return Y[:,i]
+		return results[layer-1][1 if i==0 else i+1][2]
+
+	cost = cost_model(exp, path_logs, range(start+1))
+	predicted = {layer: [] for layer in range(start,layers)} # the predicted times of the submitted pairs
+
+	def report(layer):
+		# the ETA of a tree, once all its pairs were submitted
+		print(f"Layer {layer}: predicted {makespan(predicted[layer], pool.workers)/60:.1f} min "
+			+ f"for {len(predicted[layer])} pairs (cost model from {len(cost)} timings)")
+
+	def trained(layer, i, key, result):
+		# saves the result as soon as the pair is trained
+		if (pair_store is not None) and isinstance(result, tuple):
+			pair_store.put(key, result)
+		done.put((layer, i, result))
+
+	def submit(layer, pairs):
+		keys, finished = {}, []
+		if pair_store is not None:
+			for i in pairs:
+				keys[i] = pair_store.key(layer, i, Xs[layer][0], inputs(layer,0), inputs(layer,i), gauss, light)
+				result = pair_store.get(keys[i])
+				if result is not None: # already trained
+					finished.append(i)
+					done.put((layer, i, result))
+			pairs = [i for i in pairs if i not in finished]
+		if len(pairs) == 0:
+			return
+		# the longest pairs first (see cost.py)
+		features = [pair_features(Xs[layer][0], inputs(layer,0), inputs(layer,i), layer) for i in pairs]
+		times = cost.predict(features)
+		predicted[layer].extend(times)
+		for j in np.argsort(-times):
+			i = pairs[j]
+			pool.apply_async(worker, (Xs[layer][1], column(layer,0), column(layer,i), [0,i], layer, gauss, light, shuffle, log_dirs[layer]),
+				{'features': features[j]},
+				callback=lambda result, i=i: trained(layer, i, keys.get(i), result),
+				error_callback=lambda error, i=i: done.put((layer, i, error)))
+
+	submit(start, list(range(1,NN[start]+1)))
+	report(start)
+
+	models, waics = [], []
+	next_layer = start
+	try:
+		while next_layer < layers:
+			layer, i, result = done.get()
+			if isinstance(result, BaseException) or (result == -1):
+				raise RuntimeError(f"Pair 0-{i} of the tree {layer} failed: {result}")
+			results[layer][i] = result
+			if layer+1 < layers: # the inputs of the next tree
+				shared.setdefault(layer, {})[i] = pool.share(result[2])
+
+			# the pairs of the next tree that became ready
+			if layer+1 < layers:
+				if i == 1:
+					ready = [j-1 for j in results[layer] if j > 1]
+				elif 1 in results[layer]:
+					ready = [i-1]
+				else:
+					ready = []
+				if len(ready) > 0:
+					submit(layer+1, ready)
+
+			# the completed trees, in order
+			while (next_layer < layers) and (len(results[next_layer]) == NN[next_layer]):
+				print(f"Layer {next_layer} completed")
+				tree = [results[next_layer][j] for j in range(1,NN[next_layer]+1)]
+				Y_next = np.array([y for _, _, y in tree]).T
+				models.append([m for m, _, _ in tree])
+				waics.append([w for _, w, _ in tree])
+				if on_layer is not None:
+					on_layer(next_layer, Xs[next_layer][0], models[-1], waics[-1], Y_next)
+				if log_dirs[next_layer] is not None: # new timings for the cost model
+					cost.load(log_dirs[next_layer]+'_model_list.txt')
+				if next_layer+1 < layers: # all the pairs of the next tree were submitted
+					report(next_layer+1)
+				# the inputs of this tree are no longer needed
+				results.pop(next_layer-1, None)
+				pool.unshare(*shared.pop(next_layer-1).values())
+				if shuffle:
+					pool.unshare(Xs[next_layer][1])
+				next_layer += 1
+	except BaseException:
+		if own_pool:
+			pool.close(terminate=True)
+		raise
+	if shared_X is not None:
+		pool.unshare(shared_X)
+	if own_pool:
+		pool.close()
+
+	return models, waics, Y_next
@@ -1,19 +1,25 @@
 from copulagp.utils import standard_loader
-from copulagp.train import train_next_tree
-from copulagp.train import save_checkpoint, load_checkpoint, save_final
+from copulagp.train import train_next_tree, train_trees, WorkerPool, shuffled
+from copulagp.train import save_checkpoint, load_checkpoint, save_final, PairStore
 from typing import Callable
 
+import os
+import shutil
 import pickle as pkl
-from torch import tensor, randperm
+from torch import tensor
 from copulagp.vine import CVine
 
 def train_vine(exp: str, path_data: Callable[[int],str], 
 		path_models: Callable[[int],str], path_final: str, path_logs: Callable[[str,int],str],
 		layers_max=-1,start=0,gauss=False,light=False,
-		shuffle=False, device_list=['cpu']):
+		shuffle=False, device_list=['cpu'], overlap=False, queue=None):
 	'''
 	Trains a vine model layer by layer, saving
-	the checkpoints between the layers
+	the checkpoints between the layers.
+	One pool of workers is used for all the layers.
+	The results of the individual pairs are also saved
+	(in path_final without extension + '_pairs'), so that an
+	interrupted layer is resumed with the unfinished pairs only.
 	Parameters
 	----------
 	exp : str
@@ -42,9 +48,21 @@ def train_vine(exp: str, path_data: Callable[[int],str],
 		(without a Gumbel copula, which is often well approximated by a Gaussian+Clayton)
 	shuffle : bool (Default = False)
 		A flag that switches on the shuffling of X
+		(before each tree, with a permutation seeded by the tree, see shuffled)
 	device_list : List[str] (Default = ['cpu'])
 		A list of devices to be used for
 		training (in parallel)
+	overlap : bool (Default = False)
+		A flag that starts the pairs of the next tree
+		as soon as their inputs are ready, instead of
+		waiting for the whole tree (see train_trees)
+	queue : str (Default = None)
+		A path to a job queue database (see jobqueue.py).
+		If given, the pairs are trained by the workers that
+		pull them from this queue (on this machine or on the
+		others sharing the file system), instead of the local
+		processes on device_list (then only its length
+		is used, as the expected number of the workers)
 
 	Returns
 	-------
@@ -62,23 +80,48 @@ def train_vine(exp: str, path_data: Callable[[int],str],
 		to_save['models'], to_save['waics'] = [],[]
 	else:
 		X,Y,to_save = load_checkpoint(path_data(start),path_models(start-1))
-	for layer in range(start,layers):
-		if shuffle:
-			X = X[randperm(X.shape[0])]
-		print(f'Starting {exp} layer {layer}/{layers}')
-		model, waic, Y = train_next_tree(X,Y,layer,device_list,gauss=gauss,light=light,exp=exp,path_logs=path_logs)
-		to_save['models'].append(model)
-		to_save['waics'].append(waic)
-		# save checkpoint
-		save_checkpoint(X,Y,to_save,path_data(layer+1),path_models(layer))
+
+	path_pairs = os.path.splitext(path_final)[0]+'_pairs'
+	pair_store = PairStore(path_pairs)
+
+	if queue is None:
+		pool = WorkerPool(device_list, exp, gauss)
+	else:
+		from copulagp.train.jobqueue import QueuePool
+		pool = QueuePool(queue, len(device_list), exp, gauss)
+	with pool:
+		if overlap:
+			def on_layer(layer, X, model, waic, Y):
+				to_save['models'].append(model)
+				to_save['waics'].append(waic)
+				# save checkpoint
+				save_checkpoint(X,Y,to_save,path_data(layer+1),path_models(layer))
+			print(f'Starting {exp} layers {start}-{layers-1}')
+			train_trees(X,Y,start,layers,device_list,gauss=gauss,light=light,shuffle=shuffle,
+				exp=exp,path_logs=path_logs,on_layer=on_layer,pool=pool,pair_store=pair_store)
+			layers_left = []
+		else:
+			layers_left = range(start,layers)
+		for layer in layers_left:
+			if shuffle:
+				X = shuffled(X, layer)
+			print(f'Starting {exp} layer {layer}/{layers}')
+			model, waic, Y = train_next_tree(X,Y,layer,device_list,gauss=gauss,light=light,exp=exp,path_logs=path_logs,
+				pool=pool,pair_store=pair_store)
+			to_save['models'].append(model)
+			to_save['waics'].append(waic)
+			# save checkpoint
+			save_checkpoint(X,Y,to_save,path_data(layer+1),path_models(layer))
 
 
 	save_final(path_data(0),path_models(layers-1),path_final)
+	# everything is in the checkpoints now
+	shutil.rmtree(path_pairs, ignore_errors=True)
 
 	return to_save
 
 def train_small_vine(X,Y,layers_max=-1,gauss=False,light=False,
-		shuffle=False,device_list=['cpu']):
+		shuffle=False,device_list=['cpu'],overlap=False):
 	'''
 	Same as train_vine, but does not
 	save any files. Takes (X,Y) as an input
@@ -105,6 +148,9 @@ def train_small_vine(X,Y,layers_max=-1,gauss=False,light=False,
 	device_list : List[str] (Default = ['cpu'])
 		A list of devices to be used for
 		training (in parallel)
+	overlap : bool (Default = False)
+		A flag that starts the pairs of the next tree
+		as soon as their inputs are ready (see train_trees)
 
 	Returns
 	-------
@@ -120,12 +166,18 @@ def train_small_vine(X,Y,layers_max=-1,gauss=False,light=False,
 	to_save = {}
 	to_save['models'], to_save['waics'] = [],[]
 
-	for layer in range(layers):
-		if shuffle:
-			X = X[randperm(X.shape[0])]
-		print(f'Starting layer {layer}/{layers}')
-		model, waic, Y = train_next_tree(X,Y,layer,device_list,gauss=gauss,light=light,exp='')
-		to_save['models'].append(model)
-		to_save['waics'].append(waic)
+	with WorkerPool(device_list, '', gauss) as pool:
+		if overlap:
+			to_save['models'], to_save['waics'], _ = train_trees(X,Y,0,layers,device_list,
+				gauss=gauss,light=light,shuffle=shuffle,exp='',pool=pool)
+			return to_save
+
+		for layer in range(layers):
+			if shuffle:
+				X = shuffled(X, layer)
+			print(f'Starting layer {layer}/{layers}')
+			model, waic, Y = train_next_tree(X,Y,layer,device_list,gauss=gauss,light=light,exp='',pool=pool)
+			to_save['models'].append(model)
+			to_save['waics'].append(waic)
 
 	return to_save
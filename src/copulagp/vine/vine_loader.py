@@ -63,9 +63,9 @@ def load(models_lists: Callable[[], str], weight_files: Callable[[], str],
 	                model = get_model(weight_files(layer,n), likelihoods[layer][n], device)
 	                with torch.no_grad():
 	                    if gp_particles == torch.Size([]):
-	                        f = model.gp_model(train_x).mean
+	                        f = model.gp_model.grid_posterior(train_x).mean
 	                    else:
-	                        f0 = model.gp_model(train_x).rsample(gp_particles)
+	                        f0 = model.gp_model.grid_posterior(train_x).rsample(gp_particles)
 	                        f0 = torch.einsum('i...->...i', f0)
 	                        onehot = torch.rand(f0.shape,device=f0.device).argsort(dim = -1) == 0
 	                        f = f0[onehot].reshape(f0.shape[:-1])
@@ -1,11 +1,17 @@
 import unittest
+import os
+import tempfile
 
 import torch
 import numpy as np
 from numpy.testing import assert_allclose, assert_array_equal
 import sys
 sys.path.insert(0, '../src')
-from copulagp.bvcopula.distributions import GaussianCopula, FrankCopula, ClaytonCopula, GumbelCopula, StudentTCopula
+from copulagp.bvcopula import conf, validation
+from copulagp.bvcopula.cache import InferCache
+import copulagp.bvcopula as bvcopula
+from copulagp.bvcopula.distributions import GaussianCopula, FrankCopula, ClaytonCopula, GumbelCopula, StudentTCopula, \
+	IndependenceCopula, MixtureCopula, CopulaFeatures
 
 torch.manual_seed(0) 
 
@@ -101,6 +107,349 @@ class TestCopulaLogPDF(unittest.TestCase):
 		assert_allclose(p_logpdf, r_logpdf,atol=1e-5)
 
 
+class TestMixtureLogPDF(unittest.TestCase):
+	"""
+	Checks that the fused mixture log_prob matches the element-by-element evaluation.
+	"""
+
+	def test_fused_vs_loop(self):
+		copulas = [IndependenceCopula, GaussianCopula, FrankCopula,
+					ClaytonCopula, ClaytonCopula, GumbelCopula, GumbelCopula]
+		rotations = [None, None, None, '0°', '90°', '180°', '270°']
+		N, S = 200, 5
+		theta = torch.stack([torch.zeros(S,N),
+							torch.rand(S,N)*2-1,
+							torch.rand(S,N)*26-13,
+							torch.rand(S,N)*9.4,
+							torch.rand(S,N)*9.4,
+							torch.rand(S,N)*8+1,
+							torch.rand(S,N)*8+1])
+		mix = torch.rand(len(copulas),S,N)
+		mix = mix/mix.sum(dim=0)
+		copula = MixtureCopula(theta, mix, copulas, rotations=rotations)
+		samples = torch.rand(N,2)
+		value = samples.expand(S,N,2)
+		for clayton_only in [False, True]:
+			r_logpdf = copula._loop_log_prob(value, clayton_only=clayton_only).numpy()
+			p_logpdf = copula._fused_log_prob(CopulaFeatures(value), clayton_only=clayton_only).numpy()
+			assert_allclose(p_logpdf, r_logpdf, atol=1e-4, rtol=1e-5)
+		# single element
+		for c, r, t in zip(copulas[1:], rotations[1:], theta[1:]):
+			copula = MixtureCopula(t.unsqueeze(0), torch.ones(1,S,N), [c], rotations=[r])
+			r_logpdf = copula._loop_log_prob(value).numpy()
+			p_logpdf = copula._fused_log_prob(CopulaFeatures(value)).numpy()
+			assert_allclose(p_logpdf, r_logpdf, atol=1e-4, rtol=1e-5)
+
+	def test_precomputed_features(self):
+		copulas = [GaussianCopula, ClaytonCopula, ClaytonCopula, GumbelCopula, GumbelCopula]
+		rotations = [None, '0°', '90°', '180°', '270°']
+		N, S = 200, 5
+		theta = torch.stack([torch.rand(S,N)*2-1,
+							torch.rand(S,N)*9.4,
+							torch.rand(S,N)*9.4,
+							torch.rand(S,N)*8+1,
+							torch.rand(S,N)*8+1])
+		mix = torch.ones(len(copulas),S,N)/len(copulas)
+		copula = MixtureCopula(theta, mix, copulas, rotations=rotations)
+		samples = torch.rand(N,2)
+		# features of the [N,2] samples are broadcasted against [S,N] thetas
+		r_logpdf = copula.log_prob(samples).numpy()
+		p_logpdf = copula.log_prob(CopulaFeatures(samples)).numpy()
+		assert_allclose(p_logpdf, r_logpdf, atol=1e-6)
+		assert p_logpdf.shape == (S,N)
+
+class TestMixtureLink(unittest.TestCase):
+
+	def test_stick_breaking(self):
+		likelihoods = [bvcopula.GaussianCopula_Likelihood(),
+						bvcopula.ClaytonCopula_Likelihood(rotation='0°'),
+						bvcopula.FrankCopula_Likelihood(),
+						bvcopula.ClaytonCopula_Likelihood(rotation='90°')]
+		mixture = bvcopula.MixtureCopula_Likelihood(likelihoods)
+		# at f=0 all the copulas are mixed equally
+		thetas, mix = mixture.gplink_function(torch.zeros(3,mixture.f_size))
+		assert_allclose(mix.numpy(), np.full((4,3),0.25), atol=1e-6)
+		# mixing coefficients sum up to 1, thetas follow the order of the likelihoods
+		f = torch.randn(10,mixture.f_size)
+		thetas, mix = mixture.gplink_function(f)
+		assert_allclose(mix.sum(dim=0).numpy(), np.ones(10), atol=1e-6)
+		for i, lik in enumerate(likelihoods):
+			assert_array_equal(thetas[i].numpy(), lik.gplink_function(f[...,i]).numpy())
+
+class TestStaticFit(unittest.TestCase):
+
+	def test_batched_bins(self):
+		# each bin gets its own constant parameters
+		rhos = torch.tensor([-0.5,0.,0.7])
+		with torch.random.fork_rng():
+			torch.manual_seed(0)
+			samples = GaussianCopula(rhos[:,None].expand(3,1000)).sample().squeeze()
+		mixture = bvcopula.MixtureCopula_Likelihood([bvcopula.GaussianCopula_Likelihood()])
+		copula = mixture.fit(samples, n_epoch=300, lr=0.05)
+		assert copula.theta.shape == (1,3,1000)
+		assert_allclose(copula.theta[0,:,0].numpy(), rhos.numpy(), atol=0.07)
+
+	def test_single_pair(self):
+		with torch.random.fork_rng():
+			torch.manual_seed(0)
+			samples = GaussianCopula(torch.tensor([[0.7],[-0.3]]).expand(2,1000)).sample().squeeze()
+		mixture = bvcopula.MixtureCopula_Likelihood([bvcopula.GaussianCopula_Likelihood(),
+							bvcopula.ClaytonCopula_Likelihood(rotation='90°')])
+		# a single pair [N x 2] is fitted as the same pair in a batch
+		single = mixture.fit(samples[0], n_epoch=300, lr=0.05)
+		batch = mixture.fit(samples, n_epoch=300, lr=0.05)
+		assert single.theta.shape == (2,1000)
+		assert_allclose(single.theta.numpy(), batch.theta[:,0].numpy(), atol=1e-5)
+		assert_allclose(single.mix.numpy(), batch.mix[:,0].numpy(), atol=1e-5)
+		# the starting parameters for each sample [N x f_size], as before
+		copula = mixture.fit(samples[0], f0=torch.zeros(1000,mixture.f_size), n_epoch=300, lr=0.05)
+		assert copula.theta.shape == (2,1000)
+		assert torch.all(torch.isfinite(copula.log_prob(samples[0])))
+
+class TestMinibatch(unittest.TestCase):
+
+	def tearDown(self):
+		conf.minibatch_size = None
+
+	def test_gaussian(self):
+		# the ELBO is scaled to the full data, so the fit matches the full-batch one
+		conf.minibatch_size = 150
+		with torch.random.fork_rng():
+			torch.manual_seed(0)
+			y = GaussianCopula(torch.full((600,),0.7)).sample().squeeze()
+			x = torch.linspace(0.,1.,600)
+			waic, model = bvcopula.infer([bvcopula.GaussianCopula_Likelihood()], x, y,
+				torch.device('cpu'), max_num_iter=400)
+		# -I(rho=0.7) = 0.5*log(1-0.49)
+		assert_allclose(waic, 0.5*np.log(1-0.49), atol=0.05)
+
+class TestQuadrature(unittest.TestCase):
+
+	def test_sparse_gauss_hermite(self):
+		nodes, weights = bvcopula.likelihoods.sparse_gauss_hermite(3, 3)
+		# exact up to the total degree 5
+		assert_allclose(weights.sum(), 1.)
+		assert_allclose(weights @ nodes, np.zeros(3), atol=1e-12)
+		assert_allclose(weights @ nodes**2, np.ones(3))
+		assert_allclose(weights @ nodes**4, np.full(3,3.))
+		assert_allclose(weights @ (nodes[:,0]**2 * nodes[:,1]**2), 1.)
+		assert_allclose(weights @ (nodes[:,0]**3 * nodes[:,2]**2), 0., atol=1e-12)
+
+	def test_matches_mc(self):
+		from gpytorch.settings import num_likelihood_samples
+		with torch.random.fork_rng():
+			torch.manual_seed(0)
+			model = bvcopula.Pair_CopulaGP([bvcopula.GaussianCopula_Likelihood(),
+							bvcopula.ClaytonCopula_Likelihood(rotation='90°')])
+			q_u = model.gp_model.variational_strategy.base_variational_strategy
+			x = torch.linspace(0.,1.,50)
+			try:
+				with torch.no_grad():
+					model.gp_model(x) # initializes q(u)
+					for p in model.gp_model.variational_strategy.parameters():
+						p.add_(torch.randn_like(p)*0.3)
+					# a narrow posterior, as after training
+					q_u._variational_distribution.chol_variational_covar.mul_(0.2)
+					f = model.gp_model(x)
+					y = model.likelihood.get_copula(f.mean).sample().squeeze()
+					conf.expected_log_prob = 'mc'
+					with num_likelihood_samples(20000):
+						mc = model.likelihood.expected_log_prob(y, f)
+					conf.expected_log_prob = 'quadrature'
+					quadrature = model.likelihood.expected_log_prob(y, f)
+			finally:
+				conf.expected_log_prob = 'mc'
+		assert_allclose(quadrature.numpy(), mc.numpy(), atol=0.02)
+
+class TestWAICStatistics(unittest.TestCase):
+
+	def test_chunked_statistics(self):
+		log_prob = torch.randn(500,100).double()*3
+		stats = bvcopula.likelihoods.WAICStatistics()
+		for chunk in torch.split(log_prob, 37):
+			stats.update(chunk)
+		assert stats.count == 500
+		assert_allclose(stats.logsumexp.numpy(), log_prob.logsumexp(dim=0).numpy(), rtol=1e-10)
+		assert_allclose(stats.var.numpy(), torch.var(log_prob,dim=0).numpy(), rtol=1e-10)
+
+class TestGridPosterior(unittest.TestCase):
+
+	def test_matches_gp(self):
+		with torch.random.fork_rng(): # keeps the global RNG state for the other tests
+			model = bvcopula.Pair_CopulaGP([bvcopula.GaussianCopula_Likelihood(),
+							bvcopula.ClaytonCopula_Likelihood(rotation='90°')])
+			gp_model = model.gp_model
+			with torch.no_grad():
+				for p in gp_model.variational_strategy.parameters():
+					p.add_(torch.randn_like(p)*0.3)
+				x = torch.rand(200)
+				gp_distr = gp_model(x)
+				grid_posterior = gp_model.grid_posterior(x)
+				assert_allclose(grid_posterior.mean.numpy(), gp_distr.mean.numpy(), atol=1e-6)
+				samples = grid_posterior.rsample(torch.Size([20000]))
+			assert samples.shape == (20000,200,3)
+			assert_allclose(samples.var(dim=0).numpy(), gp_distr.variance.numpy(), rtol=0.1, atol=1e-3)
+
+	def test_interpolation_cache(self):
+		model = bvcopula.Pair_CopulaGP([bvcopula.GaussianCopula_Likelihood()])
+		strategy = model.gp_model.variational_strategy.base_variational_strategy
+		x = torch.linspace(0,1,100)
+		with torch.no_grad():
+			model.gp_model(x)
+			cache = strategy._interp_cache
+			model.gp_model(x)
+			assert strategy._interp_cache is cache
+			x.mul_(0.5) # in-place change invalidates the cache
+			assert_allclose(model.gp_model(x).mean.numpy(), model.gp_model(x.clone()).mean.numpy())
+			assert strategy._interp_cache is not cache
+
+class TestBatchedPairs(unittest.TestCase):
+
+	def test_split(self):
+		with torch.random.fork_rng():
+			model = bvcopula.Pair_CopulaGP([bvcopula.GaussianCopula_Likelihood(),
+							bvcopula.ClaytonCopula_Likelihood(rotation='90°')], num_pairs=4)
+			with torch.no_grad():
+				for p in model.gp_model.parameters():
+					p.add_(torch.randn_like(p)*0.3)
+				x = torch.rand(50)
+				y = torch.rand(4,50,2)
+				mean = model.gp_model(x).mean
+				assert mean.shape == (4,50,3)
+				pairs = model.split()
+				for i, pair in enumerate(pairs):
+					assert_allclose(pair.gp_model(x).mean.numpy(), mean[i].numpy(), atol=1e-6)
+				# WAIC of each pair
+				waics = model.likelihood.WAIC(model.gp_model.grid_posterior(x), y)
+				assert len(waics) == 4
+				lpd, pwaic = model.likelihood.WAIC(model.gp_model.grid_posterior(x), y, combine_terms=False)
+				assert len(lpd) == 4 and len(pwaic) == 4
+				lpd, pwaic = pairs[0].likelihood.WAIC(pairs[0].gp_model.grid_posterior(x), y[0], combine_terms=False)
+				assert isinstance(lpd, float) and isinstance(pwaic, float)
+
+	def test_converged_pair_is_frozen(self):
+		from torch.optim.optimizer import register_optimizer_step_pre_hook
+		# parameters before each optimization step
+		steps = []
+		hook = register_optimizer_step_pre_hook(lambda optimizer, args, kwargs: steps.append(
+			[p.detach().clone() for group in optimizer.param_groups for p in group['params']]))
+		conf.r_loss_tol, r_loss_tol = 0.01, conf.r_loss_tol
+		try:
+			with torch.random.fork_rng():
+				torch.manual_seed(0)
+				x = torch.linspace(0.,1.,300)
+				y = torch.stack([GaussianCopula(torch.full((300,),0.7)).sample().squeeze(), torch.rand(300,2)])
+				waics, model = bvcopula.infer([bvcopula.GaussianCopula_Likelihood()], x, y,
+					torch.device('cpu'), max_num_iter=600)
+		finally:
+			hook.remove()
+			conf.r_loss_tol = r_loss_tol
+		assert len(waics) == 2 and waics[0] < -0.2
+		def last_change(pair):
+			return max(i for i in range(1,len(steps))
+				if any(not torch.equal(a[pair],b[pair]) for a, b in zip(steps[i-1],steps[i])))
+		# the dependent pair converges and stays at its parameters, the other one continues
+		assert last_change(0) < len(steps)-100
+		assert last_change(1) == len(steps)-1
+
+class TestNaturalParameterization(unittest.TestCase):
+
+	def test_cholesky(self):
+		with torch.random.fork_rng():
+			model = bvcopula.Pair_CopulaGP([bvcopula.GaussianCopula_Likelihood()], natural=True)
+			with torch.no_grad():
+				x = torch.rand(50)
+				model.gp_model(x) # initializes q(u)
+				for p in model.gp_model.parameters():
+					p.add_(torch.randn_like(p)*0.1)
+				posterior = model.gp_model(x)
+				converted = model.cholesky().gp_model(x)
+				assert_allclose(converted.mean.numpy(), posterior.mean.numpy(), atol=1e-4)
+				assert_allclose(converted.variance.numpy(), posterior.variance.numpy(), atol=1e-4)
+
+class TestWarmStart(unittest.TestCase):
+
+	def test_reduced_mixture(self):
+		with torch.random.fork_rng():
+			source = bvcopula.Pair_CopulaGP([bvcopula.GaussianCopula_Likelihood(),
+							bvcopula.ClaytonCopula_Likelihood(rotation='90°'),
+							bvcopula.GumbelCopula_Likelihood(rotation='180°')])
+			x = torch.linspace(0.,1.,50)
+			with torch.no_grad():
+				source.gp_model(x) # initializes q(u)
+				for p in source.gp_model.parameters():
+					p.add_(torch.randn_like(p)*0.1)
+			model = bvcopula.Pair_CopulaGP([bvcopula.ClaytonCopula_Likelihood(rotation='90°'),
+							bvcopula.GaussianCopula_Likelihood()])
+			model.warm_start(source.serialize())
+			with torch.no_grad():
+				posterior, source_posterior = model.gp_model(x), source.gp_model(x)
+				thetas, mix = model.likelihood.gplink_function(posterior.mean)
+				source_thetas, source_mix = source.likelihood.gplink_function(source_posterior.mean)
+			assert_allclose(posterior.variance[:,[1,0]].numpy(), source_posterior.variance[:,:2].numpy(), rtol=5e-2)
+			# matched copulas keep their parameters and relative mixing weights
+			assert_allclose(thetas[[1,0]].numpy(), source_thetas[:2].numpy(), atol=1e-2)
+			assert_allclose((mix[1]/mix[0]).numpy(), (source_mix[0]/source_mix[1]).numpy(), rtol=1e-2)
+
+class TestInferCache(unittest.TestCase):
+
+	def test_lookup_and_eviction(self):
+		likelihoods = [bvcopula.GaussianCopula_Likelihood(), bvcopula.ClaytonCopula_Likelihood(rotation='90°')]
+		x, y = torch.linspace(0.,1.,20), torch.full((20,2),0.5)
+		with tempfile.TemporaryDirectory() as path:
+			cache = InferCache(path, max_bytes=2**30)
+			key = cache.key(likelihoods, x, y)
+			assert cache.get(key, likelihoods, torch.device('cpu')) is None
+			# the key depends on the data, the mixture and the conf
+			assert cache.key(likelihoods, x, y+0.1) != key
+			assert cache.key(likelihoods[:1], x, y) != key
+			conf.base_lr, base_lr = conf.base_lr*2, conf.base_lr
+			try:
+				assert cache.key(likelihoods, x, y) != key
+			finally:
+				conf.base_lr = base_lr
+			model = bvcopula.Pair_CopulaGP(likelihoods)
+			with torch.no_grad():
+				model.gp_model(x) # initializes q(u)
+			cache.put(key, -0.1, model)
+			waic, cached = cache.get(key, likelihoods, torch.device('cpu'))
+			assert waic == -0.1
+			with torch.no_grad():
+				assert_array_equal(cached.gp_model(x).mean.numpy(), model.gp_model(x).mean.numpy())
+			# least recently used entries are removed when the cache is full
+			cache.max_bytes = os.path.getsize(os.path.join(path, f'{key}.pth')) * 1.5
+			cache.put('other', -0.2, model)
+			assert sorted(os.listdir(path)) == ['other.pth']
+
+class TestValidation(unittest.TestCase):
+	"""
+	Checks the validation levels of the numerical checks.
+	"""
+
+	def tearDown(self):
+		conf.validation = 'strict'
+		validation.reset()
+
+	def bad_mixture(self):
+		return MixtureCopula(torch.zeros(2,10), torch.full([2,10],0.3), [GaussianCopula, FrankCopula])
+
+	def test_strict(self):
+		conf.validation = 'strict'
+		with self.assertRaises(AssertionError):
+			self.bad_mixture()
+
+	def test_sampled(self):
+		conf.validation = 'sampled'
+		self.bad_mixture() # does not raise here
+		with self.assertRaises(AssertionError):
+			validation.inspect()
+		validation.inspect() # flags were reset
+
+	def test_off(self):
+		conf.validation = 'off'
+		self.bad_mixture()
+		validation.inspect()
+
 class TestCopulaSampling(unittest.TestCase):
 	"""
 	Checks that the Sampling is consistent with log_prob.
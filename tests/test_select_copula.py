@@ -0,0 +1,227 @@
+import unittest
+import os
+import subprocess
+import sys
+import tempfile
+from unittest import mock
+
+import torch
+import numpy as np
+from numpy.testing import assert_allclose
+
+import copulagp.bvcopula as bvcopula
+from copulagp.bvcopula.distributions import GaussianCopula
+from copulagp.select_copula import conf
+from copulagp.select_copula.candidates import Candidates
+from copulagp.select_copula import halving, prescreen, subsample, simple_greedy
+from copulagp.utils import get_copula_name_string
+
+def gaussian_data(rho, N=300, seed=0):
+	with torch.random.fork_rng():
+		torch.manual_seed(seed)
+		y = GaussianCopula(torch.full((N,),rho)).sample().squeeze()
+	return torch.linspace(0.,1.,N), y
+
+class TestCandidates(unittest.TestCase):
+
+	def tearDown(self):
+		conf.candidate_workers = 1
+
+	def test_pool_matches_serial(self):
+		x, y = gaussian_data(0.7)
+		mixtures = [[bvcopula.GaussianCopula_Likelihood()],
+					[bvcopula.ClaytonCopula_Likelihood(rotation='90°')]]
+		results = {}
+		for workers in [1, 2]:
+			conf.candidate_workers = workers
+			with Candidates(x, y, torch.device('cpu')) as candidates:
+				assert (candidates.pool is None) == (workers == 1)
+				submitted = [candidates.submit(likelihoods, max_num_iter=300) for likelihoods in mixtures]
+				results[workers] = [candidate.result() for candidate in submitted]
+		serial = [waic for waic, _ in results[1]]
+		pooled = [waic for waic, _ in results[2]]
+		# each candidate is trained on its own random stream: the same WAICs
+		assert np.argmin(serial) == 0
+		assert_allclose(pooled, serial, rtol=1e-5)
+		for (_, serial_model), (_, pooled_model) in zip(*results.values()):
+			assert pooled_model.serialize().name_string == serial_model.serialize().name_string
+
+class _FakeModel():
+	# a trained model, that remembers how it was trained
+	def __init__(self, likelihoods, init_from, max_num_iter):
+		self.name = self.name_string = get_copula_name_string(likelihoods)
+		self.init_from, self.max_num_iter = init_from, max_num_iter
+	def serialize(self):
+		return self
+
+class TestHalving(unittest.TestCase):
+
+	def test_rungs(self):
+		calls = []
+		def infer(likelihoods, train_x, train_y, device, init_from=None, max_num_iter=None):
+			model = _FakeModel(likelihoods, init_from, max_num_iter)
+			calls.append((model, train_x.shape[0]))
+			return -0.1, model
+		# the held-out score prefers the elements in this order
+		ranking = [get_copula_name_string([e]) for e in conf.elements[3::-1]]
+		score = lambda model, x, y: ranking.index(model.name)
+		x, y = gaussian_data(0.7, N=100)
+		with mock.patch.object(bvcopula, 'infer', infer), \
+				mock.patch.object(halving, 'heldout_score', score), \
+				mock.patch.object(conf, 'elements', conf.elements[:4]), \
+				mock.patch.object(conf, 'halving_max_mix', 1):
+			model_data, waic = halving._select_halving(x, y, torch.device('cpu'))
+		# 4 mixtures -> 2 -> 1, with a doubled budget on each rung
+		assert [model.max_num_iter for model, _ in calls] == [conf.halving_iter]*4 + [2*conf.halving_iter]*2 + [None]
+		assert [model.name for model, _ in calls[4:6]] == ranking[:2]
+		# the promoted mixtures continue from their models of the previous rung
+		for model, _ in calls[4:]:
+			assert model.init_from.name == model.name and model.init_from in [m for m, _ in calls]
+		# the winner is trained on all the data
+		final, N = calls[-1]
+		assert final.name == ranking[0] and N == 100
+		assert calls[0][1] == 100 - int(100*conf.halving_holdout)
+		assert model_data is final and waic == -0.1
+
+class TestPrescreen(unittest.TestCase):
+
+	def test_large_n_memory(self):
+		# Kendall's tau is computed on a subsample of each bin, not on all n^2 pairs
+		# (that would be 8 x 25000^2 floats here); peak memory measured in a fresh process
+		code = """if True:
+			import resource, torch
+			from copulagp.select_copula import conf, prescreen
+			conf.prescreen_epochs = 5
+			torch.manual_seed(0)
+			x, y = torch.rand(200000), torch.rand(200000,2)
+			before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+			prescreen.prescreen(x, y)
+			print((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before)//1024)"""
+		output = subprocess.run([sys.executable, '-W', 'ignore', '-c', code], capture_output=True, text=True, check=True)
+		assert int(output.stdout.split()[-1]) < 1024 # MB
+
+class TestIndependence(unittest.TestCase):
+
+	def tearDown(self):
+		conf.independence_test = False
+
+	def test_independent_and_dependent(self):
+		x = torch.linspace(0.,1.,5000)
+		with torch.random.fork_rng():
+			torch.manual_seed(0)
+			independent = torch.rand(5000,2)
+		_, dependent = gaussian_data(0.2, N=5000)
+		conf.independence_test = True
+		assert prescreen.clearly_independent(x, independent)
+		assert not prescreen.clearly_independent(x, dependent)
+		# the same decisions with the bootstrap in small chunks
+		with mock.patch.object(prescreen, 'max_resampled', 1000):
+			assert prescreen.clearly_independent(x, independent)
+			assert not prescreen.clearly_independent(x, dependent)
+		# off by default
+		conf.independence_test = False
+		assert not prescreen.clearly_independent(x, independent)
+
+class TestSubsample(unittest.TestCase):
+
+	def tearDown(self):
+		conf.subsample, conf.subsample_check = None, 0.
+
+	def run_selection(self):
+		selections = []
+		def select(train_x, train_y):
+			selections.append(train_x.shape[0])
+			# the full data would select another mixture
+			likelihoods = [bvcopula.GaussianCopula_Likelihood()] if train_x.shape[0] < 1000 \
+				else [bvcopula.FrankCopula_Likelihood()]
+			return bvcopula.Pair_CopulaGP(likelihoods).serialize(), -0.1
+		refits = []
+		def infer(likelihoods, train_x, train_y, device, init_from=None):
+			refits.append((get_copula_name_string(likelihoods), train_x.shape[0], init_from))
+			return -0.2, bvcopula.Pair_CopulaGP(likelihoods)
+		x, y = gaussian_data(0.7, N=1000)
+		conf.subsample = 0.2
+		with mock.patch.object(bvcopula, 'infer', infer), self.assertLogs(level='INFO') as logs:
+			model_data, waic = subsample.select_subsampled(select, x, y, torch.device('cpu'))
+		return selections, refits, model_data, waic, logs.output
+
+	def test_refit(self):
+		selections, refits, model_data, waic, _ = self.run_selection()
+		assert selections == [200]
+		# the subsample choice is refitted on all the data, from the subsample model
+		assert [refit[:2] for refit in refits] == [('Gaussian', 1000)]
+		assert refits[0][2].name_string == 'Gaussian'
+		assert model_data.name_string == 'Gaussian' and waic == -0.2
+
+	def test_check(self):
+		conf.subsample_check = 1.
+		selections, refits, model_data, waic, output = self.run_selection()
+		# the full selection is only compared to, the subsample choice is returned
+		assert selections == [200, 1000]
+		assert model_data.name_string == 'Gaussian' and waic == -0.2
+		# the agreement is collected from the logs (e.g. of several workers)
+		with tempfile.TemporaryDirectory() as path:
+			for i, agreed in enumerate(['0', '1']):
+				with open(f'{path}/log{i}.txt', 'w') as f:
+					f.write('\n'.join(line.replace('agreed=0', f'agreed={agreed}') for line in output))
+			assert subsample.subsample_agreement([f'{path}/log0.txt', f'{path}/log1.txt']) == (1, 2)
+
+class TestSimpleGreedy(unittest.TestCase):
+
+	def tearDown(self):
+		conf.greedy_spill = False
+
+	def select(self, path, waics):
+		def infer(likelihoods, train_x, train_y, device, init_from=None):
+			name = get_copula_name_string(likelihoods)
+			if waics.get(name) is None:
+				raise ValueError(f'{name} cannot be trained')
+			model = bvcopula.Pair_CopulaGP(likelihoods)
+			with torch.no_grad():
+				model.gp_model(train_x) # initializes q(u)
+			return waics[name], model
+		x, y = gaussian_data(0.7, N=50)
+		with mock.patch.object(bvcopula, 'infer', infer), \
+				mock.patch.object(conf, 'elements', conf.elements[1:3]), \
+				mock.patch('copulagp.utils.Plot_Fit'):
+			return simple_greedy.select_copula_model(x.numpy(), y.numpy(), torch.device('cpu'),
+				'exp', path, 'x', 'y', train_x=x, train_y=y)
+
+	def test_only_the_winner_is_saved(self):
+		waics = {'Gaussian': -0.1, 'Frank': -0.05, 'FrankGaussian': -0.08}
+		with tempfile.TemporaryDirectory() as path:
+			likelihoods, waic = self.select(path, waics)
+			assert get_copula_name_string(likelihoods) == 'Gaussian' and waic == -0.1
+			assert sorted(f for f in os.listdir(path) if f.startswith('w_')) == ['w_exp_x-y_Gaussian.pth']
+		# with the spill, all the candidates are written as well
+		conf.greedy_spill = True
+		with tempfile.TemporaryDirectory() as path:
+			self.select(path, waics)
+			assert sorted(f for f in os.listdir(path) if f.startswith('w_')) == \
+				['w_exp_x-y_Frank.pth', 'w_exp_x-y_FrankGaussian.pth', 'w_exp_x-y_Gaussian.pth']
+
+	def test_all_failed(self):
+		with tempfile.TemporaryDirectory() as path:
+			likelihoods, waic = self.select(path, {'Gaussian': -0.1})
+			# the extensions of Gaussian failed: it is kept
+			assert get_copula_name_string(likelihoods) == 'Gaussian'
+			likelihoods, waic = self.select(path, {})
+			assert get_copula_name_string(likelihoods) == 'Independence'
+
+	def test_spill(self):
+		model = bvcopula.Pair_CopulaGP([bvcopula.GaussianCopula_Likelihood()])
+		with torch.no_grad():
+			model.gp_model(torch.linspace(0.,1.,10))
+		model_data = model.serialize()
+		conf.greedy_spill = True
+		with tempfile.TemporaryDirectory() as path:
+			spill = simple_greedy.Spill()
+			spill.save(model_data, f'{path}/w.pth')
+			expected = {k: v.clone() for k, v in model_data.weights.items()}
+			for v in model_data.weights.values():
+				v.add_(1) # the weights were copied when saved
+			spill.close()
+			saved = torch.load(f'{path}/w.pth')
+			assert saved.keys() == expected.keys()
+			for k in expected:
+				assert torch.equal(saved[k], expected[k])
@@ -0,0 +1,439 @@
+import unittest
+from unittest import mock
+from contextlib import redirect_stdout
+import io
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+
+import numpy as np
+from numpy.testing import assert_allclose
+
+from copulagp.train import train_trees, train_next_tree, WorkerPool, PairStore, shuffled
+from copulagp.train.train_next_tree import Shared, fetch
+from copulagp.train.jobqueue import JobQueue, QueuePool, run_worker, _settings
+import copulagp.bvcopula as bvcopula
+from copulagp.utils import get_copula_name_string
+import copulagp.select_copula as select_copula
+from copulagp.train import cost as cost_module
+from copulagp.train.cost import CostModel, prior_weights, format_features, makespan
+
+def fake_output(Y0, Y1):
+	# a deterministic stand-in for the ccdf of a trained pair
+	return np.mod(0.3*Y0 + Y1, 1.)
+
+def _conf_value(name):
+	return getattr(select_copula.conf, name)
+
+def _spin(seconds):
+	# a job that runs python code (and can be interrupted) for some seconds
+	start = time.time()
+	while time.time()-start < seconds:
+		time.sleep(0.01)
+	return 'finished'
+
+class FakePool():
+	'''
+	Same interface as WorkerPool: the tasks are completed in a random order
+	by a thread, with fake_output instead of training (the pairs in fail fail)
+	'''
+	def __init__(self, path, seed=0, fail=()):
+		self.path, self.count, self.workers, self.fail = path, 0, 2, fail
+		self.pending, self.delivered, self.submitted = [], set(), []
+		self.random = random.Random(seed)
+		self.lock = threading.Lock()
+		self.stopped = threading.Event()
+		self.thread = threading.Thread(target=self.run, daemon=True)
+		self.thread.start()
+
+	def share(self, array):
+		path = os.path.join(self.path, f'{self.count}.npy')
+		self.count += 1
+		np.save(path, array)
+		return Shared(path)
+
+	def unshare(self, *shared):
+		for s in shared:
+			os.remove(s.path)
+
+	def apply_async(self, func, args=(), kwds={}, callback=None, error_callback=None):
+		X, Y0, Y1, idxs, layer = args[:5]
+		result = _FakeResult(callback, error_callback)
+		with self.lock:
+			self.submitted.append((layer, idxs[1], set(self.delivered)))
+			self.pending.append((layer, idxs[1], fetch(Y0), fetch(Y1), result))
+		return result
+
+	def run(self):
+		while not self.stopped.is_set():
+			with self.lock:
+				task = self.pending.pop(self.random.randrange(len(self.pending))) if self.pending else None
+			if task is None:
+				time.sleep(0.001)
+				continue
+			layer, i, Y0, Y1, result = task
+			with self.lock:
+				self.delivered.add((layer, i))
+			if (layer, i) in self.fail:
+				result.finish(None, RuntimeError(f'pair {layer}-{i} failed'))
+			else:
+				result.finish((f'model{layer}-{i}', -0.1*layer, fake_output(Y0, Y1)), None)
+
+	def close(self):
+		self.stopped.set()
+		self.thread.join()
+
+class _FakeResult():
+	def __init__(self, callback, error_callback):
+		self.callback, self.error_callback = callback, error_callback
+		self.event = threading.Event()
+
+	def finish(self, value, error):
+		self.value, self.error = value, error
+		if error is None:
+			if self.callback is not None:
+				self.callback(value)
+		elif self.error_callback is not None:
+			self.error_callback(error)
+		self.event.set()
+
+	def get(self):
+		self.event.wait()
+		if self.error is not None:
+			raise self.error
+		return self.value
+
+class TestWorkerPool(unittest.TestCase):
+
+	def test_share_round_trip(self):
+		Y = np.random.default_rng(0).random((100,4))
+		with WorkerPool(['cpu']) as pool:
+			shared = pool.share(Y)
+			# the workers get the arrays and the columns through the references
+			assert_allclose(pool.apply_async(fetch, (shared,)).get(), Y)
+			assert_allclose(pool.apply_async(fetch, (shared.column(2),)).get(), Y[:,2])
+			assert_allclose(fetch(Y), Y) # the arrays themselves are passed as they are
+			pool.unshare(shared)
+			assert not os.path.exists(shared.path)
+			pool.unshare(shared) # already removed
+			other = pool.share(Y)
+		# the files are removed with the pool
+		assert not os.path.exists(other.path) and not os.path.exists(pool.dir)
+
+class TestTrainTrees(unittest.TestCase):
+
+	def train(self, Y, start, layers, shuffle=False, seed=0):
+		completed = []
+		with tempfile.TemporaryDirectory() as path:
+			pool = FakePool(path, seed)
+			try:
+				models, waics, Y_next = train_trees(np.linspace(0.,1.,Y.shape[0]), Y, start, layers, ['cpu'],
+					shuffle=shuffle, pool=pool, on_layer=lambda layer, *args: completed.append(layer))
+			finally:
+				pool.close()
+			# all the shared files were released
+			assert os.listdir(path) == []
+		return models, waics, Y_next, completed, pool.submitted
+
+	def test_readiness_and_order(self):
+		rng = np.random.default_rng(0)
+		Y = rng.random((200,6))
+		for seed in range(3):
+			for shuffle in [False, True]:
+				models, waics, Y_next, completed, submitted = self.train(Y, 0, 4, shuffle=shuffle, seed=seed)
+				# each pair is submitted once, after the pairs that it depends on
+				assert sorted((layer, i) for layer, i, _ in submitted) == \
+					[(layer, i) for layer in range(4) for i in range(1,6-layer)]
+				for layer, i, delivered in submitted:
+					if layer > 0:
+						assert {(layer-1, 1), (layer-1, i+1)} <= delivered
+				# the trees complete in order, with the same outputs as tree by tree
+				assert completed == [0, 1, 2, 3]
+				expected = Y
+				for layer in range(4):
+					assert models[layer] == [f'model{layer}-{i}' for i in range(1,expected.shape[1])]
+					expected = np.stack([fake_output(expected[:,0], expected[:,i]) for i in range(1,expected.shape[1])]).T
+				assert_allclose(Y_next, expected)
+
+	def test_eta(self):
+		Y = np.random.default_rng(0).random((50,6))
+		with redirect_stdout(io.StringIO()) as output:
+			self.train(Y, 0, 4)
+		# an ETA for each tree, for all its pairs, before the tree completes
+		etas = [line for line in output.getvalue().splitlines() if 'predicted' in line]
+		assert [line.split(':')[0] for line in etas] == [f'Layer {layer}' for layer in range(4)]
+		assert [f'for {5-layer} pairs' in line for layer, line in enumerate(etas)] == [True]*4
+		lines = output.getvalue().splitlines()
+		for layer in range(1,4):
+			assert lines.index(etas[layer]) < lines.index(f'Layer {layer} completed')
+
+	def test_no_trees(self):
+		Y = np.random.default_rng(0).random((20,3))
+		models, waics, Y_next, completed, submitted = self.train(Y, 2, 2)
+		assert models == [] and waics == [] and Y_next is Y and submitted == []
+
+class TestCostModel(unittest.TestCase):
+
+	def test_load_and_fit(self):
+		# log(time) of these pairs follows the weights exactly
+		weights = np.array([4., 4., 0.5, 0.2]) # (minutes, so that the rounding to seconds is negligible)
+		rng = np.random.default_rng(0)
+		features = [[float(tau), int(N), int(layer)] for tau, N, layer in
+			zip(rng.random(200)*0.8, rng.integers(1000,100000,200), rng.integers(0,5,200))]
+		times = np.exp(CostModel._design(features) @ weights)
+		with tempfile.TemporaryDirectory() as path:
+			filename = f'{path}/layer0_model_list.txt'
+			with open(filename, 'w') as f:
+				# the format of the worker (train_next_tree.worker); older lines have no features
+				f.write("0-1 Gaussian\t-0.1000\t12 sec\n")
+				for (tau, N, layer), t in zip(features, times):
+					f.write(f"0-{layer+1} Gaussian\t-0.1000\t{int(round(t))} sec\t{format_features([tau, N, layer])}\n")
+			cost = CostModel()
+			assert len(cost) == 0
+			assert_allclose(cost.weights(), prior_weights) # no timings: the prior
+			cost.load(filename)
+			cost.load(filename) # reloading replaces the timings of the file
+			assert len(cost) == 200
+		# without the prior, the weights are fitted exactly (up to the rounding of the times)
+		with mock.patch.object(cost_module, 'prior_strength', 0.):
+			assert_allclose(cost.weights(), weights, atol=0.01)
+		assert_allclose(cost.predict(features[:5]), times[:5], rtol=0.2)
+
+	def test_makespan(self):
+		# longest first: 5 | 4+1 | 3+2
+		assert makespan([1,2,3,4,5], 3) == 5
+		assert makespan([1,2,3,4,5], 1) == 15
+
+class TestPairStore(unittest.TestCase):
+
+	def test_put_get(self):
+		X, Y = np.linspace(0.,1.,20), np.random.default_rng(0).random((20,3))
+		with tempfile.TemporaryDirectory() as path:
+			store = PairStore(path)
+			key = store.key(0, 1, X, Y[:,0], Y[:,1], False, False)
+			assert store.key(0, 1, X, Y[:,0], Y[:,1], False, False) == key
+			# the inputs and the flags are in the key
+			assert store.key(0, 1, X, Y[:,0], Y[:,2], False, False) != key
+			assert store.key(0, 1, X, Y[:,0], Y[:,1], True, False) != key
+			assert store.get(key) is None
+			store.put(key, ('model', -0.1, Y[:,1]))
+			model, waic, y = store.get(key)
+			assert model == 'model' and waic == -0.1
+			assert_allclose(y, Y[:,1])
+			assert [f for f in os.listdir(path) if f.endswith('.tmp')] == []
+			# an unreadable result is trained again
+			open(os.path.join(path, f'{key}.pkl'), 'wb').close()
+			assert store.get(key) is None
+
+	def test_resume_tree(self):
+		X, Y = np.linspace(0.,1.,50), np.random.default_rng(0).random((50,6))
+		with tempfile.TemporaryDirectory() as path:
+			store = PairStore(path)
+			pool = FakePool(path, fail={(0,3)})
+			with self.assertRaises(RuntimeError):
+				train_next_tree(X, Y, 0, ['cpu'], pool=pool, pair_store=store)
+			pool.close()
+			# the other pairs were saved as soon as they were trained
+			stored = [i for i in range(1,6) if store.get(store.key(0, i, X, Y[:,0], Y[:,i], False, False)) is not None]
+			assert 3 not in stored and len(stored) > 0
+			pool = FakePool(path)
+			models, waics, Y_next = train_next_tree(X, Y, 0, ['cpu'], pool=pool, pair_store=store)
+			pool.close()
+		assert sorted(i for _, i, _ in pool.submitted) == [i for i in range(1,6) if i not in stored]
+		assert models == [f'model0-{i}' for i in range(1,6)]
+		assert_allclose(Y_next, np.stack([fake_output(Y[:,0], Y[:,i]) for i in range(1,6)]).T)
+
+	def test_resume_trees(self):
+		X, Y = np.linspace(0.,1.,50), np.random.default_rng(0).random((50,6))
+		inputs = [Y] # of each tree
+		for layer in range(3):
+			inputs.append(np.stack([fake_output(inputs[-1][:,0], inputs[-1][:,i]) for i in range(1,inputs[-1].shape[1])]).T)
+		pairs = [(layer, i) for layer in range(3) for i in range(1,6-layer)]
+		for shuffle in [False, True]:
+			# with shuffle, the X of each tree is the same in the resumed run
+			Xs = [shuffled(X, 0) if shuffle else X]
+			for layer in range(1,3):
+				Xs.append(shuffled(Xs[-1], layer) if shuffle else X)
+			with tempfile.TemporaryDirectory() as path:
+				store = PairStore(os.path.join(path, 'pairs'))
+				pool = FakePool(path, fail={(1,2)})
+				with self.assertRaises(RuntimeError):
+					train_trees(X, Y, 0, 3, ['cpu'], shuffle=shuffle, pool=pool, pair_store=store)
+				pool.close()
+				stored = {(layer, i) for layer, i in pairs if store.get(store.key(layer, i, Xs[layer],
+					inputs[layer][:,0], inputs[layer][:,i], False, False)) is not None}
+				assert (1,2) not in stored and len(stored) > 0
+				pool = FakePool(path)
+				models, waics, Y_next = train_trees(X, Y, 0, 3, ['cpu'], shuffle=shuffle, pool=pool, pair_store=store)
+				pool.close()
+			# only the pairs that were not stored are trained again
+			assert sorted((layer, i) for layer, i, _ in pool.submitted) == [pair for pair in pairs if pair not in stored]
+			assert models == [[f'model{layer}-{i}' for i in range(1,6-layer)] for layer in range(3)]
+			assert_allclose(Y_next, inputs[3])
+
+class TestJobQueue(unittest.TestCase):
+
+	def setUp(self):
+		self.dir = tempfile.TemporaryDirectory()
+		self.path = os.path.join(self.dir.name, 'queue.db')
+
+	def tearDown(self):
+		self.dir.cleanup()
+
+	def test_submit_take_complete(self):
+		queue = JobQueue(self.path)
+		id = queue.submit('run', (divmod, (7,2), {}))
+		assert queue.take('w1') == (id, (divmod, (7,2), {}))
+		assert queue.take('w2') is None # leased
+		assert queue.finished('run') == []
+		queue.complete(id, 'w2', 'other') # not its job
+		queue.complete(id, 'w1', (3,1))
+		assert queue.finished('run') == [(id, 'done', (3,1), None)]
+		assert queue.finished('other run') == []
+		queue.remove('run', [id])
+		assert queue.finished('run') == [] and queue.take('w1') is None
+
+	def test_lease_expiry(self):
+		queue = JobQueue(self.path, lease=0.1)
+		id = queue.submit('run', 'task')
+		assert queue.take('w1')[0] == id
+		assert queue.extend(id, 'w1')
+		assert queue.take('w2') is None
+		time.sleep(0.2)
+		# the worker died: the job is leased again
+		assert queue.take('w2') == (id, 'task')
+		assert not queue.extend(id, 'w1')
+		queue.complete(id, 'w1', 'late') # discarded
+		queue.complete(id, 'w2', 'result')
+		assert queue.finished('run') == [(id, 'done', 'result', None)]
+		# a removed job cannot be extended either
+		queue.remove('run')
+		assert not queue.extend(id, 'w2')
+
+	def test_max_attempts(self):
+		queue = JobQueue(self.path, max_attempts=2)
+		id = queue.submit('run', 'task')
+		queue.take('w1')
+		queue.fail(id, 'w1', 'first')
+		assert queue.finished('run') == [] # retried
+		assert queue.take('w2')[0] == id
+		queue.fail(id, 'w2', 'second')
+		assert queue.finished('run') == [(id, 'failed', None, 'second')]
+		assert queue.take('w3') is None
+		# the lease of a dead worker expired on the last attempt
+		queue = JobQueue(self.path, lease=0.1, max_attempts=1)
+		id = queue.submit('run', 'task')
+		queue.take('w1')
+		time.sleep(0.2)
+		assert queue.take('w2') is None
+		assert queue.finished('run')[-1] == (id, 'failed', None, 'the lease expired too many times')
+
+	def test_worker_settings(self):
+		# the settings of the job are applied while it runs, and restored after it
+		queue = JobQueue(self.path)
+		check, elements = select_copula.conf.subsample_check, select_copula.conf.elements
+		settings = _settings(select_copula.conf)
+		settings.update(subsample_check=check+0.5, elements=elements[:2])
+		ids = [queue.submit('run', (_conf_value, (name,), {}, '', _settings(bvcopula.conf), settings))
+			for name in ['subsample_check', 'elements']]
+		run_worker(self.path, idle_exit=0.1, poll=0.01)
+		(_, _, value, _), (_, _, applied, _) = sorted(queue.finished('run'))
+		assert value == check+0.5
+		# the lists of likelihoods as well
+		assert [get_copula_name_string([e]) for e in applied] == ['Independence', 'Gaussian']
+		assert select_copula.conf.subsample_check == check and select_copula.conf.elements is elements
+
+	def test_worker_cancelled(self):
+		# a job removed while it runs is interrupted (the worker runs in the main thread)
+		queue = JobQueue(self.path)
+		id = queue.submit('run', (_spin, (10.,), {}, '', {}, {}))
+		remover = threading.Timer(0.3, queue.remove, ('run',))
+		remover.start()
+		start = time.time()
+		with redirect_stdout(io.StringIO()) as output:
+			run_worker(self.path, idle_exit=0.1, poll=0.01, lease=0.15)
+		remover.join()
+		assert time.time()-start < 2.
+		assert f'Job {id} was cancelled' in output.getvalue()
+
+class TestQueuePool(unittest.TestCase):
+
+	def setUp(self):
+		self.dir = tempfile.TemporaryDirectory()
+		self.path = os.path.join(self.dir.name, 'queue.db')
+
+	def tearDown(self):
+		self.dir.cleanup()
+
+	def start_worker(self, **kwargs):
+		thread = threading.Thread(target=run_worker, args=(self.path,),
+			kwargs=dict(idle_exit=0.5, poll=0.01, **kwargs), daemon=True)
+		thread.start()
+		return thread
+
+	def test_results_and_errors(self):
+		results, errors = [], []
+		with QueuePool(self.path, poll=0.01) as pool:
+			Y = np.random.default_rng(0).random((10,3))
+			shared = pool.share(Y)
+			done = pool.apply_async(divmod, (7,2), callback=results.append)
+			data = pool.apply_async(fetch, (shared.column(1),))
+			failed = pool.apply_async(int, ('x',), error_callback=errors.append)
+			minus_one = pool.apply_async(int, ('-1',)) # the workers return -1 on errors
+			worker = self.start_worker()
+			assert done.get() == (3,1) and results == [(3,1)]
+			assert_allclose(data.get(), Y[:,1])
+			with self.assertRaisesRegex(RuntimeError, 'ValueError'):
+				failed.get()
+			assert len(errors) == 1 and isinstance(errors[0], RuntimeError)
+			with self.assertRaisesRegex(RuntimeError, 'returned -1'):
+				minus_one.get()
+		worker.join()
+		# the delivered jobs and the shared files were removed
+		assert JobQueue(self.path).finished(pool.run) == []
+		assert not os.path.exists(pool.dir)
+
+	def test_relative_path(self):
+		# the shared files are found by workers started in another directory
+		cwd = os.getcwd()
+		os.chdir(self.dir.name)
+		try:
+			pool = QueuePool('queue.db', poll=0.01)
+		finally:
+			os.chdir(cwd)
+		shared = pool.share(np.arange(3.))
+		assert os.path.isabs(pool.dir) and os.path.isabs(shared.path)
+		assert pool.queue.path == self.path
+		job = pool.apply_async(fetch, (shared,))
+		worker = self.start_worker()
+		assert_allclose(job.get(), np.arange(3.))
+		pool.close()
+		worker.join()
+
+	def test_close_waits(self):
+		pool = QueuePool(self.path, poll=0.01)
+		job = pool.apply_async(divmod, (7,2))
+		worker = self.start_worker()
+		pool.close()
+		assert job.get() == (3,1)
+		worker.join()
+
+	def test_terminate(self):
+		pool = QueuePool(self.path, poll=0.01)
+		pool.apply_async(_spin, (1.,))
+		pool.apply_async(divmod, (7,2))
+		with redirect_stdout(io.StringIO()) as output:
+			worker = self.start_worker(lease=0.15)
+			with sqlite3.connect(self.path) as db:
+				while db.execute("SELECT COUNT(*) FROM jobs WHERE status='leased'").fetchone()[0] == 0:
+					time.sleep(0.01)
+			pool.close(terminate=True)
+			worker.join()
+			# the pending job was not run, and the result of the running one was discarded
+			# (the worker is not in the main thread: it cannot be interrupted)
+			with sqlite3.connect(self.path) as db:
+				assert db.execute('SELECT COUNT(*) FROM jobs').fetchone()[0] == 0
+		assert 'was cancelled, its result is discarded' in output.getvalue()
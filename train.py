@@ -16,9 +16,13 @@ To run a model selection using this dataset.
 	Also, if using any flags, append them to the end of the dataset name, e.g. "datasetnameGL_layer0.pkl"
 	(this naming convention is defined by this script and can be easily changed)
 2. Configure the conf.py in the main folder. Provide a path to datasets and a path for outputs.
-3. If you use multiple GPUs, provide a list of device numbers in this script (gpus)
+3. If you use multiple GPUs, provide a list of device numbers (-gpus)
 4. Run "python train.py -exp datasetname"
 
+To distribute the pairs across several machines (sharing the file system), pass a job queue
+database (-queue path/to/queue.db) and start any number of workers on each machine:
+	python -m copulagp.train.jobqueue path/to/queue.db -device cuda:0
+
 '''
 
 if __name__ == "__main__":
@@ -30,6 +34,8 @@ if __name__ == "__main__":
 	parser.add_argument('--gauss','-g', default=False, help='Train with only Gauss Copulas', action='store_true')
 	parser.add_argument('--light','-l', default=False, help='Light model selection, without Gumbel', action='store_true')
 	parser.add_argument('--shuffle','-s', default=False, help='Shuffle X', action='store_true')
+	parser.add_argument('-gpus', default=[2,3,4,5,6,7], nargs='+', help='Device numbers of the GPUs', type=int)
+	parser.add_argument('-queue', default=None, help='Job queue database, for the workers on other machines')
 	# TODO paths to exps
 
 	args = parser.parse_args()
@@ -45,14 +51,14 @@ if __name__ == "__main__":
 	path_final = f"{conf.path2outputs}/{args.exp}{g}_trained.pkl"
 	path_logs = lambda exp_pref, layer: f'{conf.path2outputs}/logs_{exp_pref}/layer{layer}'
 
-	gpus = range(2,8)
 	start = time.time()
 	result = train_vine(args.exp, path_data, path_models, path_final,
 		layers_max=args.layers,start=args.start,gauss=args.gauss,
 		light=args.light,
 		shuffle=args.shuffle,
 		path_logs=path_logs,
-		device_list=[f'cuda:{i}' for i in gpus])
+		device_list=[f'cuda:{i}' for i in args.gpus],
+		queue=args.queue)
 	end = time.time()
 
 	print(f"Done. Training {args.start}-{len(result['models'])} trees took {(end-start)//60} min")